@@ -1,6 +1,9 @@
 from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
 from types import SimpleNamespace
 
+from .revocation import revocations
+
 class RawSQLJWTAuthentication(JWTAuthentication):
     """
     Custom Authentication backend that overrides the default JWT behavior 
@@ -8,8 +11,20 @@ class RawSQLJWTAuthentication(JWTAuthentication):
     
     This is specifically designed for architectures using raw SQL for user management,
     allowing the request.user object to be populated directly from token claims.
+    Revoked tokens are rejected using the in-process mirror of token versions
+    (see accounts/revocation.py), so no query is made per request.
     """
 
+    def __init__(self, *args, refresh_revocations=True, **kwargs):
+        """
+        Args:
+            refresh_revocations (bool): Whether `get_user` may refresh the revocation mirror
+                through Django's (sync-only) connection. Async callers pass False and
+                await `revocations.arefresh_if_stale()` before authenticating instead.
+        """
+        super().__init__(*args, **kwargs)
+        self.refresh_revocations = refresh_revocations
+
     def get_user(self, validated_token):
         """
         Retrieves the user identity from the validated JWT payload.
@@ -24,13 +39,20 @@ class RawSQLJWTAuthentication(JWTAuthentication):
             SimpleNamespace: A mock user object containing the 'id' and 'is_authenticated' 
                              status, compatible with DRF permission checks.
             None: If the user_id claim is missing.
+        Raises:
+            AuthenticationFailed: If the token was issued before the user's latest revocation.
         """
         user_id = validated_token.get('user_id')
         
         if not user_id:
             return None
 
+        if self.refresh_revocations:
+            revocations.refresh_if_stale()
+        if revocations.is_revoked(user_id, validated_token.get('ver', 0)):
+            raise AuthenticationFailed("Token has been revoked", code="token_revoked")
+
         # Create a stateless user object to facilitate compatibility with DRF's 
         # request.user interface (e.g., request.user.id and request.user.is_authenticated)
         # without requiring a corresponding record in a Django-managed table.
-        return SimpleNamespace(id=user_id, is_authenticated=True)
\ No newline at end of file
+        return SimpleNamespace(id=user_id, is_authenticated=True)
@@ -0,0 +1,32 @@
+"""
+Password hashers with their cost parameters taken from settings.PASSWORD_HASHING.
+
+Django rehashes a password on the next successful login when its stored hash
+uses another algorithm or different parameters than the first entry of
+settings.PASSWORD_HASHERS, so changing the values below upgrades existing users
+gradually without a migration.
+"""
+
+from django.conf import settings
+from django.contrib.auth.hashers import Argon2PasswordHasher, PBKDF2PasswordHasher
+
+_config = getattr(settings, 'PASSWORD_HASHING', {})
+
+
+class TunedArgon2PasswordHasher(Argon2PasswordHasher):
+    """
+    Argon2id (requires argon2-cffi). Parallelism defaults to 1 so that one hash
+    occupies one core and the hashing pool size maps directly onto CPU usage.
+    """
+
+    time_cost = _config.get('ARGON2_TIME_COST', Argon2PasswordHasher.time_cost)
+    memory_cost = _config.get('ARGON2_MEMORY_COST', Argon2PasswordHasher.memory_cost)
+    parallelism = _config.get('ARGON2_PARALLELISM', 1)
+
+
+class TunedPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """
+    PBKDF2-SHA256 for deployments without argon2-cffi.
+    """
+
+    iterations = _config.get('PBKDF2_ITERATIONS') or PBKDF2PasswordHasher.iterations
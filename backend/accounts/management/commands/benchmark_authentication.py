@@ -0,0 +1,57 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from accounts.authentication import RawSQLJWTAuthentication
+from accounts.revocation import revocations
+
+
+class Command(BaseCommand):
+    help = ("Measures per-request authentication cost: signature check only, with the "
+            "revocation check, and with a naive users lookup for comparison.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000)
+
+    def _time(self, fn, iterations):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        return (time.perf_counter() - start) / iterations * 1e6
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id FROM users LIMIT 1")
+            row = cursor.fetchone()
+        if row is None:
+            self.stderr.write("Needs at least one user")
+            return
+
+        refresh = RefreshToken()
+        refresh['user_id'] = str(row[0])
+        refresh['ver'] = revocations.version(row[0])
+        raw = str(refresh.access_token).encode()
+        authenticator = RawSQLJWTAuthentication()
+
+        def validate():
+            authenticator.get_validated_token(raw)
+
+        def with_revocation():
+            authenticator.get_user(authenticator.get_validated_token(raw))
+
+        def with_lookup():
+            token = authenticator.get_validated_token(raw)
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT id FROM users WHERE id = %s", [token['user_id']])
+                cursor.fetchone()
+
+        for label, fn, n in (
+            ("Signature only", validate, iterations),
+            ("With revocation cache", with_revocation, iterations),
+            ("With users lookup", with_lookup, max(1, iterations // 10)),
+        ):
+            self.stdout.write(f"{label}: {self._time(fn, n):.1f} us/request")
+        self.stdout.write(f"Revocation cache: {revocations.stats()}")
@@ -0,0 +1,62 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, check_password, get_hasher, make_password
+from django.core.management.base import BaseCommand
+
+from services.passwords import HashingBusyError, pool, verify_password
+
+PASSWORD = "correct horse battery staple"
+
+
+class Command(BaseCommand):
+    help = ("Measures logins/sec (one password check each) for Django's default PBKDF2 and the "
+            "configured hasher: inline on one thread, and through the hashing pool under load.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=5.0, help="Duration of each measurement")
+        parser.add_argument('--clients', type=int, default=None,
+                            help="Concurrent request threads submitting to the pool (default: 2x workers)")
+
+    def _inline(self, encoded, seconds):
+        count = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            check_password(PASSWORD, encoded)
+            count += 1
+        return count / seconds
+
+    def _pooled(self, encoded, seconds, clients):
+        # Each client plays a request thread: it blocks on pool.run like UserViewSet.login does
+        def client(deadline):
+            done, rejected = 0, 0
+            while time.monotonic() < deadline:
+                try:
+                    verify_password(PASSWORD, encoded)
+                    done += 1
+                except HashingBusyError:
+                    rejected += 1
+            return done, rejected
+
+        deadline = time.monotonic() + seconds
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            results = list(executor.map(client, [deadline] * clients))
+        return sum(r[0] for r in results) / seconds, sum(r[1] for r in results)
+
+    def handle(self, *args, **options):
+        seconds = options['seconds']
+        clients = options['clients'] or pool.workers * 2
+        default = PBKDF2PasswordHasher()
+        cases = [
+            ("Django default PBKDF2 (before)", default.encode(PASSWORD, default.salt())),
+            (f"Configured {get_hasher().algorithm} (after)", make_password(PASSWORD)),
+        ]
+
+        for label, encoded in cases:
+            per_core = self._inline(encoded, seconds)
+            pooled, rejected = self._pooled(encoded, seconds, clients)
+            self.stdout.write(
+                f"{label}: {per_core:.1f} logins/s inline on one core; "
+                f"{pooled:.1f} logins/s through the pool ({pool.workers} workers, "
+                f"{clients} clients, {rejected} rejected as busy)"
+            )
@@ -0,0 +1,28 @@
+"""
+Per-user token versions for revocation (see accounts/revocation.py).
+
+There is deliberately no foreign key to users: the row has to outlive a deleted
+account so that the account's outstanding tokens stay revoked. The updated_at
+index serves the incremental refresh every process runs.
+"""
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = []
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE IF NOT EXISTS token_versions (
+                    user_id UUID PRIMARY KEY,
+                    version INT NOT NULL,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                );
+                CREATE INDEX IF NOT EXISTS token_versions_updated_at_idx ON token_versions (updated_at);
+            """,
+            reverse_sql="DROP TABLE IF EXISTS token_versions",
+        ),
+    ]
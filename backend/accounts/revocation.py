@@ -0,0 +1,143 @@
+"""
+Token revocation without a per-request database lookup.
+
+Every user has a token version (`token_versions`, absent row = 0) that is stamped
+on issued tokens as the `ver` claim. Revoking bumps the version, which invalidates
+every token issued before. Each process mirrors the table in memory and refreshes
+it with one query for the rows changed since the last refresh, at most every
+settings.TOKEN_REVOCATION['REFRESH_SECONDS']. A revocation therefore applies
+immediately in the process that made it and within that interval everywhere else.
+
+The table only holds users who have revoked at least once (logout everywhere,
+account deletion), so the mirror stays small.
+"""
+
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+
+# Rows are re-read for this long after they were seen, so a bump whose transaction
+# committed after a later one is not missed by the incremental refresh
+REFRESH_OVERLAP = timedelta(seconds=30)
+
+CHANGED_VERSIONS_QUERY = "SELECT user_id, version, updated_at FROM token_versions WHERE updated_at > %s"
+
+BUMP_VERSION_SQL = """
+    INSERT INTO token_versions (user_id, version, updated_at) VALUES (%s, 1, clock_timestamp())
+    ON CONFLICT (user_id) DO UPDATE
+    SET version = token_versions.version + 1, updated_at = clock_timestamp()
+    RETURNING version
+"""
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class TokenVersionCache:
+    """
+    In-process mirror of `token_versions`.
+
+    :param refresh_seconds: Maximum age of the mirror before the next check refreshes it
+    """
+
+    def __init__(self, refresh_seconds=5.0):
+        self.refresh_seconds = refresh_seconds
+        self._versions = {}
+        self._since = _EPOCH
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+        self._arefreshing = False
+        self.refreshes = 0
+        self.rejected = 0
+
+    def _stale(self):
+        return self._refreshed_at is None or time.monotonic() - self._refreshed_at > self.refresh_seconds
+
+    def _apply(self, rows):
+        latest = self._since
+        for user_id, version, updated_at in rows:
+            user_id = str(user_id)
+            # Never lower a version applied locally by `revoke`
+            if version > self._versions.get(user_id, 0):
+                self._versions[user_id] = version
+            latest = max(latest, updated_at - REFRESH_OVERLAP)
+        self._since = latest
+        self._refreshed_at = time.monotonic()
+        self.refreshes += 1
+
+    def refresh_if_stale(self):
+        """
+        Refreshes through Django's connection (WSGI). While another thread refreshes,
+        callers keep using the current mirror; only the very first load is waited for.
+        """
+        if not self._stale():
+            return
+        if not self._lock.acquire(blocking=self._refreshed_at is None):
+            return
+        try:
+            if self._stale():
+                with connection.cursor() as cursor:
+                    cursor.execute(CHANGED_VERSIONS_QUERY, [self._since])
+                    self._apply(cursor.fetchall())
+        finally:
+            self._lock.release()
+
+    async def arefresh_if_stale(self):
+        """
+        `refresh_if_stale` for async callers (psycopg async pool).
+        """
+        from canvas.async_db import fetch_all
+
+        if not self._stale() or (self._arefreshing and self._refreshed_at is not None):
+            return
+        self._arefreshing = True
+        try:
+            rows = await fetch_all(CHANGED_VERSIONS_QUERY, [self._since])
+            self._apply([(r['user_id'], r['version'], r['updated_at']) for r in rows])
+        finally:
+            self._arefreshing = False
+
+    def version(self, user_id):
+        return self._versions.get(str(user_id), 0)
+
+    def is_revoked(self, user_id, token_version):
+        """
+        True if the token was issued before the user's latest revocation. No I/O:
+        call `refresh_if_stale` / `arefresh_if_stale` first.
+        """
+        # A newer token than the mirror knows of was issued after a revocation elsewhere
+        revoked = (token_version or 0) < self.version(user_id)
+        if revoked:
+            self.rejected += 1
+        return revoked
+
+    def revoke(self, cursor, user_id):
+        """
+        Invalidates every token issued to the user so far and returns the new version.
+        Applied to this process's mirror once the surrounding transaction commits.
+        """
+        cursor.execute(BUMP_VERSION_SQL, [user_id])
+        version = cursor.fetchone()[0]
+
+        def apply():
+            key = str(user_id)
+            self._versions[key] = max(version, self._versions.get(key, 0))
+        transaction.on_commit(apply)
+        return version
+
+    def stats(self):
+        return {
+            "users": len(self._versions),
+            "refreshes": self.refreshes,
+            "rejected": self.rejected
+        }
+
+
+def _build_revocations() -> TokenVersionCache:
+    config = getattr(settings, 'TOKEN_REVOCATION', {})
+    return TokenVersionCache(refresh_seconds=config.get('REFRESH_SECONDS', 5.0))
+
+
+revocations = _build_revocations()
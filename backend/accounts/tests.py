@@ -1,3 +1,216 @@
-from django.test import TestCase
+import threading
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, get_hasher
+from django.core.cache import caches
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from services.passwords import HashingBusyError, HashingPool
+from .revocation import TokenVersionCache, revocations
+from .throttling import LoginThrottle
+from .views import UserViewSet
+
+
+def create_user(email="owner@example.com"):
+    with connection.cursor() as cursor:
+        cursor.execute("INSERT INTO users (email, password) VALUES (%s, 'x') RETURNING id", [email])
+        return str(cursor.fetchone()[0])
+
+
+def bearer(access):
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
+    return client
+
+
+class TokenRevocationTests(TestCase):
+
+    def setUp(self):
+        self.user_id = create_user()
+
+    def profile_status(self, access):
+        return bearer(access).get(f"/api/accounts/users/{self.user_id}/").status_code
+
+    def revoke(self, access):
+        # The mirror is updated on commit, which TestCase's transaction never reaches
+        with self.captureOnCommitCallbacks(execute=True):
+            response = bearer(access).post("/api/accounts/users/revoke/")
+        self.assertEqual(response.status_code, 204)
+
+    def test_revoked_token_is_rejected(self):
+        access = UserViewSet().get_tokens_for_user(self.user_id)['access']
+        self.assertEqual(self.profile_status(access), 200)
+
+        self.revoke(access)
+        self.assertEqual(self.profile_status(access), 401)
+        # Tokens issued after the revocation carry the new version
+        fresh = UserViewSet().get_tokens_for_user(self.user_id, revocations.version(self.user_id))['access']
+        self.assertEqual(self.profile_status(fresh), 200)
+
+    def test_token_without_version_claim(self):
+        # Issued before token versions existed: counts as version 0
+        refresh = RefreshToken()
+        refresh['user_id'] = self.user_id
+        legacy = str(refresh.access_token)
+        self.assertEqual(self.profile_status(legacy), 200)
+
+        self.revoke(legacy)
+        self.assertEqual(self.profile_status(legacy), 401)
+
+
+class TokenVersionRefreshTests(TestCase):
+
+    def setUp(self):
+        self.users = [create_user(f"user{i}@example.com") for i in range(3)]
+        self.cache = TokenVersionCache(refresh_seconds=0)
+
+    def bump(self, user_id, version, seconds_ago):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO token_versions (user_id, version, updated_at)
+                VALUES (%s, %s, now() - make_interval(secs => %s))
+                ON CONFLICT (user_id) DO UPDATE SET version = EXCLUDED.version, updated_at = EXCLUDED.updated_at
+                """,
+                [user_id, version, seconds_ago]
+            )
+
+    def test_incremental_refresh_rereads_the_overlap(self):
+        first, late, old = self.users
+        self.bump(first, 1, 0)
+        with self.assertNumQueries(1):
+            self.cache.refresh_if_stale()
+        self.assertEqual(self.cache.version(first), 1)
+
+        # Committed after `first` but stamped earlier, within the 30s overlap: still picked up
+        self.bump(late, 2, 10)
+        # Older than the overlap: an incremental refresh no longer reads it
+        self.bump(old, 3, 60)
+        with self.assertNumQueries(1):
+            self.cache.refresh_if_stale()
+        self.assertEqual(self.cache.version(late), 2)
+        self.assertEqual(self.cache.version(old), 0)
+
+    def test_refresh_never_lowers_a_local_revocation(self):
+        with connection.cursor() as cursor:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.cache.revoke(cursor, self.users[0])
+        # Another process saw an older row
+        self.cache._apply([(self.users[0], 0, self.cache._since)])
+        self.assertTrue(self.cache.is_revoked(self.users[0], 0))
+
+
+@mock.patch("accounts.throttling.time.time", return_value=60 * 1000 + 1)
+class LoginThrottleTests(SimpleTestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.throttle = LoginThrottle(email_attempts=2, ip_attempts=3, window=60)
+
+    def attempt(self, ip, email=None):
+        return self.throttle.attempt(RequestFactory().post("/", REMOTE_ADDR=ip), email=email)
+
+    def test_email_limit_holds_across_ips(self, _):
+        self.assertEqual([self.attempt(ip, "a@example.com") for ip in ("10.0.0.1", "10.0.0.2")], [0, 0])
+        self.assertEqual(self.attempt("10.0.0.3", "A@example.com "), 60)
+        self.assertEqual(self.attempt("10.0.0.3", "b@example.com"), 0)
+
+    def test_ip_limit_holds_across_emails(self, _):
+        self.assertEqual([self.attempt("10.0.0.1", f"{i}@example.com") for i in range(3)], [0, 0, 0])
+        # Registrations count against the IP too
+        self.assertGreater(self.attempt("10.0.0.1"), 0)
+        self.assertEqual(self.attempt("10.0.0.2", "0@example.com"), 0)
+
+    def test_success_clears_the_email_count(self, _):
+        self.attempt("10.0.0.1", "a@example.com")
+        self.attempt("10.0.0.1", "a@example.com")
+        self.throttle.succeeded("a@example.com")
+        self.assertEqual(self.attempt("10.0.0.2", "a@example.com"), 0)
+
+
+class HashingPoolTests(SimpleTestCase):
+
+    def test_rejects_beyond_max_pending(self):
+        pool = HashingPool(workers=1, max_pending=2, max_wait=5)
+        started, release = threading.Event(), threading.Event()
+
+        def blocking():
+            started.set()
+            release.wait()
+            return "slow"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(pool.run(blocking)))]
+        threads[0].start()
+        started.wait()
+        # Queued behind the running hash: the second and last slot
+        threads.append(threading.Thread(target=lambda: results.append(pool.run(str, "queued"))))
+        threads[1].start()
+
+        with self.assertRaises(HashingBusyError):
+            pool.run(str, "rejected")
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results), ["queued", "slow"])
+        self.assertEqual(pool.stats()["rejected"], 1)
+        self.assertEqual(pool.run(str, "again"), "again")
+
+    def test_gives_up_after_max_wait(self):
+        pool = HashingPool(workers=1, max_pending=4, max_wait=0.05)
+        started, release = threading.Event(), threading.Event()
+        ran = []
+
+        def blocking():
+            started.set()
+            release.wait()
+
+        # The caller gives up on its hash after max_wait, the hash itself keeps running
+        blocker = pool._executor.submit(blocking)
+        started.wait()
+        with self.assertRaises(HashingBusyError):
+            pool.run(ran.append, "late")
+        release.set()
+        blocker.result()
+
+        # The abandoned hash was still queued, so it was cancelled rather than run
+        self.assertEqual(pool.run(ran.append, "next"), None)
+        self.assertEqual(ran, ["next"])
+        self.assertEqual(pool.stats()["rejected"], 1)
+
+
+class LoginRehashTests(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        weak = PBKDF2PasswordHasher()
+        weak.iterations = 1000
+        self.user_id = create_user()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE users SET password = %s WHERE id = %s", [weak.encode("secret", weak.salt()), self.user_id]
+            )
+
+    def stored_hash(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT password FROM users WHERE id = %s", [self.user_id])
+            return cursor.fetchone()[0]
+
+    def login(self, password="secret"):
+        return APIClient().post(
+            "/api/accounts/users/login/", {"email": "owner@example.com", "password": password}, format="json"
+        )
+
+    def test_outdated_hash_is_replaced_on_login(self):
+        self.assertEqual(self.login("wrong").status_code, 401)
+        self.assertIn("$1000$", self.stored_hash())
+
+        self.assertEqual(self.login().status_code, 200)
+        upgraded = self.stored_hash()
+        self.assertFalse(get_hasher().must_update(upgraded))
+        self.assertEqual(self.login().status_code, 200)
+        self.assertEqual(self.stored_hash(), upgraded)
@@ -0,0 +1,82 @@
+"""
+Attempt limits for the password endpoints, checked before any hashing is done.
+
+Counters live in a Django cache (use a shared backend such as Redis so limits hold
+across workers) and use fixed windows of settings.LOGIN_THROTTLE['WINDOW'] seconds:
+
+    per email: login attempts; a successful login clears the count
+    per IP:    login and registration attempts, regardless of outcome
+
+The email key is hashed, so arbitrary input is a valid cache key.
+"""
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.throttling import BaseThrottle
+
+
+class LoginThrottle:
+    """
+    :param email_attempts: Login attempts per email and window
+    :param ip_attempts: Login/registration attempts per client IP and window
+    :param window: Window length in seconds
+    :param alias: Django cache alias holding the counters
+    """
+
+    KEY_PREFIX = "login:"
+
+    def __init__(self, email_attempts=10, ip_attempts=100, window=300, alias='default'):
+        self.email_attempts = email_attempts
+        self.ip_attempts = ip_attempts
+        self.window = window
+        self.alias = alias
+        self._ident = BaseThrottle()
+
+    def _key(self, kind, value, now):
+        return f"{self.KEY_PREFIX}{kind}:{value}:{int(now // self.window)}"
+
+    def _email_key(self, email, now):
+        digest = hashlib.sha256((email or "").strip().lower().encode("utf-8")).hexdigest()
+        return self._key("email", digest, now)
+
+    def _take(self, key, limit):
+        cache = caches[self.alias]
+        cache.add(key, 0, self.window + 30)
+        return cache.incr(key) <= limit
+
+    def _retry_after(self, now):
+        return int(self.window - now % self.window) + 1
+
+    def client_ip(self, request):
+        # Honours REST_FRAMEWORK['NUM_PROXIES'] for X-Forwarded-For, like DRF's throttles
+        return self._ident.get_ident(request)
+
+    def attempt(self, request, email=None):
+        """
+        Counts an attempt. Returns 0 if it may proceed, else the seconds until it may be retried.
+        Pass `email` for logins; registrations only count against the IP.
+        """
+        now = time.time()
+        allowed = self._take(self._key("ip", self.client_ip(request), now), self.ip_attempts)
+        if email is not None:
+            allowed = self._take(self._email_key(email, now), self.email_attempts) and allowed
+        return 0 if allowed else self._retry_after(now)
+
+    def succeeded(self, email):
+        caches[self.alias].delete(self._email_key(email, time.time()))
+
+
+def _build_login_throttle() -> LoginThrottle:
+    config = getattr(settings, 'LOGIN_THROTTLE', {})
+    return LoginThrottle(
+        email_attempts=config.get('EMAIL_ATTEMPTS', 10),
+        ip_attempts=config.get('IP_ATTEMPTS', 100),
+        window=config.get('WINDOW', 300),
+        alias=config.get('CACHE_ALIAS', 'default')
+    )
+
+
+login_throttle = _build_login_throttle()
@@ -1,10 +1,16 @@
 from rest_framework import viewsets, status, permissions
 from rest_framework.response import Response
 from rest_framework.decorators import action
-from django.contrib.auth.hashers import make_password, check_password
-from django.db import connection
+from django.db import connection, transaction
 from rest_framework_simplejwt.tokens import RefreshToken
 
+from services.db import Query, fetch_one
+from services.passwords import HashingBusyError, hash_password, verify_password
+from .revocation import revocations
+from .throttling import login_throttle
+
+USER_QUERY = Query("users.retrieve", "SELECT id, email, created_at FROM users WHERE id = %s")
+
 class UserViewSet(viewsets.ViewSet):
     """
     ViewSet for managing user-related operations including registration, 
@@ -22,22 +28,35 @@ class UserViewSet(viewsets.ViewSet):
             return [permissions.AllowAny()]
         return [permissions.IsAuthenticated()]
 
-    def get_tokens_for_user(self, user_id):
+    def get_tokens_for_user(self, user_id, token_version=0):
         """
         Manually generates a new pair of Refresh and Access JWT tokens for a specific user.
         
         Args:
             user_id (int/str): The unique identifier of the user.
+            token_version (int): The user's current token version (see accounts/revocation.py).
         Returns:
             dict: Containing 'refresh' and 'access' token strings.
         """
         refresh = RefreshToken()
         refresh['user_id'] = str(user_id) 
+        refresh['ver'] = token_version
         return {
             'refresh': str(refresh),
             'access': str(refresh.access_token),
         }
 
+    def _throttled_response(self, wait):
+        response = Response({"error": "Too many attempts, try again later"},
+                            status=status.HTTP_429_TOO_MANY_REQUESTS)
+        response['Retry-After'] = str(wait)
+        return response
+
+    def _busy_response(self, error):
+        response = Response({"error": str(error)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        response['Retry-After'] = str(error.retry_after)
+        return response
+
     def check_ownership(self, request, pk):
         """
         Security Utility: Validates that the authenticated user is accessing their own resource.
@@ -60,23 +79,15 @@ class UserViewSet(viewsets.ViewSet):
         Restricted to the requester's own data to ensure privacy.
         """
         current_user_id = request.user.id
-        query = "SELECT id, email, created_at FROM users WHERE id = %s"
-        
-        with connection.cursor() as cursor:
-            cursor.execute(query, [current_user_id])
-            columns = [col[0] for col in cursor.description]
-            row = cursor.fetchone()
-            if row:
-                user_data = dict(zip(columns, row))
-                return Response({"data": [user_data]})
-        
-        return Response({"data": []})
+        user_data = fetch_one(USER_QUERY, [current_user_id])
+        return Response({"data": [user_data] if user_data else []})
 
     def create(self, request):
         """
         POST /users/
         Registers a new user in the system. 
         Hashes the password before persistence and returns initial JWT tokens.
+        Registrations count against the per-IP attempt limit.
         """
         data = request.data
         email = data.get('email')
@@ -85,7 +96,15 @@ class UserViewSet(viewsets.ViewSet):
         if not email or not raw_password:
             return Response({"error": "Missing email/password"}, status=status.HTTP_400_BAD_REQUEST)
 
-        hashed_password = make_password(raw_password)
+        wait = login_throttle.attempt(request)
+        if wait:
+            return self._throttled_response(wait)
+
+        try:
+            hashed_password = hash_password(raw_password)
+        except HashingBusyError as e:
+            return self._busy_response(e)
+
         query = "INSERT INTO users (email, password) VALUES (%s, %s) RETURNING id, created_at"
         
         try:
@@ -113,18 +132,11 @@ class UserViewSet(viewsets.ViewSet):
         if not self.check_ownership(request, pk):
             return Response({"error": "Forbidden: You cannot view other users."}, status=status.HTTP_403_FORBIDDEN)
 
-        query = "SELECT id, email, created_at FROM users WHERE id = %s"
-        with connection.cursor() as cursor:
-            cursor.execute(query, [pk])
-            row = cursor.fetchone()
-            if not row:
-                return Response({"error": "Not found"}, status=status.HTTP_404_NOT_FOUND)
-            
-            return Response({
-                "id": row[0],
-                "email": row[1],
-                "created_at": row[2]
-            })
+        row = fetch_one(USER_QUERY, [pk])
+        if not row:
+            return Response({"error": "Not found"}, status=status.HTTP_404_NOT_FOUND)
+        
+        return Response(row)
 
     def update(self, request, pk=None):
         """
@@ -141,7 +153,11 @@ class UserViewSet(viewsets.ViewSet):
         if not email or not password:
             return Response({"error": "Email and password are required for update"}, status=status.HTTP_400_BAD_REQUEST)
 
-        hashed_password = make_password(password)
+        try:
+            hashed_password = hash_password(password)
+        except HashingBusyError as e:
+            return self._busy_response(e)
+
         query = "UPDATE users SET email = %s, password = %s WHERE id = %s"
         
         try:
@@ -158,15 +174,17 @@ class UserViewSet(viewsets.ViewSet):
         DELETE /users/{id}/
         Performs a hard delete of the user record from the database.
         Verified via ownership check to ensure users can only delete their own account.
+        Outstanding tokens of the account are revoked with it.
         """
         if not self.check_ownership(request, pk):
             return Response({"error": "Forbidden: You cannot delete other users."}, status=status.HTTP_403_FORBIDDEN)
 
         query = "DELETE FROM users WHERE id = %s"
-        with connection.cursor() as cursor:
+        with transaction.atomic(), connection.cursor() as cursor:
             cursor.execute(query, [pk])
             if cursor.rowcount == 0:
                 return Response({"error": "User not found"}, status=status.HTTP_404_NOT_FOUND)
+            revocations.revoke(cursor, pk)
         
         return Response({"message": "Account deleted"}, status=status.HTTP_204_NO_CONTENT)
 
@@ -176,21 +194,58 @@ class UserViewSet(viewsets.ViewSet):
         POST /users/login/
         Authenticates a user via email and password.
         Returns user metadata and a fresh JWT pair upon successful verification.
+        Attempts are limited per email and per client IP before any hashing happens,
+        and a stored hash with outdated parameters is replaced after a successful check.
         """
         email = request.data.get('email')
         password = request.data.get('password')
 
-        query = "SELECT id, password FROM users WHERE email = %s"
+        wait = login_throttle.attempt(request, email=email)
+        if wait:
+            return self._throttled_response(wait)
+
+        query = """
+            SELECT u.id, u.password, COALESCE(t.version, 0) FROM users u
+            LEFT JOIN token_versions t ON t.user_id = u.id
+            WHERE u.email = %s
+        """
         with connection.cursor() as cursor:
             cursor.execute(query, [email])
             row = cursor.fetchone()
 
-        if row and check_password(password, row[1]):
-            tokens = self.get_tokens_for_user(row[0])
-            return Response({
-                "id": row[0],
-                "email": email, 
-                "tokens": tokens
-            }, status=status.HTTP_200_OK)
+        if row and password:
+            try:
+                valid, new_hash = verify_password(password, row[1])
+            except HashingBusyError as e:
+                return self._busy_response(e)
+
+            if valid:
+                login_throttle.succeeded(email)
+                if new_hash:
+                    # Skipped if the password was changed since it was read
+                    with connection.cursor() as cursor:
+                        cursor.execute(
+                            "UPDATE users SET password = %s WHERE id = %s AND password = %s",
+                            [new_hash, row[0], row[1]]
+                        )
+
+                tokens = self.get_tokens_for_user(row[0], row[2])
+                return Response({
+                    "id": row[0],
+                    "email": email, 
+                    "tokens": tokens
+                }, status=status.HTTP_200_OK)
         
-        return Response({"error": "Invalid credentials"}, status=status.HTTP_401_UNAUTHORIZED)
\ No newline at end of file
+        return Response({"error": "Invalid credentials"}, status=status.HTTP_401_UNAUTHORIZED)
+
+    @action(detail=False, methods=['post'])
+    def revoke(self, request):
+        """
+        POST /users/revoke/
+        Signs the user out everywhere: every token issued so far, including the one
+        used for this request, stops working within TOKEN_REVOCATION['REFRESH_SECONDS'].
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            revocations.revoke(cursor, request.user.id)
+
+        return Response(status=status.HTTP_204_NO_CONTENT)
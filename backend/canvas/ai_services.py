@@ -1,41 +1,379 @@
-import google.generativeai as genai
-import os
-from typing import List, TypedDict
+import hashlib
+import json
+import logging
+import threading
+from typing import Iterator, List, NamedTuple, Optional, TypedDict
 
-genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-model = genai.GenerativeModel("gemini-flash-latest")
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from services.cache import DjangoCacheBackend, LRUCache
+from services.limiter import BACKGROUND, get_limiter, get_single_flight, is_overloaded
+from services.llm import LLMProvider, get_llm
+from .context import CONTEXT_TOKEN_BUDGET, build_contents, estimate_tokens, to_contents
+from .prefix_cache import PrefixCache, is_cache_missing
+
+logger = logging.getLogger(__name__)
 
 class MessageDict(TypedDict):
     role: str
     content: str
 
-def ask_gemini(previous_messages: List[MessageDict], prompt: str):
+
+def request_key(model_name, contents):
+    """
+    Hash of the model name and the exact `contents` payload. Identifies identical
+    requests for the response cache and for coalescing. Text is not normalized:
+    whitespace can change the answer (code indentation, Markdown line breaks).
+    """
+    exact = [{"role": c["role"], "parts": [{"text": p["text"]} for p in c["parts"]]} for c in contents]
+    payload = json.dumps([model_name, exact], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Caches model answers keyed by a hash of the model name and the exact
+    `contents` payload (history + instruction), so retries and repeated branches
+    of the same highlight skip the Gemini round trip. Keeps hit/miss counters.
+    """
+
+    KEY_PREFIX = "canvas:llm:"
+
+    def __init__(self, backend, model_name):
+        self.backend = backend
+        self.model_name = model_name
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, contents):
+        return self.KEY_PREFIX + request_key(self.model_name, contents)
+
+    def _count(self, value):
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def get(self, contents):
+        return self._count(self.backend.get(self.key(contents)))
+
+    def set(self, contents, text):
+        self.backend.set(self.key(contents), text)
+
+    async def aget(self, contents):
+        return self._count(await self.backend.aget(self.key(contents)))
+
+    async def aset(self, contents, text):
+        await self.backend.aset(self.key(contents), text)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+
+def _build_response_cache() -> Optional[ResponseCache]:
+    """
+    Creates the cache described by settings.CANVAS_LLM_CACHE, or None when disabled.
+    """
+    config = getattr(settings, 'CANVAS_LLM_CACHE', {})
+    backend_name = config.get('BACKEND', 'memory')
+    ttl = config.get('TTL', 3600)
+
+    if backend_name == 'memory':
+        backend = LRUCache(max_entries=config.get('MAX_ENTRIES', 1024), ttl=ttl)
+    elif backend_name == 'django':
+        backend = DjangoCacheBackend(alias=config.get('ALIAS', 'default'), ttl=ttl)
+    else:
+        return None
+    return ResponseCache(backend, get_llm().model_name)
+
+
+response_cache = _build_response_cache()
+
+def _build_prefix_cache() -> Optional[PrefixCache]:
+    """
+    Creates the shared-prefix cache described by settings.CANVAS_LLM_PREFIX_CACHE, or None when disabled.
+    """
+    config = getattr(settings, 'CANVAS_LLM_PREFIX_CACHE', {})
+    if not config.get('ENABLED', False):
+        return None
+
+    ttl = config.get('TTL', 600)
+    # Registry entries expire before the provider-side cache so stale handles are rare
+    registry_ttl = max(1, ttl - 60)
+    if config.get('BACKEND', 'memory') == 'django':
+        registry = DjangoCacheBackend(alias=config.get('ALIAS', 'default'), ttl=registry_ttl)
+    else:
+        registry = LRUCache(max_entries=config.get('MAX_ENTRIES', 256), ttl=registry_ttl)
+
+    return PrefixCache(
+        get_llm(),
+        registry,
+        min_tokens=config.get('MIN_TOKENS', 4096),
+        ttl=ttl
+    )
+
+
+prefix_cache = _build_prefix_cache()
+
+
+class _RequestPlan(NamedTuple):
+    # Provider to call and the contents to send to it
+    provider: LLMProvider
+    contents: list
+    tokens: int
+    # The conversation as sent without a cached prefix: the response-cache key and the fallback
+    full_contents: list
+    full_tokens: int
+    # Inherited turns served from the provider cache (None when sent inline)
+    cached_prefix: Optional[list]
+    cached_tokens: int
+
+
+def _plan_request(previous_messages: List[MessageDict], prompt: str, highlight: Optional[str] = None,
+                  summary: Optional[str] = None, inherited: int = 0) -> _RequestPlan:
+    """
+    Converts stored chat history plus the current prompt into Gemini's `contents` payload,
+    trimmed to the token budget (see `canvas.context.build_contents`).
+
+    When the first `inherited` messages (a branch's ancestor context) are long and shared
+    with other chats, they are served from a provider-side cache instead and only the
+    chat's own turns are sent. The cached prefix counts against the budget like inline
+    turns do: the chat's own turns get what is left, and the prefix is sent inline when
+    it leaves no room for them.
+    """
+    contents, tokens = build_contents(previous_messages, prompt, highlight, summary)
+
+    if prefix_cache and inherited:
+        prefix_tokens = sum(estimate_tokens(m["content"]) for m in previous_messages[:inherited])
+        suffix, suffix_tokens = build_contents(
+            previous_messages[inherited:], prompt, highlight, summary, budget=CONTEXT_TOKEN_BUDGET - prefix_tokens
+        )
+        if prefix_tokens + suffix_tokens <= CONTEXT_TOKEN_BUDGET:
+            prefix = to_contents(previous_messages[:inherited])
+            bound = prefix_cache.provider_for(prefix, prefix_tokens)
+            if bound is not None:
+                return _RequestPlan(bound, suffix, suffix_tokens, contents, tokens, prefix, prefix_tokens)
+
+    return _RequestPlan(get_llm(), contents, tokens, contents, tokens, None, 0)
+
+def _report_usage(plan: _RequestPlan):
+    logger.info(
+        "Gemini request: %d turns, ~%d input tokens (+~%d from context cache)",
+        len(plan.contents), plan.tokens, plan.cached_tokens
+    )
+
+def _can_fall_back(plan: _RequestPlan, error: Exception):
+    # Overload and other errors are the caller's to handle; resending inline would only add load
+    return plan.cached_prefix is not None and is_cache_missing(error)
+
+def _fallback(plan: _RequestPlan, error: Exception):
+    """
+    The cached prefix is gone (typically expired): forget it and send the budgeted inline request.
+    """
+    logger.warning("Cached prefix request failed, retrying inline: %s", error)
+    prefix_cache.invalidate(plan.cached_prefix)
+    return plan._replace(
+        provider=get_llm(), contents=plan.full_contents, tokens=plan.full_tokens, cached_prefix=None, cached_tokens=0
+    )
+
+def _generate(plan: _RequestPlan) -> str:
+    try:
+        return plan.provider.generate(plan.contents)
+    except Exception as e:
+        if not _can_fall_back(plan, e):
+            raise
+        plan = _fallback(plan, e)
+        return plan.provider.generate(plan.contents)
+
+async def _generate_async(plan: _RequestPlan) -> str:
+    try:
+        return await plan.provider.agenerate(plan.contents)
+    except Exception as e:
+        if not _can_fall_back(plan, e):
+            raise
+        plan = await sync_to_async(_fallback, thread_sensitive=False)(plan, e)
+        return await plan.provider.agenerate(plan.contents)
+
+def _call(plan: _RequestPlan, user_id, coalesce: bool) -> str:
+    """
+    Runs the request inside a limiter slot. With `coalesce`, identical requests already
+    in flight are joined instead of being sent again (before taking a slot).
+    """
+    run = lambda: get_limiter().run(user_id, lambda: _generate(plan))
+    if not coalesce:
+        return run()
+    return get_single_flight().do(request_key(get_llm().model_name, plan.full_contents), run)
+
+async def _call_async(plan: _RequestPlan, user_id, coalesce: bool) -> str:
+    run = lambda: get_limiter().arun(user_id, lambda: _generate_async(plan))
+    if not coalesce:
+        return await run()
+    return await get_single_flight().ado(request_key(get_llm().model_name, plan.full_contents), run)
+
+def ask_gemini(previous_messages: List[MessageDict], prompt: str, use_cache: bool = True, highlight: Optional[str] = None, summary: Optional[str] = None, inherited: int = 0, user_id=None):
     """
     Call Gemini API to get a response to `prompt` with context `previous_messages`
+
+    Overload errors (`LLMBusyError`, or a 429/503 that outlasted the retries) are raised
+    so the caller can ask the client to retry; other failures are returned as text.
     
     :param previous_messages: Message class is {"role": either "user" or "model", "content": "..."}
     :type previous_messages: List[Message]
     :param prompt: The current prompt to ask LLM
     :type prompt: str
+    :param use_cache: Set to False to bypass the response cache (e.g. "regenerate")
+    :type use_cache: bool
+    :param highlight: Text span the chat was branched from, sent alongside the prompt
+    :type highlight: Optional[str]
+    :param summary: Running summary of the conversation before `previous_messages`
+    :type summary: Optional[str]
+    :param inherited: Number of leading `previous_messages` inherited from ancestor chats
+    :type inherited: int
+    :param user_id: Requesting user; the limiter queues callers fairly per user
     """
-    # Industry Standard: Trim history to 10 messages to maintain focus and stay within limits
-    context = previous_messages[-10:] if len(previous_messages) > 10 else previous_messages
+    plan = _plan_request(previous_messages, prompt, highlight, summary, inherited)
+    cache = response_cache if use_cache else None
+
+    if cache:
+        cached = cache.get(plan.full_contents)
+        if cached is not None:
+            return cached
+
+    _report_usage(plan)
+    try:
+        # A forced regenerate must not be answered with someone else's in-flight result
+        text = _call(plan, user_id, coalesce=use_cache)
+    except Exception as e:
+        if is_overloaded(e):
+            raise
+        return f"AI Service Error: {str(e)}"
+
+    # Only successful answers are cached; errors should be retried for real
+    if cache:
+        cache.set(plan.full_contents, text)
+    return text
+
+async def ask_gemini_async(previous_messages: List[MessageDict], prompt: str, use_cache: bool = True, highlight: Optional[str] = None, summary: Optional[str] = None, inherited: int = 0, user_id=None):
+    """
+    Async variant of `ask_gemini` for ASGI views. Awaits `generate_content_async`,
+    so the event loop can keep serving other requests while Gemini is generating.
     
-    contents = []
-    for m in context:
-        contents.append({
-            "role": "user" if m["role"] == "user" else "model",
-            "parts": [{"text": m["content"]}]
-        })
-
-    # Add the final instruction
-    contents.append({
-        "role": "user", 
-        "parts": [{"text": f"Instruction: Answer in plain text (paragraphs): {prompt}"}]
-    })
+    :param previous_messages: Message class is {"role": either "user" or "model", "content": "..."}
+    :type previous_messages: List[Message]
+    :param prompt: The current prompt to ask LLM
+    :type prompt: str
+    :param use_cache: Set to False to bypass the response cache
+    :type use_cache: bool
+    :param highlight: Text span the chat was branched from, sent alongside the prompt
+    :type highlight: Optional[str]
+    :param summary: Running summary of the conversation before `previous_messages`
+    :type summary: Optional[str]
+    :param inherited: Number of leading `previous_messages` inherited from ancestor chats
+    :type inherited: int
+    :param user_id: Requesting user; the limiter queues callers fairly per user
+    """
+    # Creating a prefix cache and binding a model to it are blocking SDK calls (with retry
+    # sleeps): plan in a worker thread so the event loop keeps serving other requests
+    plan = await sync_to_async(_plan_request, thread_sensitive=False)(
+        previous_messages, prompt, highlight, summary, inherited
+    )
+    cache = response_cache if use_cache else None
+
+    if cache:
+        cached = await cache.aget(plan.full_contents)
+        if cached is not None:
+            return cached
 
+    _report_usage(plan)
     try:
-        response = model.generate_content(contents)
-        return response.text
+        text = await _call_async(plan, user_id, coalesce=use_cache)
     except Exception as e:
-        return f"AI Service Error: {str(e)}"
\ No newline at end of file
+        if is_overloaded(e):
+            raise
+        return f"AI Service Error: {str(e)}"
+
+    if cache:
+        await cache.aset(plan.full_contents, text)
+    return text
+
+def stream_gemini(previous_messages: List[MessageDict], prompt: str, use_cache: bool = True, highlight: Optional[str] = None, summary: Optional[str] = None, inherited: int = 0, user_id=None) -> Iterator[str]:
+    """
+    Streaming variant of `ask_gemini`: yields text chunks as Gemini produces them.
+    Unlike `ask_gemini`, provider errors (`LLMError`) are raised so the caller can report them mid-stream.
+    A cache hit is yielded as a single chunk; a fully streamed answer is cached.
+    A limiter slot is held for the whole stream; streams are never coalesced.
+    
+    :param previous_messages: Message class is {"role": either "user" or "model", "content": "..."}
+    :type previous_messages: List[Message]
+    :param prompt: The current prompt to ask LLM
+    :type prompt: str
+    :param use_cache: Set to False to bypass the response cache
+    :type use_cache: bool
+    :param highlight: Text span the chat was branched from, sent alongside the prompt
+    :type highlight: Optional[str]
+    :param summary: Running summary of the conversation before `previous_messages`
+    :type summary: Optional[str]
+    :param inherited: Number of leading `previous_messages` inherited from ancestor chats
+    :type inherited: int
+    :param user_id: Requesting user; the limiter queues callers fairly per user
+    """
+    plan = _plan_request(previous_messages, prompt, highlight, summary, inherited)
+    cache = response_cache if use_cache else None
+
+    if cache:
+        cached = cache.get(plan.full_contents)
+        if cached is not None:
+            yield cached
+            return
+
+    _report_usage(plan)
+    chunks = []
+    # Closing the generator (client disconnect) exits the slot as well
+    with get_limiter().slot(user_id):
+        try:
+            for text in plan.provider.stream(plan.contents):
+                chunks.append(text)
+                yield text
+        except Exception as e:
+            # Only a cached-prefix failure before any output can be retried transparently
+            if chunks or not _can_fall_back(plan, e):
+                raise
+            plan = _fallback(plan, e)
+            for text in plan.provider.stream(plan.contents):
+                chunks.append(text)
+                yield text
+
+    if cache:
+        cache.set(plan.full_contents, "".join(chunks))
+
+def summarize_conversation(previous_summary: Optional[str], messages: List[MessageDict], max_words: int = 250) -> str:
+    """
+    Folds `messages` into `previous_summary`, producing the chat's new running summary.
+    Errors are raised (not returned as text) so a failed run never overwrites a good summary.
+    
+    :param previous_summary: The current summary, or None for the first run
+    :type previous_summary: Optional[str]
+    :param messages: Messages not yet covered by the summary, in chronological order
+    :type messages: List[Message]
+    :param max_words: Upper bound for the summary, which keeps every later prompt bounded
+    :type max_words: int
+    """
+    transcript = "\n\n".join(f"{m['role'].upper()}: {m['content']}" for m in messages)
+    instruction = (
+        f"Update the running summary of this conversation with the new messages below. "
+        f"Keep facts, decisions, open questions and user preferences; drop pleasantries. "
+        f"Answer with the summary only, in at most {max_words} words.\n\n"
+        f"CURRENT SUMMARY:\n{previous_summary or '(none yet)'}\n\n"
+        f"NEW MESSAGES:\n{transcript}"
+    )
+    contents = [{"role": "user", "parts": [{"text": instruction}]}]
+    return get_limiter().run(BACKGROUND, lambda: get_llm().generate(contents)).strip()
\ No newline at end of file
@@ -0,0 +1,89 @@
+import asyncio
+
+from django.conf import settings
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+# Sized independently of the sync workers: a single ASGI process holds many
+# in-flight requests, but each one only borrows a connection for a few milliseconds.
+POOL_MIN_SIZE = getattr(settings, 'ASYNC_DB_POOL_MIN_SIZE', 1)
+POOL_MAX_SIZE = getattr(settings, 'ASYNC_DB_POOL_MAX_SIZE', 10)
+
+_pool = None
+_pool_lock = None
+
+
+def conninfo(direct=False):
+    """
+    Builds a libpq connection string from the 'default' entry of DATABASES,
+    so the async path talks to the same database as the sync viewsets.
+    With `direct`, host and port come from settings.DATABASE_DIRECT, bypassing
+    a transaction-mode PgBouncer for connections that need session state.
+    """
+    db = settings.DATABASES['default']
+    params = {
+        'dbname': db.get('NAME'),
+        'user': db.get('USER'),
+        'password': db.get('PASSWORD'),
+        'host': db.get('HOST'),
+        'port': db.get('PORT'),
+    }
+    if direct:
+        direct_db = getattr(settings, 'DATABASE_DIRECT', {})
+        params['host'] = direct_db.get('HOST') or params['host']
+        params['port'] = direct_db.get('PORT') or params['port']
+    return make_conninfo(**{k: v for k, v in params.items() if v})
+
+
+def connection_kwargs():
+    """
+    Connection options shared with the sync backend, e.g. prepare_threshold=None behind PgBouncer.
+    """
+    options = settings.DATABASES['default'].get('OPTIONS', {})
+    return {k: options[k] for k in ('prepare_threshold',) if k in options}
+
+
+async def get_pool():
+    """
+    Returns the process-wide async connection pool, opening it on first use.
+    """
+    global _pool, _pool_lock
+
+    if _pool is not None:
+        return _pool
+
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+
+    async with _pool_lock:
+        if _pool is None:
+            pool = AsyncConnectionPool(
+                conninfo(), min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                kwargs=connection_kwargs(), open=False
+            )
+            await pool.open()
+            _pool = pool
+    return _pool
+
+
+async def fetch_all(query, params):
+    """
+    Runs a read query on a pooled connection and returns the rows as dicts.
+    """
+    pool = await get_pool()
+    async with pool.connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute(query, params)
+            return await cursor.fetchall()
+
+
+async def fetch_one(query, params):
+    """
+    Runs a query on a pooled connection and returns the first row (or None).
+    """
+    pool = await get_pool()
+    async with pool.connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(query, params)
+            return await cursor.fetchone()
@@ -0,0 +1,266 @@
+"""
+ASGI-native counterparts of the hot canvas endpoints.
+
+DRF viewsets are synchronous, so under ASGI every request still occupies a worker
+thread while Gemini generates. These plain Django async views await both the
+database (psycopg async pool) and the model (`generate_content_async`), letting a
+single process keep hundreds of LLM calls in flight. They speak the same JSON
+contract as `ChatViewSet.list` and `MessageViewSet.list/create`.
+"""
+
+import json
+
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions
+
+from accounts.authentication import RawSQLJWTAuthentication
+from accounts.revocation import revocations
+from services.limiter import is_overloaded, retry_after
+from workspaces.permissions import ownership
+from .ai_services import ask_gemini_async
+from .async_db import get_pool, fetch_all, fetch_one
+from .context import load_context_async
+from .persistence import (
+    APPEND_MESSAGE_SQL, DELETE_MESSAGE_SQL, FILL_REPLY_SQL, LOCK_CHAT_WORKSPACE_SQL, RELEASE_REPLY_SQL,
+    RESERVE_REPLY_SQL, message_delta, notify_sql
+)
+from .summaries import schedule_summary
+from .pagination import CursorError, MAX_PAGE_SIZE, parse_cursor, page_query, build_page
+from .sync import (
+    CHANGED_MESSAGES_QUERY, CHAT_VERSION_QUERY, VERSION_QUERY, SinceError, cap_message_delta, delta_payload,
+    parse_since, since_clause, tombstones_query
+)
+
+_authenticator = RawSQLJWTAuthentication(refresh_revocations=False)
+
+
+async def _authenticate(request):
+    """
+    Resolves the JWT bearer token into the same lightweight user the viewsets see.
+    Returns None when the request is anonymous or the token is invalid or revoked.
+    """
+    await revocations.arefresh_if_stale()
+    try:
+        result = _authenticator.authenticate(request)
+    except exceptions.AuthenticationFailed:
+        return None
+    if not result:
+        return None
+    # Lets ReadYourWritesMiddleware see who wrote
+    request.user = result[0]
+    return result[0]
+
+
+def _unauthorized():
+    return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+
+
+async def _check_chat_ownership(user_id, chat_id):
+    """
+    Security Utility: Ensures the chat belongs to the authenticated user.
+    Answered from the ownership cache when possible (see `workspaces.permissions`).
+    """
+    return await ownership.achat_workspace(user_id, chat_id) is not None
+
+
+async def chat_list(request):
+    """
+    GET /canvas/async/chats/?workspace_id={uuid}&since={version}
+    Async equivalent of `ChatViewSet.list`.
+    """
+    user = await _authenticate(request)
+    if user is None:
+        return _unauthorized()
+    if request.method != 'GET':
+        return JsonResponse({"detail": f'Method "{request.method}" not allowed.'}, status=405)
+
+    workspace_id = request.GET.get('workspace_id')
+    if not workspace_id:
+        return JsonResponse({"error": "workspace_id is required"}, status=400)
+
+    try:
+        since = parse_since(request.GET)
+    except SinceError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    row = await fetch_one(VERSION_QUERY, [workspace_id, user.id])
+    if row is None:
+        return JsonResponse({"error": "Forbidden: Workspace access denied"}, status=403)
+
+    changed, changed_params = since_clause('chats', since)
+    query = f"""
+        SELECT id, title, x_pos, y_pos, width, height, z_index, created_at
+        FROM chats
+        WHERE workspace_id = %s {changed}
+        ORDER BY created_at ASC
+    """
+    data = await fetch_all(query, [workspace_id, *changed_params])
+    deleted = []
+    if since is not None:
+        deleted = [r["object_id"] for r in await fetch_all(*tombstones_query(workspace_id, 'chats', since))]
+    return JsonResponse(delta_payload(data, row[0], since, deleted))
+
+
+@csrf_exempt
+async def messages(request):
+    """
+    GET  /canvas/async/messages/?chat_id={uuid}[&since={version}]  -> async `MessageViewSet.list`
+    POST /canvas/async/messages/                                   -> async `MessageViewSet.create`
+    """
+    user = await _authenticate(request)
+    if user is None:
+        return _unauthorized()
+
+    if request.method == 'GET':
+        return await _message_list(request, user)
+    if request.method == 'POST':
+        return await _message_create(request, user)
+    return JsonResponse({"detail": f'Method "{request.method}" not allowed.'}, status=405)
+
+
+async def _message_list(request, user):
+    chat_id = request.GET.get('chat_id')
+
+    if not chat_id or not await _check_chat_ownership(user.id, chat_id):
+        return JsonResponse({"error": "Unauthorized or missing chat_id"}, status=403)
+
+    try:
+        since = parse_since(request.GET)
+    except SinceError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    if since is not None:
+        return await _message_list_since(chat_id, user.id, since)
+
+    try:
+        direction, cursor_value, limit = parse_cursor(request.GET)
+    except CursorError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    query, params = page_query(chat_id, direction, cursor_value, limit)
+    return JsonResponse(build_page(await fetch_all(query, params), direction, limit))
+
+
+async def _message_list_since(chat_id, user_id, since):
+    """
+    Async equivalent of `MessageViewSet._list_since`.
+    """
+    row = await fetch_one(CHAT_VERSION_QUERY, [chat_id, user_id])
+    # The ownership check may be answered from the cache: the chat can be gone
+    if row is None:
+        return JsonResponse({"error": "Unauthorized or missing chat_id"}, status=403)
+    workspace_id, version = row
+
+    rows = await fetch_all(CHANGED_MESSAGES_QUERY, [chat_id, since, MAX_PAGE_SIZE + 1])
+    rows, version, has_more = cap_message_delta(rows, version)
+    deleted = await fetch_all(*tombstones_query(workspace_id, 'messages', since, chat_id, upto=version))
+
+    payload = delta_payload(rows, version, since, [r["object_id"] for r in deleted])
+    payload["has_more"] = has_more
+    return JsonResponse(payload)
+
+
+async def _append_message(cursor, chat_id, role, content):
+    """
+    Inserts a message at the end of the chat; see `canvas.persistence.append_message`.
+    Must run inside a transaction so the workspace row lock covers the INSERT.
+    """
+    await cursor.execute(LOCK_CHAT_WORKSPACE_SQL, [chat_id])
+    chat = await cursor.fetchone()
+    await cursor.execute(APPEND_MESSAGE_SQL, [chat_id, role, content, chat_id])
+    row = await cursor.fetchone()
+    if chat:
+        await cursor.execute(*notify_sql(chat[0], "message.created", message_delta(chat_id, role, content, row)))
+    return row
+
+
+async def _fill_reply(cursor, chat_id, reply_id, content):
+    """
+    Writes the reply into its reserved slot; see `canvas.persistence.fill_reply`.
+    """
+    await cursor.execute(LOCK_CHAT_WORKSPACE_SQL, [chat_id])
+    chat = await cursor.fetchone()
+    await cursor.execute(FILL_REPLY_SQL, [content, reply_id])
+    row = await cursor.fetchone()
+    if row is None:
+        return await _append_message(cursor, chat_id, 'model', content)
+    if chat:
+        await cursor.execute(*notify_sql(chat[0], "message.created", message_delta(chat_id, 'model', content, row)))
+    return row
+
+
+async def _message_create(request, user):
+    try:
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        return JsonResponse({"error": "Invalid JSON body"}, status=400)
+
+    chat_id = data.get('chat_id')
+    content = data.get('content')
+    use_cache = data.get('use_cache', True) is not False
+
+    if not chat_id or not content:
+        return JsonResponse({"error": "chat_id and content are required"}, status=400)
+
+    if not await _check_chat_ownership(user.id, chat_id):
+        return JsonResponse({"error": "Access denied"}, status=403)
+
+    try:
+        pool = await get_pool()
+
+        # 1. Save the prompt, reserve the reply's slot right after it and read the context
+        #    window; the connection goes back to the pool before the model call.
+        async with pool.connection() as conn:
+            async with conn.transaction():
+                async with conn.cursor() as cursor:
+                    prompt = await _append_message(cursor, chat_id, 'user', content)
+                    await cursor.execute(RESERVE_REPLY_SQL, [chat_id, prompt[1] + 1])
+                    reply_id = (await cursor.fetchone())[0]
+                    context = await load_context_async(cursor, chat_id)
+        user_msg_id = prompt[0]
+
+        # 2. Await Gemini without holding a thread or a connection
+        try:
+            ai_content = await ask_gemini_async(
+                context.history, content, use_cache=use_cache,
+                highlight=context.highlight, summary=context.summary,
+                inherited=context.inherited, user_id=user.id
+            )
+        except Exception as e:
+            if not is_overloaded(e):
+                raise
+            # Nothing was answered: drop the prompt so the client's retry doesn't post it twice
+            async with pool.connection() as conn:
+                async with conn.transaction():
+                    async with conn.cursor() as cursor:
+                        await cursor.execute(RELEASE_REPLY_SQL, [reply_id])
+                        await cursor.execute(DELETE_MESSAGE_SQL, [user_msg_id])
+                        deleted = await cursor.fetchone()
+                        if deleted:
+                            await cursor.execute(*notify_sql(
+                                deleted[0], "message.deleted", {"id": user_msg_id, "chat_id": deleted[1]}
+                            ))
+            response = JsonResponse({"error": str(e), "retryable": True}, status=503)
+            response["Retry-After"] = str(retry_after(e))
+            return response
+
+        # 3. Save and Return Gemini Response in the reserved slot
+        async with pool.connection() as conn:
+            async with conn.transaction():
+                async with conn.cursor() as cursor:
+                    row = await _fill_reply(cursor, chat_id, reply_id, ai_content)
+
+        schedule_summary(chat_id, context.summary_through, row[1])
+
+        return JsonResponse({
+            "user_message_id": user_msg_id,
+            "model_message": {
+                "id": row[0],
+                "role": "model",
+                "content": ai_content,
+                "created_at": row[2]
+            }
+        }, status=201)
+
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=500)
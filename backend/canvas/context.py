@@ -0,0 +1,219 @@
+"""
+Context resolution for the LLM.
+
+A branched chat does not store copies of its parent's messages. Instead, its
+history is assembled at prompt time by following `message_links` upwards: the
+chat's own messages come first, then the parent's messages up to and including
+the branch's source message, then the grandparent's, and so on.
+
+Long chats carry a running summary (see `canvas.summaries`); only the messages
+after it are loaded. `build_contents` then fits summary and history into a
+token budget instead of a fixed number of turns.
+"""
+
+from typing import List, NamedTuple, Optional
+
+from django.conf import settings
+
+# How many of each ancestor's messages (ending at the branch point) a branch inherits
+BRANCH_CONTEXT_DEPTH = getattr(settings, 'CANVAS_BRANCH_CONTEXT_DEPTH', 10)
+
+# Candidate turns loaded from the database; the token budget decides how many are sent
+CONTEXT_MAX_MESSAGES = getattr(settings, 'CANVAS_CONTEXT_MAX_MESSAGES', 50)
+# Approximate input tokens per request, including the instruction turn
+CONTEXT_TOKEN_BUDGET = getattr(settings, 'CANVAS_CONTEXT_TOKEN_BUDGET', 8000)
+# A single older turn is cut down to this size so one long answer can't crowd out the rest
+MAX_TURN_TOKENS = getattr(settings, 'CANVAS_CONTEXT_MAX_TURN_TOKENS', 2000)
+# Send the highlighted span a branch was created from along with the instruction
+INCLUDE_HIGHLIGHT = getattr(settings, 'CANVAS_CONTEXT_INCLUDE_HIGHLIGHT', True)
+
+TRUNCATION_MARKER = " [...]"
+# Don't bother sending a turn cut down below this many tokens
+MIN_TRUNCATED_TOKENS = 32
+
+# Guard against runaway recursion if links ever form a cycle
+MAX_LINEAGE_DEPTH = 50
+
+class ChatContext(NamedTuple):
+    history: List[dict]
+    highlight: Optional[str]
+    summary: Optional[str]
+    summary_through: Optional[int]
+    # Number of leading `history` entries inherited from ancestor chats
+    inherited: int
+
+
+# Per-chat inputs: the running summary (see `canvas.summaries`) and the highlighted
+# span of the source message the chat was branched from (if any)
+CHAT_META_QUERY = """
+    SELECT c.summary, c.summary_through,
+           (SELECT substring(m.content FROM ml.start_offset + 1 FOR ml.end_offset - ml.start_offset)
+            FROM message_links ml
+            JOIN messages m ON m.id = ml.source_message_id
+            WHERE ml.to_chat_id = c.id
+            LIMIT 1)
+    FROM chats c
+    WHERE c.id = %s
+"""
+
+# Messages already folded into the chat's summary (order_index <= floor) are skipped,
+# and so is the ancestor context, which the first summary already absorbed. Hidden
+# messages are reply slots still waiting for their answer (see `canvas.persistence`).
+HISTORY_QUERY = """
+    WITH RECURSIVE lineage (chat_id, cutoff, floor, depth) AS (
+        SELECT %s::uuid, %s::int, %s::int, 0
+      UNION ALL
+        SELECT src.chat_id, src.order_index, NULL::int, l.depth + 1
+        FROM lineage l
+        JOIN message_links ml ON ml.to_chat_id = l.chat_id
+        JOIN messages src ON src.id = ml.source_message_id
+        WHERE l.depth < %s AND l.floor IS NULL
+    )
+    SELECT h.role, h.content, l.depth
+    FROM lineage l
+    CROSS JOIN LATERAL (
+        SELECT role, content, order_index
+        FROM messages m
+        WHERE m.chat_id = l.chat_id
+          AND (l.cutoff IS NULL OR m.order_index <= l.cutoff)
+          AND (l.floor IS NULL OR m.order_index > l.floor)
+          AND m.is_hidden = FALSE
+        ORDER BY m.order_index DESC
+        LIMIT CASE WHEN l.depth = 0 THEN %s ELSE %s END
+    ) h
+    ORDER BY l.depth ASC, h.order_index DESC
+    LIMIT %s
+"""
+
+
+def _history_params(chat_id, summary_through, limit, upto=None):
+    return [chat_id, upto, summary_through, MAX_LINEAGE_DEPTH, limit, min(limit, BRANCH_CONTEXT_DEPTH), limit]
+
+
+def _to_history(rows):
+    # Rows arrive newest first; Gemini wants chronological order
+    return [{"role": r, "content": c} for r, c, _ in reversed(rows)]
+
+
+def _to_context(meta, rows):
+    summary, summary_through, highlight = meta if meta else (None, None, None)
+    return ChatContext(
+        history=_to_history(rows),
+        highlight=highlight if INCLUDE_HIGHLIGHT else None,
+        summary=summary,
+        summary_through=summary_through,
+        inherited=sum(1 for row in rows if row[2] > 0)
+    )
+
+
+def load_context(cursor, chat_id, limit=CONTEXT_MAX_MESSAGES, upto=None):
+    """
+    Returns the ChatContext for the chat: the last `limit` messages not yet covered
+    by its running summary (including inherited ancestor context) as
+    [{"role": ..., "content": ...}] in chronological order, the summary itself and
+    the highlighted text the chat was branched from (None for root chats).
+    With `upto`, the chat's own messages stop at that order_index (the prompt being
+    answered), so prompts saved after it are not part of its context.
+    """
+    cursor.execute(CHAT_META_QUERY, [chat_id])
+    meta = cursor.fetchone()
+    summary_through = meta[1] if meta else None
+
+    cursor.execute(HISTORY_QUERY, _history_params(chat_id, summary_through, limit, upto))
+    return _to_context(meta, cursor.fetchall())
+
+
+def load_inherited(cursor, chat_id):
+    """
+    Returns only the context the chat inherits from its ancestors (up to
+    BRANCH_CONTEXT_DEPTH messages each), in chronological order.
+    """
+    cursor.execute(
+        HISTORY_QUERY,
+        [chat_id, None, None, MAX_LINEAGE_DEPTH, 0, BRANCH_CONTEXT_DEPTH, MAX_LINEAGE_DEPTH * BRANCH_CONTEXT_DEPTH]
+    )
+    return _to_history(cursor.fetchall())
+
+
+async def load_context_async(cursor, chat_id, limit=CONTEXT_MAX_MESSAGES):
+    """
+    `load_context` for a psycopg async cursor.
+    """
+    await cursor.execute(CHAT_META_QUERY, [chat_id])
+    meta = await cursor.fetchone()
+    summary_through = meta[1] if meta else None
+
+    await cursor.execute(HISTORY_QUERY, _history_params(chat_id, summary_through, limit))
+    return _to_context(meta, await cursor.fetchall())
+
+
+def estimate_tokens(text):
+    """
+    Local token estimate (~4 characters per token for Gemini on English text).
+    Cheap enough to run on every turn without a tokenizer round trip.
+    """
+    return (len(text) + 3) // 4
+
+
+def _truncate(text, max_tokens):
+    max_chars = max(0, max_tokens * 4 - len(TRUNCATION_MARKER))
+    return text if len(text) <= max_chars else text[:max_chars] + TRUNCATION_MARKER
+
+
+def to_contents(messages):
+    """
+    Converts messages to Gemini turns verbatim (no budget applied).
+    """
+    return [
+        {"role": "user" if m["role"] == "user" else "model", "parts": [{"text": m["content"]}]}
+        for m in messages
+    ]
+
+
+def build_contents(history, prompt, highlight=None, summary=None, budget=CONTEXT_TOKEN_BUDGET):
+    """
+    Converts stored chat history plus the current prompt into Gemini's `contents`
+    payload, newest turns first until `budget` is spent.
+
+    - The just-saved prompt at the end of `history` is dropped, since it is sent
+      again as the instruction turn.
+    - Older turns longer than MAX_TURN_TOKENS are truncated; the oldest turn that
+      would overflow the budget is truncated to fit and everything before it is dropped.
+    - `highlight` (the branched-from span) is placed right before the instruction.
+    - `summary` (the chat's running summary) opens the conversation; it is always
+      sent, so its size is bounded when it is generated.
+
+    Returns (contents, estimated_tokens).
+    """
+    if history and history[-1]["role"] == "user" and history[-1]["content"] == prompt:
+        history = history[:-1]
+
+    instruction = f"Instruction: Answer in plain text (paragraphs): {prompt}"
+    if highlight:
+        instruction = f'Highlighted passage this conversation branched from: "{highlight}"\n\n{instruction}'
+
+    preamble = f"Summary of the earlier conversation: {summary}" if summary else None
+
+    used = estimate_tokens(instruction) + (estimate_tokens(preamble) if preamble else 0)
+    selected = []
+    for m in reversed(history):
+        allowed = min(MAX_TURN_TOKENS, budget - used)
+        if estimate_tokens(m["content"]) > allowed and allowed < MIN_TRUNCATED_TOKENS:
+            break
+        text = _truncate(m["content"], allowed)
+        used += estimate_tokens(text)
+        selected.append({
+            "role": "user" if m["role"] == "user" else "model",
+            "parts": [{"text": text}]
+        })
+
+    contents = list(reversed(selected))
+    if preamble:
+        contents.insert(0, {"role": "user", "parts": [{"text": preamble}]})
+
+    # Add the final instruction
+    contents.append({
+        "role": "user",
+        "parts": [{"text": instruction}]
+    })
+    return contents, used
@@ -0,0 +1,301 @@
+"""
+Postgres-backed queue for AI generation.
+
+In async mode, `POST /canvas/messages/` saves the prompt and a `generation_jobs`
+row in one transaction and returns 202 right away. Workers
+(`manage.py run_generation_worker`) claim jobs with `FOR UPDATE SKIP LOCKED`,
+so any number of them poll the table without blocking each other. The model is
+called with no transaction open, and the reply is saved with the job's status.
+
+A claimed job holds a lease (`locked_until`). If its worker dies, another one
+claims the job once the lease has expired, up to MAX_ATTEMPTS. Jobs of the same
+chat are not run concurrently.
+
+The reply's slot is reserved right after the prompt when the job is queued (see
+`canvas.persistence.append_exchange`), and a job's context ends at its own
+prompt. So when several prompts of a chat are queued, each is answered as if it
+were the last one sent, and its reply is stored next to it.
+"""
+
+import logging
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from services.limiter import is_overloaded, retry_after
+from services.routing import mark_write
+from .ai_services import ask_gemini
+from .context import load_context
+from .persistence import fill_reply, release_reply
+from .summaries import schedule_summary
+
+logger = logging.getLogger(__name__)
+
+_config = getattr(settings, 'CANVAS_JOBS', {})
+# Seconds a worker may hold a job before it is considered dead
+LEASE_SECONDS = _config.get('LEASE_SECONDS', 300)
+MAX_ATTEMPTS = _config.get('MAX_ATTEMPTS', 3)
+POLL_INTERVAL = _config.get('POLL_INTERVAL', 1.0)
+# Finished jobs (and their idempotency keys) are kept this long
+RETENTION_DAYS = _config.get('RETENTION_DAYS', 7)
+# Length of generation_jobs.idempotency_key
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+
+class Job(NamedTuple):
+    id: str
+    user_id: str
+    chat_id: str
+    prompt_message_id: Optional[str]
+    use_cache: bool
+    attempts: int
+    # The reply's reserved slot (see `enqueue_job`)
+    reply_message_id: Optional[str]
+
+
+JOB_QUERY = """
+    SELECT j.id, j.chat_id, j.status, j.attempts, j.error, j.created_at, j.finished_at,
+           j.prompt_message_id, m.id, m.content, m.created_at
+    FROM generation_jobs j
+    LEFT JOIN messages m ON m.id = j.reply_message_id AND m.is_hidden = FALSE
+    WHERE j.user_id = %s AND {condition}
+"""
+
+# Oldest runnable job, locked so that other workers skip it. The running-job check here
+# only narrows the choice: its snapshot may predate another worker's claim (see `claim_job`).
+CANDIDATE_QUERY = """
+    SELECT q.id, q.chat_id
+    FROM generation_jobs q
+    WHERE q.status IN ('queued', 'running')
+      AND q.run_after <= now()
+      AND (q.status = 'queued' OR q.locked_until < now())
+      AND q.attempts < %s
+      AND NOT EXISTS (
+          SELECT 1 FROM generation_jobs r
+          WHERE r.chat_id = q.chat_id AND r.id <> q.id
+            AND r.status = 'running' AND r.locked_until >= now()
+      )
+    ORDER BY q.run_after
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+"""
+
+# Serializes claims per chat until commit; the first key keeps these locks apart from other users
+CHAT_LOCK_QUERY = "SELECT pg_try_advisory_xact_lock(%s, hashtext(%s::text))"
+CHAT_LOCK_NAMESPACE = 1001
+
+RUNNING_QUERY = """
+    SELECT 1 FROM generation_jobs
+    WHERE chat_id = %s AND id <> %s AND status = 'running' AND locked_until >= now()
+"""
+
+CLAIM_QUERY = """
+    UPDATE generation_jobs
+    SET status = 'running', attempts = attempts + 1,
+        locked_until = now() + make_interval(secs => %s)
+    WHERE id = %s
+    RETURNING id, user_id, chat_id, prompt_message_id, use_cache, attempts, reply_message_id
+"""
+
+# Candidates given up in a row (another worker is claiming in the same chat) before reporting none
+CLAIM_ATTEMPTS = 5
+
+
+def _to_job(row):
+    (job_id, chat_id, job_status, attempts, error, created_at, finished_at,
+     prompt_id, reply_id, reply_content, reply_created_at) = row
+    return {
+        "job_id": job_id,
+        "chat_id": chat_id,
+        "status": job_status,
+        "attempts": attempts,
+        "error": error,
+        "user_message_id": prompt_id,
+        "model_message": {
+            "id": reply_id,
+            "role": "model",
+            "content": reply_content,
+            "created_at": reply_created_at
+        } if reply_id else None,
+        "created_at": created_at,
+        "finished_at": finished_at
+    }
+
+
+def get_job(cursor, user_id, job_id):
+    """
+    Returns the user's job as a response payload, or None.
+    """
+    cursor.execute(JOB_QUERY.format(condition="j.id = %s"), [user_id, job_id])
+    row = cursor.fetchone()
+    return _to_job(row) if row else None
+
+
+def find_job(cursor, user_id, idempotency_key):
+    """
+    Returns the user's job created with `idempotency_key`, or None.
+    """
+    cursor.execute(JOB_QUERY.format(condition="j.idempotency_key = %s"), [user_id, idempotency_key])
+    row = cursor.fetchone()
+    return _to_job(row) if row else None
+
+
+def enqueue_job(cursor, user_id, chat_id, prompt_message_id, reply_message_id, use_cache=True,
+                idempotency_key=None):
+    """
+    Queues generation of the reply to `prompt_message_id` into the slot `reply_message_id`.
+    Meant to run in the same transaction that saved both (`append_exchange`).
+    A duplicate `idempotency_key` raises IntegrityError.
+    """
+    cursor.execute(
+        """
+        INSERT INTO generation_jobs (user_id, chat_id, prompt_message_id, reply_message_id, use_cache, idempotency_key)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        RETURNING id
+        """,
+        [user_id, chat_id, prompt_message_id, reply_message_id, use_cache, idempotency_key]
+    )
+    return get_job(cursor, user_id, cursor.fetchone()[0])
+
+
+def claim_job() -> Optional[Job]:
+    """
+    Leases the oldest runnable job to this worker. Returns None when the queue is empty.
+
+    Each claim is a short transaction: lock a candidate job, take the chat's advisory
+    lock, then check for a running job of the same chat in a statement started after
+    the lock was granted. Any claim in that chat committed before then is visible to
+    the check, and any later one waits for this transaction, so a chat never has two
+    running jobs.
+    """
+    for _ in range(CLAIM_ATTEMPTS):
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(CANDIDATE_QUERY, [MAX_ATTEMPTS])
+                candidate = cursor.fetchone()
+                if candidate is None:
+                    return None
+                job_id, chat_id = candidate
+
+                cursor.execute(CHAT_LOCK_QUERY, [CHAT_LOCK_NAMESPACE, chat_id])
+                if not cursor.fetchone()[0]:
+                    continue
+                cursor.execute(RUNNING_QUERY, [chat_id, job_id])
+                if cursor.fetchone():
+                    continue
+
+                cursor.execute(CLAIM_QUERY, [LEASE_SECONDS, job_id])
+                return Job(*cursor.fetchone())
+    return None
+
+
+def _requeue(job, delay):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE generation_jobs
+            SET status = 'queued', locked_until = NULL, run_after = now() + make_interval(secs => %s)
+            WHERE id = %s AND status = 'running' AND attempts = %s
+            """,
+            [delay, job.id, job.attempts]
+        )
+
+
+def fail_job(job, error):
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE generation_jobs
+                SET status = 'failed', error = %s, locked_until = NULL, finished_at = now()
+                WHERE id = %s AND status = 'running' AND attempts = %s
+                """,
+                [error, job.id, job.attempts]
+            )
+            # No answer is coming: free the reply's slot
+            if cursor.rowcount == 1:
+                release_reply(cursor, job.reply_message_id)
+
+
+def run_job(job: Job):
+    """
+    Generates and saves the reply for a claimed job.
+    """
+    # 1. Read (short): the prompt and the chat's context window up to it
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT content, order_index FROM messages WHERE id = %s", [job.prompt_message_id])
+        prompt = cursor.fetchone()
+        if prompt is None:
+            fail_job(job, "Prompt no longer exists")
+            return
+        context = load_context(cursor, job.chat_id, upto=prompt[1])
+
+    # 2. Call the model without holding a connection (unless an outer transaction needs it)
+    if not connection.in_atomic_block:
+        connection.close()
+    try:
+        ai_content = ask_gemini(
+            context.history, prompt[0], use_cache=job.use_cache,
+            highlight=context.highlight, summary=context.summary,
+            inherited=context.inherited, user_id=job.user_id
+        )
+    except Exception as e:
+        if is_overloaded(e) and job.attempts < MAX_ATTEMPTS:
+            _requeue(job, retry_after(e))
+        else:
+            fail_job(job, str(e))
+        return
+
+    # 3. Write (short): only if this worker still owns the job, so a reclaimed job never answers twice
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE generation_jobs
+                SET status = 'succeeded', error = NULL, locked_until = NULL, finished_at = now()
+                WHERE id = %s AND status = 'running' AND attempts = %s
+                """,
+                [job.id, job.attempts]
+            )
+            if cursor.rowcount != 1:
+                logger.warning("Job %s was reclaimed by another worker; dropping this reply", job.id)
+                return
+            reply = fill_reply(cursor, job.chat_id, job.reply_message_id, ai_content)
+            cursor.execute(
+                "UPDATE generation_jobs SET reply_message_id = %s WHERE id = %s", [reply[0], job.id]
+            )
+
+    # The client fetches the reply once the job reports success
+    mark_write(job.user_id)
+    schedule_summary(job.chat_id, context.summary_through, reply[1])
+
+
+def sweep_jobs():
+    """
+    Fails jobs whose last lease expired without attempts left and deletes finished
+    jobs older than RETENTION_DAYS (releasing their idempotency keys).
+    Returns (failed, deleted).
+    """
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE generation_jobs
+                SET status = 'failed', error = 'Worker lease expired', locked_until = NULL, finished_at = now()
+                WHERE status = 'running' AND locked_until < now() AND attempts >= %s
+                RETURNING reply_message_id
+                """,
+                [MAX_ATTEMPTS]
+            )
+            slots = [row[0] for row in cursor.fetchall()]
+            for reply_id in slots:
+                release_reply(cursor, reply_id)
+            cursor.execute(
+                """
+                DELETE FROM generation_jobs
+                WHERE status IN ('succeeded', 'failed') AND finished_at < now() - make_interval(days => %s)
+                """,
+                [RETENTION_DAYS]
+            )
+            return len(slots), cursor.rowcount
@@ -0,0 +1,121 @@
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from accounts.revocation import revocations
+from services.limiter import get_limiter
+from services.llm import FakeProvider, get_llm
+from workspaces.permissions import ownership
+
+
+class Command(BaseCommand):
+    help = ("Load test: concurrent POST /canvas/messages/ requests through the WSGI handler "
+            "(sync DRF view, one worker thread per request) and through the ASGI handler "
+            "(async view). Needs LLM_PROVIDER=fake; LLM_FAKE_LATENCY sets the model time.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=100, help="Requests in flight at once")
+        parser.add_argument('--threads', type=int, default=8,
+                            help="WSGI worker threads (e.g. gunicorn --threads) in the simulated process")
+
+    def _setup(self, chats):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO users (email, password) VALUES ('benchmark-' || gen_random_uuid() || '@example.com', '!') "
+                "RETURNING id"
+            )
+            user_id = cursor.fetchone()[0]
+            cursor.execute("INSERT INTO workspaces (user_id, name) VALUES (%s, 'Benchmark') RETURNING id", [user_id])
+            workspace_id = cursor.fetchone()[0]
+            cursor.execute(
+                "INSERT INTO chats (workspace_id, title) SELECT %s, 'Benchmark' FROM generate_series(1, %s) "
+                "RETURNING id",
+                [workspace_id, chats]
+            )
+            chat_ids = [str(r[0]) for r in cursor.fetchall()]
+
+        refresh = RefreshToken()
+        refresh['user_id'] = str(user_id)
+        refresh['ver'] = revocations.version(user_id)
+        return user_id, chat_ids, {"Authorization": f"Bearer {refresh.access_token}"}
+
+    def _bodies(self, chat_ids, count):
+        # Distinct prompts with caching off, so every request reaches the model
+        return [
+            {"chat_id": chat_ids[i % len(chat_ids)], "content": f"Benchmark prompt {i}", "use_cache": False}
+            for i in range(count)
+        ]
+
+    def _report(self, label, results, elapsed):
+        latencies = sorted(t for status, t in results if status == 201)
+        failed = len(results) - len(latencies)
+        p99 = statistics.quantiles(latencies, n=100, method='inclusive')[98] if len(latencies) > 1 else float('nan')
+        self.stdout.write(
+            f"{label}: {len(latencies) / elapsed:.1f} req/s, {len(latencies)} ok, {failed} failed, "
+            f"p50 {statistics.median(latencies) if latencies else float('nan'):.2f}s, p99 {p99:.2f}s"
+        )
+
+    def _wsgi(self, headers, bodies, threads):
+        client = Client(headers=headers)
+
+        start = time.perf_counter()
+
+        def one(body):
+            # Latency counts from the burst, so it includes the wait for a free thread
+            response = client.post("/api/canvas/messages/", body, content_type="application/json")
+            connection.close()
+            return response.status_code, time.perf_counter() - start
+
+        # The process can only work on as many requests as it has threads; the rest queue
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = list(executor.map(one, bodies))
+        return results, time.perf_counter() - start
+
+    async def _asgi(self, headers, bodies, concurrency):
+        client = AsyncClient()
+        gate = asyncio.Semaphore(concurrency)
+
+        async def one(body):
+            async with gate:
+                start = time.perf_counter()
+                response = await client.post(
+                    "/api/canvas/async/messages/", body, content_type="application/json", headers=headers
+                )
+                return response.status_code, time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(one(body) for body in bodies))
+        return results, time.perf_counter() - start
+
+    def handle(self, *args, **options):
+        llm = get_llm()
+        if not isinstance(llm, FakeProvider):
+            raise CommandError("Run with LLM_PROVIDER=fake (and LLM_FAKE_LATENCY) so no API calls are made")
+
+        self.stdout.write(
+            f"Model latency {llm.latency:.2f}s, {options['requests']} requests, concurrency {options['concurrency']}, "
+            f"LLM limiter {get_limiter().max_concurrent} concurrent calls per process"
+        )
+        user_id, chat_ids, headers = self._setup(options['concurrency'])
+        try:
+            # The test clients send Host: testserver
+            with override_settings(ALLOWED_HOSTS=['testserver']):
+                results, elapsed = self._wsgi(headers, self._bodies(chat_ids, options['requests']), options['threads'])
+                self._report(f"WSGI ({options['threads']} threads)", results, elapsed)
+
+                results, elapsed = asyncio.run(
+                    self._asgi(headers, self._bodies(chat_ids, options['requests']), options['concurrency'])
+                )
+                self._report("ASGI (1 event loop)", results, elapsed)
+            self.stdout.write(f"Ownership cache: {ownership.stats()}")
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM users WHERE id = %s", [user_id])
@@ -0,0 +1,106 @@
+import asyncio
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from services.limiter import FairLimiter, LLMBusyError, SingleFlight
+from services.llm import LLMError
+
+
+class _SaturatingProvider:
+    """
+    Offline stand-in for a provider that answers 429 beyond `capacity` concurrent calls.
+    """
+
+    def __init__(self, capacity, latency):
+        self.capacity = capacity
+        self.latency = latency
+        self.active = 0
+        self.calls = 0
+
+    async def agenerate(self):
+        self.calls += 1
+        if self.active >= self.capacity:
+            raise LLMError("Rate limited", status=429)
+        self.active += 1
+        try:
+            await asyncio.sleep(self.latency)
+            return "answer"
+        finally:
+            self.active -= 1
+
+
+def _percentile(values, pct):
+    if not values:
+        return "n/a"
+    value = statistics.quantiles(values, n=100, method='inclusive')[pct - 1] if len(values) > 1 else values[0]
+    return f"{value:.2f}s"
+
+
+class Command(BaseCommand):
+    help = ("Load-tests services.limiter with a burst of concurrent async requests against a simulated "
+            "provider: unbounded calls vs. FairLimiter (failures, p50/p99 latency, fairness) and "
+            "SingleFlight coalescing of identical requests.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help="Requests in the burst")
+        parser.add_argument('--users', type=int, default=10, help="Distinct users sending them")
+        parser.add_argument('--heavy-share', type=float, default=0.8,
+                            help="Share of the burst sent by a single heavy user")
+        parser.add_argument('--capacity', type=int, default=8, help="Concurrent calls the provider accepts")
+        parser.add_argument('--latency', type=float, default=0.2, help="Seconds per provider call")
+        parser.add_argument('--max-wait', type=float, default=20.0, help="FairLimiter max wait")
+
+    def _users(self, options):
+        # The heavy user's requests come first, so the light users arrive behind a queue
+        heavy = int(options['requests'] * options['heavy_share'])
+        light = options['requests'] - heavy
+        return ["heavy"] * heavy + [f"user-{i % max(1, options['users'] - 1)}" for i in range(light)]
+
+    async def _burst(self, users, call):
+        async def one(user):
+            start = time.perf_counter()
+            try:
+                await call(user)
+                return user, time.perf_counter() - start, None
+            except LLMBusyError:
+                return user, None, "busy"
+            except LLMError:
+                return user, None, "429"
+
+        return await asyncio.gather(*(one(user) for user in users))
+
+    def _report(self, label, results, provider):
+        latencies = [t for _, t, _ in results if t is not None]
+        light = [t for user, t, _ in results if t is not None and user != "heavy"]
+        failed = {kind: sum(1 for *_, error in results if error == kind) for kind in ("429", "busy")}
+        self.stdout.write(
+            f"{label}: {len(latencies)}/{len(results)} succeeded, {failed['429']} provider 429s, "
+            f"{failed['busy']} rejected as busy, {provider.calls} provider calls; "
+            f"p50 {_percentile(latencies, 50)}, p99 {_percentile(latencies, 99)}, "
+            f"light users p99 {_percentile(light, 99)}"
+        )
+
+    async def _run(self, options):
+        users = self._users(options)
+
+        provider = _SaturatingProvider(options['capacity'], options['latency'])
+        self._report("Unbounded", await self._burst(users, lambda user: provider.agenerate()), provider)
+
+        provider = _SaturatingProvider(options['capacity'], options['latency'])
+        limiter = FairLimiter(max_concurrent=options['capacity'], max_wait=options['max_wait'])
+        results = await self._burst(users, lambda user: limiter.arun(user, provider.agenerate))
+        self._report("FairLimiter", results, provider)
+
+        provider = _SaturatingProvider(options['capacity'], options['latency'])
+        limiter = FairLimiter(max_concurrent=options['capacity'], max_wait=options['max_wait'])
+        flight = SingleFlight()
+        # Every request identical (e.g. the same prompt retried from many tabs)
+        results = await self._burst(
+            users, lambda user: flight.ado("same", lambda: limiter.arun(user, provider.agenerate))
+        )
+        self._report("FairLimiter + SingleFlight, identical requests", results, provider)
+
+    def handle(self, *args, **options):
+        asyncio.run(self._run(options))
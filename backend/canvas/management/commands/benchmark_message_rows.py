@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from services.db import Query, fetch_all
+
+# Shaped like a MessageViewSet.list page; generated so no data is needed
+ROWS_QUERY = Query("benchmark.messages", """
+    SELECT gen_random_uuid() AS id, 'model' AS role, repeat('x', %s) AS content,
+           i AS order_index, now() AS created_at
+    FROM generate_series(1, %s) i
+""")
+
+
+class Command(BaseCommand):
+    help = ("Compares the CPU spent per request on fetching and mapping a page of messages: "
+            "the former cursor.description/dict(zip()) pattern against services.db.fetch_all.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000)
+        parser.add_argument('--content-length', type=int, default=500)
+        parser.add_argument('--iterations', type=int, default=200)
+
+    def handle(self, *args, **options):
+        params = [options['content_length'], options['rows']]
+
+        def manual():
+            with connection.cursor() as cursor:
+                cursor.execute(ROWS_QUERY.sql, params)
+                columns = [col[0] for col in cursor.description]
+                return [dict(zip(columns, r)) for r in cursor.fetchall()]
+
+        def helper():
+            return fetch_all(ROWS_QUERY, params)
+
+        for label, fn in (("cursor + dict(zip())", manual), ("services.db.fetch_all", helper)):
+            fn()
+            start = time.process_time()
+            for _ in range(options['iterations']):
+                fn()
+            cpu_ms = (time.process_time() - start) / options['iterations'] * 1000
+            self.stdout.write(f"{label}: {cpu_ms:.2f} ms CPU per {options['rows']}-row request")
@@ -0,0 +1,55 @@
+import logging
+import signal
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from canvas.jobs import POLL_INTERVAL, claim_job, fail_job, run_job, sweep_jobs
+
+logger = logging.getLogger(__name__)
+
+# Seconds between lease/retention sweeps
+SWEEP_INTERVAL = 60
+
+
+class Command(BaseCommand):
+    help = "Processes queued AI generation jobs (see canvas/jobs.py). Run one or more per host."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Exit once the queue is empty")
+        parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL,
+                            help="Seconds to wait when the queue is empty")
+
+    def handle(self, *args, **options):
+        stopping = threading.Event()
+        # Finish the current job on SIGTERM/SIGINT instead of abandoning it until its lease expires
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *_: stopping.set())
+
+        processed = 0
+        last_sweep = 0.0
+        while not stopping.is_set():
+            if time.monotonic() - last_sweep > SWEEP_INTERVAL:
+                failed, deleted = sweep_jobs()
+                if failed or deleted:
+                    logger.info("Swept generation jobs: %d expired, %d deleted", failed, deleted)
+                last_sweep = time.monotonic()
+
+            job = claim_job()
+            if job is None:
+                if options['once']:
+                    break
+                stopping.wait(options['poll_interval'])
+                continue
+
+            try:
+                run_job(job)
+            except Exception as e:
+                logger.exception("Generation job %s failed", job.id)
+                fail_job(job, str(e))
+            processed += 1
+
+        connection.close()
+        self.stdout.write(f"Generation worker stopped after {processed} job(s)")
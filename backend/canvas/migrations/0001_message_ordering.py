@@ -0,0 +1,44 @@
+"""
+Brings `messages` in line with what the views expect before the indexes in
+0002 are built:
+
+- `is_hidden` is read and written by the canvas views but was missing from
+  database.sql.
+- `order_index` was allocated with an unlocked MAX() + 1, so concurrent prompts
+  could produce duplicates. Affected chats are renumbered (keeping their
+  relative order) so the UNIQUE (chat_id, order_index) constraint can be added.
+"""
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workspaces', '0001_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="ALTER TABLE messages ADD COLUMN IF NOT EXISTS is_hidden BOOLEAN NOT NULL DEFAULT FALSE",
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            sql="""
+                UPDATE messages m
+                SET order_index = r.new_index
+                FROM (
+                    SELECT id,
+                           ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY order_index, created_at, id) - 1 AS new_index
+                    FROM messages
+                    WHERE chat_id IN (
+                        SELECT chat_id FROM messages
+                        GROUP BY chat_id, order_index
+                        HAVING COUNT(*) > 1
+                    )
+                ) r
+                WHERE m.id = r.id AND m.order_index <> r.new_index
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
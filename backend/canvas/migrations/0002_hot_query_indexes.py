@@ -0,0 +1,59 @@
+"""
+Indexes for the hot canvas queries. Built CONCURRENTLY so large `messages`
+tables stay writable during the migration, which requires atomic = False.
+"""
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('canvas', '0001_message_ordering'),
+    ]
+
+    operations = [
+        # History reads (ORDER BY order_index DESC LIMIT n) and order_index allocation (MAX).
+        # UNIQUE doubles as the backstop against duplicate positions within a chat.
+        migrations.RunSQL(
+            sql="CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS messages_chat_id_order_index_uniq "
+                "ON messages (chat_id, order_index)",
+            reverse_sql="DROP INDEX CONCURRENTLY IF EXISTS messages_chat_id_order_index_uniq",
+        ),
+        migrations.RunSQL(
+            sql="ALTER TABLE messages ADD CONSTRAINT messages_chat_id_order_index_uniq "
+                "UNIQUE USING INDEX messages_chat_id_order_index_uniq",
+            reverse_sql="ALTER TABLE messages DROP CONSTRAINT messages_chat_id_order_index_uniq",
+        ),
+        # MessageViewSet.list: WHERE chat_id = %s AND is_hidden = FALSE ORDER BY order_index
+        migrations.RunSQL(
+            sql="CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_visible_chat_id_order_index_idx "
+                "ON messages (chat_id, order_index) WHERE is_hidden = FALSE",
+            reverse_sql="DROP INDEX CONCURRENTLY IF EXISTS messages_visible_chat_id_order_index_idx",
+        ),
+        # ChatViewSet.list: WHERE workspace_id = %s ORDER BY created_at
+        migrations.RunSQL(
+            sql="CREATE INDEX CONCURRENTLY IF NOT EXISTS chats_workspace_id_created_at_idx "
+                "ON chats (workspace_id, created_at)",
+            reverse_sql="DROP INDEX CONCURRENTLY IF EXISTS chats_workspace_id_created_at_idx",
+        ),
+        # LinkViewSet.list joins on from_chat_id; to_chat_id and source_message_id
+        # back the ON DELETE CASCADE lookups when chats or messages are removed.
+        migrations.RunSQL(
+            sql="CREATE INDEX CONCURRENTLY IF NOT EXISTS message_links_from_chat_id_idx "
+                "ON message_links (from_chat_id)",
+            reverse_sql="DROP INDEX CONCURRENTLY IF EXISTS message_links_from_chat_id_idx",
+        ),
+        migrations.RunSQL(
+            sql="CREATE INDEX CONCURRENTLY IF NOT EXISTS message_links_to_chat_id_idx "
+                "ON message_links (to_chat_id)",
+            reverse_sql="DROP INDEX CONCURRENTLY IF EXISTS message_links_to_chat_id_idx",
+        ),
+        migrations.RunSQL(
+            sql="CREATE INDEX CONCURRENTLY IF NOT EXISTS message_links_source_message_id_idx "
+                "ON message_links (source_message_id)",
+            reverse_sql="DROP INDEX CONCURRENTLY IF EXISTS message_links_source_message_id_idx",
+        ),
+    ]
@@ -0,0 +1,28 @@
+"""
+Branched chats used to receive physical, hidden copies of their parent's last
+messages. Context is now resolved through `message_links` at prompt time (see
+canvas/context.py), so those copies are dead weight and are deleted here.
+
+Only chats that still have an incoming link are collapsed: if the source message
+(and therefore the link) is gone, the hidden copies are the only context left.
+"""
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas', '0002_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+                DELETE FROM messages m
+                WHERE m.is_hidden = TRUE
+                  AND EXISTS (SELECT 1 FROM message_links ml WHERE ml.to_chat_id = m.chat_id)
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
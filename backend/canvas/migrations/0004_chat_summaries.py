@@ -0,0 +1,29 @@
+"""
+Running conversation summary per chat (see canvas/summaries.py).
+`summary_through` is the last order_index of the chat that the summary covers;
+NULL means the chat has not been summarized yet.
+"""
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas', '0003_collapse_branch_copies'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+                ALTER TABLE chats
+                    ADD COLUMN IF NOT EXISTS summary TEXT,
+                    ADD COLUMN IF NOT EXISTS summary_through INT
+            """,
+            reverse_sql="""
+                ALTER TABLE chats
+                    DROP COLUMN IF EXISTS summary,
+                    DROP COLUMN IF EXISTS summary_through
+            """,
+        ),
+    ]
@@ -0,0 +1,54 @@
+"""
+Queue table for asynchronous AI generation (see canvas/jobs.py).
+Idempotency keys are unique per user; the partial index on `run_after` keeps
+the workers' claim query on pending rows only.
+"""
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas', '0004_chat_summaries'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE IF NOT EXISTS generation_jobs (
+                    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+                    user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+                    chat_id UUID NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+                    prompt_message_id UUID REFERENCES messages(id) ON DELETE CASCADE,
+                    reply_message_id UUID REFERENCES messages(id) ON DELETE SET NULL,
+                    idempotency_key VARCHAR(255),
+                    use_cache BOOLEAN NOT NULL DEFAULT TRUE,
+                    status VARCHAR NOT NULL DEFAULT 'queued'
+                        CHECK (status IN ('queued', 'running', 'succeeded', 'failed')),
+                    attempts INT NOT NULL DEFAULT 0,
+                    error TEXT,
+                    run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    locked_until TIMESTAMPTZ,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    finished_at TIMESTAMPTZ
+                )
+            """,
+            reverse_sql="DROP TABLE IF EXISTS generation_jobs",
+        ),
+        migrations.RunSQL(
+            sql="CREATE UNIQUE INDEX IF NOT EXISTS generation_jobs_user_id_idempotency_key_uniq "
+                "ON generation_jobs (user_id, idempotency_key) WHERE idempotency_key IS NOT NULL",
+            reverse_sql="DROP INDEX IF EXISTS generation_jobs_user_id_idempotency_key_uniq",
+        ),
+        migrations.RunSQL(
+            sql="CREATE INDEX IF NOT EXISTS generation_jobs_pending_run_after_idx "
+                "ON generation_jobs (run_after) WHERE status IN ('queued', 'running')",
+            reverse_sql="DROP INDEX IF EXISTS generation_jobs_pending_run_after_idx",
+        ),
+        # Per-chat ordering check in the claim query and ON DELETE CASCADE from chats
+        migrations.RunSQL(
+            sql="CREATE INDEX IF NOT EXISTS generation_jobs_chat_id_idx ON generation_jobs (chat_id)",
+            reverse_sql="DROP INDEX IF EXISTS generation_jobs_chat_id_idx",
+        ),
+    ]
@@ -0,0 +1,144 @@
+"""
+Per-workspace change versions for delta sync (see canvas/sync.py).
+
+`workspaces.version` is a counter bumped by triggers on every insert/update of
+the workspace's chats, links and messages; the new value is stamped on the row
+as `revision`. Deletes bump it as well and leave a row in `canvas_tombstones`.
+The bump takes the workspace row lock until commit, so versions become visible
+in order and a client holding version N never misses a change <= N.
+
+Rows deleted only because their chat or workspace went away (cascades) get no
+tombstone of their own: the chat's tombstone, or the workspace's absence, covers them.
+The indexes are built CONCURRENTLY, which requires atomic = False.
+"""
+
+from django.db import migrations
+
+BUMP_FUNCTION = """
+    CREATE OR REPLACE FUNCTION canvas_bump_revision() RETURNS trigger AS $$
+    DECLARE
+        ws UUID;
+    BEGIN
+        IF TG_TABLE_NAME = 'chats' THEN
+            ws := NEW.workspace_id;
+        ELSIF TG_TABLE_NAME = 'messages' THEN
+            SELECT workspace_id INTO ws FROM chats WHERE id = NEW.chat_id;
+        ELSE
+            SELECT workspace_id INTO ws FROM chats WHERE id = NEW.from_chat_id;
+        END IF;
+
+        UPDATE workspaces SET version = version + 1 WHERE id = ws RETURNING version INTO NEW.revision;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+"""
+
+TOMBSTONE_FUNCTION = """
+    CREATE OR REPLACE FUNCTION canvas_record_tombstone() RETURNS trigger AS $$
+    DECLARE
+        ws UUID;
+        parent UUID;
+        rev BIGINT;
+    BEGIN
+        IF TG_TABLE_NAME = 'chats' THEN
+            ws := OLD.workspace_id;
+            parent := OLD.id;
+        ELSE
+            -- PL/pgSQL resolves every OLD field it sees against the deleted row's type,
+            -- so each table reads its own column (a CASE over both fails on messages)
+            IF TG_TABLE_NAME = 'messages' THEN
+                parent := OLD.chat_id;
+            ELSE
+                parent := OLD.from_chat_id;
+            END IF;
+            SELECT workspace_id INTO ws FROM chats WHERE id = parent;
+        END IF;
+
+        UPDATE workspaces SET version = version + 1 WHERE id = ws RETURNING version INTO rev;
+        -- No chat or workspace left: removed by a cascade that is already recorded
+        IF rev IS NULL THEN
+            RETURN OLD;
+        END IF;
+
+        INSERT INTO canvas_tombstones (workspace_id, kind, object_id, chat_id, revision)
+        VALUES (ws, TG_TABLE_NAME, OLD.id, parent, rev);
+        RETURN OLD;
+    END
+    $$ LANGUAGE plpgsql
+"""
+
+
+def _triggers(table, update_columns=""):
+    of = f"OF {update_columns} " if update_columns else ""
+    return [
+        migrations.RunSQL(
+            sql=f"CREATE TRIGGER {table}_bump_revision BEFORE INSERT OR UPDATE {of}ON {table} "
+                f"FOR EACH ROW EXECUTE FUNCTION canvas_bump_revision()",
+            reverse_sql=f"DROP TRIGGER IF EXISTS {table}_bump_revision ON {table}",
+        ),
+        migrations.RunSQL(
+            sql=f"CREATE TRIGGER {table}_record_tombstone AFTER DELETE ON {table} "
+                f"FOR EACH ROW EXECUTE FUNCTION canvas_record_tombstone()",
+            reverse_sql=f"DROP TRIGGER IF EXISTS {table}_record_tombstone ON {table}",
+        ),
+    ]
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('workspaces', '0001_hot_query_indexes'),
+        ('canvas', '0005_generation_jobs'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+                ALTER TABLE workspaces ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+                ALTER TABLE chats ADD COLUMN IF NOT EXISTS revision BIGINT NOT NULL DEFAULT 0;
+                ALTER TABLE messages ADD COLUMN IF NOT EXISTS revision BIGINT NOT NULL DEFAULT 0;
+                ALTER TABLE message_links ADD COLUMN IF NOT EXISTS revision BIGINT NOT NULL DEFAULT 0;
+            """,
+            reverse_sql="""
+                ALTER TABLE workspaces DROP COLUMN IF EXISTS version;
+                ALTER TABLE chats DROP COLUMN IF EXISTS revision;
+                ALTER TABLE messages DROP COLUMN IF EXISTS revision;
+                ALTER TABLE message_links DROP COLUMN IF EXISTS revision;
+            """,
+        ),
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE IF NOT EXISTS canvas_tombstones (
+                    workspace_id UUID NOT NULL REFERENCES workspaces(id) ON DELETE CASCADE,
+                    kind VARCHAR NOT NULL CHECK (kind IN ('chats', 'messages', 'message_links')),
+                    object_id UUID NOT NULL,
+                    chat_id UUID,
+                    revision BIGINT NOT NULL,
+                    deleted_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                );
+                CREATE INDEX IF NOT EXISTS canvas_tombstones_workspace_id_revision_idx
+                    ON canvas_tombstones (workspace_id, revision);
+            """,
+            reverse_sql="DROP TABLE IF EXISTS canvas_tombstones",
+        ),
+        migrations.RunSQL(sql=BUMP_FUNCTION, reverse_sql="DROP FUNCTION IF EXISTS canvas_bump_revision()"),
+        migrations.RunSQL(sql=TOMBSTONE_FUNCTION, reverse_sql="DROP FUNCTION IF EXISTS canvas_record_tombstone()"),
+        # Summary refreshes update chats too; only layout/title changes are client-visible
+        *_triggers('chats', 'workspace_id, title, x_pos, y_pos, width, height, z_index'),
+        *_triggers('messages'),
+        *_triggers('message_links'),
+        # ChatViewSet.list?since=: WHERE workspace_id = %s AND revision > %s
+        migrations.RunSQL(
+            sql="CREATE INDEX CONCURRENTLY IF NOT EXISTS chats_workspace_id_revision_idx "
+                "ON chats (workspace_id, revision)",
+            reverse_sql="DROP INDEX CONCURRENTLY IF EXISTS chats_workspace_id_revision_idx",
+        ),
+        # MessageViewSet.list?since=: WHERE chat_id = %s AND revision > %s
+        migrations.RunSQL(
+            sql="CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_chat_id_revision_idx "
+                "ON messages (chat_id, revision)",
+            reverse_sql="DROP INDEX CONCURRENTLY IF EXISTS messages_chat_id_revision_idx",
+        ),
+    ]
@@ -0,0 +1,109 @@
+"""
+Keyset pagination for chat messages.
+
+`order_index` is unique per chat, so it is used directly as a stable cursor and
+every page is a short range scan on the (chat_id, order_index) index instead of
+an OFFSET that grows with the chat's length.
+
+Client contract for GET /canvas/messages/?chat_id={uuid}:
+    - No before, after or limit: returns the whole conversation in ascending order,
+      as {"data": [...]} without "paging" (the original, unpaginated response).
+    - Only ?limit={n}: returns the newest `limit` messages (the tail) in ascending order.
+      A window renders these first.
+    - ?before={order_index}: returns the `limit` messages right before that index
+      (ascending). Pass `paging.before` of the oldest page loaded to scroll back.
+    - ?after={order_index}: returns the `limit` messages right after that index
+      (ascending). Pass `paging.after` to catch up after a reconnect.
+    - `paging.has_more` tells whether more messages exist in the direction of travel
+      (older for tail/before, newer for after).
+"""
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+MESSAGE_COLUMNS = "id, role, content, order_index, created_at"
+
+
+class CursorError(ValueError):
+    pass
+
+
+def parse_cursor(query_params):
+    """
+    Validates ?before=, ?after= and ?limit=.
+    Returns (direction, cursor, limit) where direction is 'before' or 'after',
+    or (None, None, None) when none of them is given (the whole conversation).
+    Raises CursorError on invalid input.
+    """
+    before = query_params.get('before')
+    after = query_params.get('after')
+    if before is None and after is None and query_params.get('limit') is None:
+        return None, None, None
+
+    if before is not None and after is not None:
+        raise CursorError("Use either before or after, not both")
+
+    raw_cursor = after if after is not None else before
+    try:
+        limit = int(query_params.get('limit', DEFAULT_PAGE_SIZE))
+        cursor = int(raw_cursor) if raw_cursor is not None else None
+    except ValueError:
+        raise CursorError("before, after and limit must be integers")
+
+    if limit < 1:
+        raise CursorError("limit must be positive")
+
+    return ('after' if after is not None else 'before'), cursor, min(limit, MAX_PAGE_SIZE)
+
+
+def page_query(chat_id, direction, cursor, limit):
+    """
+    Builds the query for one page. One extra row is fetched to compute `has_more`.
+    Without a direction, the query returns every message of the chat.
+    """
+    if direction is None:
+        query = f"""
+            SELECT {MESSAGE_COLUMNS}
+            FROM messages
+            WHERE chat_id = %s AND is_hidden = FALSE
+            ORDER BY order_index ASC
+        """
+        return query, [chat_id]
+
+    params = [chat_id]
+    condition = ""
+    if cursor is not None:
+        condition = "AND order_index > %s" if direction == 'after' else "AND order_index < %s"
+        params.append(cursor)
+    params.append(limit + 1)
+
+    query = f"""
+        SELECT {MESSAGE_COLUMNS}
+        FROM messages
+        WHERE chat_id = %s AND is_hidden = FALSE {condition}
+        ORDER BY order_index {"ASC" if direction == 'after' else "DESC"}
+        LIMIT %s
+    """
+    return query, params
+
+
+def build_page(rows, direction, limit):
+    """
+    Turns the fetched rows (dicts) into the response payload, ascending by order_index.
+    """
+    if direction is None:
+        return {"data": rows}
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == 'before':
+        rows.reverse()
+
+    return {
+        "data": rows,
+        "paging": {
+            "before": rows[0]["order_index"] if rows else None,
+            "after": rows[-1]["order_index"] if rows else None,
+            "has_more": has_more
+        }
+    }
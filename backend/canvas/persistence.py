@@ -0,0 +1,178 @@
+"""
+Writes and change notifications shared by the viewsets, the async views and the
+generation worker.
+
+Every canvas write emits a delta on the `CHANNEL` Postgres channel with
+`pg_notify`, in the same transaction as the write. Postgres delivers it only
+on commit, so listeners (see `canvas.realtime`) never see rolled-back changes.
+"""
+
+import json
+
+from rest_framework.utils.encoders import JSONEncoder
+
+CHANNEL = "canvas_events"
+
+# NOTIFY payloads must stay below 8000 bytes
+MAX_NOTIFY_BYTES = 7900
+# Chats per notification for bulk layout updates
+LAYOUT_NOTIFY_CHUNK = 40
+
+
+def notify_sql(workspace_id, event, data):
+    """
+    Returns (sql, params) publishing `event` for the workspace. Message content that
+    would overflow the payload limit is left out and flagged with "truncated": true;
+    clients then fetch the message through the regular endpoints.
+    """
+    payload = json.dumps({"workspace_id": workspace_id, "event": event, "data": data}, cls=JSONEncoder)
+    if len(payload.encode("utf-8")) > MAX_NOTIFY_BYTES and "content" in data:
+        data = {**data, "content": None, "truncated": True}
+        payload = json.dumps({"workspace_id": workspace_id, "event": event, "data": data}, cls=JSONEncoder)
+    return "SELECT pg_notify(%s, %s)", [CHANNEL, payload]
+
+
+def notify(cursor, workspace_id, event, data):
+    cursor.execute(*notify_sql(workspace_id, event, data))
+
+
+def notify_layout(cursor, rows, columns):
+    """
+    Publishes `chat.updated` for changed chats, grouped per workspace and chunked.
+    `rows` are (workspace_id, *values) tuples matching `columns`.
+    """
+    by_workspace = {}
+    for workspace_id, *values in rows:
+        by_workspace.setdefault(workspace_id, []).append(dict(zip(columns, values)))
+
+    for workspace_id, chats in by_workspace.items():
+        for start in range(0, len(chats), LAYOUT_NOTIFY_CHUNK):
+            notify(cursor, workspace_id, "chat.updated", {"chats": chats[start:start + LAYOUT_NOTIFY_CHUNK]})
+
+
+def message_delta(chat_id, role, content, row):
+    message_id, order_index, created_at = row
+    return {
+        "id": message_id,
+        "chat_id": chat_id,
+        "role": role,
+        "content": content,
+        "order_index": order_index,
+        "created_at": created_at
+    }
+
+
+# Writers lock the chat's workspace row first. The change-version triggers (see
+# canvas/migrations/0006_change_versions.py) need that lock anyway, so taking it up
+# front keeps every write path in the same lock order.
+LOCK_CHAT_WORKSPACE_SQL = """
+    SELECT w.id FROM chats c
+    JOIN workspaces w ON w.id = c.workspace_id
+    WHERE c.id = %s
+    FOR UPDATE OF w
+"""
+
+APPEND_MESSAGE_SQL = """
+    INSERT INTO messages (chat_id, role, content, order_index)
+    SELECT %s, %s, %s, COALESCE(MAX(order_index), -1) + 1
+    FROM messages WHERE chat_id = %s
+    RETURNING id, order_index, created_at
+"""
+
+
+def append_message(cursor, chat_id, role, content):
+    """
+    Inserts a message at the end of the chat and returns (id, order_index, created_at).
+    Must run inside `transaction.atomic()`: the workspace row lock serializes order_index
+    allocation, so concurrent prompts on the same chat never receive the same slot.
+    """
+    cursor.execute(LOCK_CHAT_WORKSPACE_SQL, [chat_id])
+    chat = cursor.fetchone()
+    cursor.execute(APPEND_MESSAGE_SQL, [chat_id, role, content, chat_id])
+    row = cursor.fetchone()
+    if chat:
+        notify(cursor, chat[0], "message.created", message_delta(chat_id, role, content, row))
+    return row
+
+
+# The reply's slot, reserved right after its prompt: a hidden, empty model message that
+# list endpoints, snapshots, context and summaries skip until `fill_reply` writes it
+RESERVE_REPLY_SQL = """
+    INSERT INTO messages (chat_id, role, content, order_index, is_hidden)
+    VALUES (%s, 'model', '', %s, TRUE)
+    RETURNING id
+"""
+
+FILL_REPLY_SQL = """
+    UPDATE messages SET content = %s, is_hidden = FALSE, created_at = now()
+    WHERE id = %s AND is_hidden = TRUE
+    RETURNING id, order_index, created_at
+"""
+
+RELEASE_REPLY_SQL = "DELETE FROM messages WHERE id = %s AND is_hidden = TRUE"
+
+
+def append_exchange(cursor, chat_id, content):
+    """
+    Inserts the user's prompt at the end of the chat and reserves the slot right after
+    it for the reply. Returns (prompt_row, reply_id); see `append_message` for the row.
+    Prompts sent while an answer is still being generated go after its slot, so the
+    stored transcript keeps each reply next to its prompt.
+    """
+    prompt = append_message(cursor, chat_id, 'user', content)
+    cursor.execute(RESERVE_REPLY_SQL, [chat_id, prompt[1] + 1])
+    return prompt, cursor.fetchone()[0]
+
+
+def fill_reply(cursor, chat_id, reply_id, content):
+    """
+    Writes the reply into its reserved slot, publishes `message.created` and returns
+    (id, order_index, created_at). Without a slot (`reply_id` None, or the slot was
+    released meanwhile) the reply is appended at the end instead.
+    Must run inside `transaction.atomic()`.
+    """
+    if reply_id is None:
+        return append_message(cursor, chat_id, 'model', content)
+    workspace_id = lock_chat_workspace(cursor, chat_id)
+    cursor.execute(FILL_REPLY_SQL, [content, reply_id])
+    row = cursor.fetchone()
+    if row is None:
+        return append_message(cursor, chat_id, 'model', content)
+    notify(cursor, workspace_id, "message.created", message_delta(chat_id, 'model', content, row))
+    return row
+
+
+def release_reply(cursor, reply_id):
+    """
+    Frees a reply slot that will never be filled (the request gave up). Clients never saw it.
+    """
+    if reply_id is not None:
+        cursor.execute(RELEASE_REPLY_SQL, [reply_id])
+
+
+DELETE_MESSAGE_SQL = """
+    DELETE FROM messages m USING chats c
+    WHERE m.id = %s AND c.id = m.chat_id
+    RETURNING c.workspace_id, m.chat_id
+"""
+
+
+def lock_chat_workspace(cursor, chat_id):
+    """
+    Locks the workspace of the chat until commit and returns its id (None if the chat doesn't exist).
+    """
+    cursor.execute(LOCK_CHAT_WORKSPACE_SQL, [chat_id])
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def delete_message(cursor, message_id):
+    """
+    Deletes a message and publishes `message.deleted`. Returns False if it didn't exist.
+    """
+    cursor.execute(DELETE_MESSAGE_SQL, [message_id])
+    row = cursor.fetchone()
+    if row is None:
+        return False
+    notify(cursor, row[0], "message.deleted", {"id": message_id, "chat_id": row[1]})
+    return True
@@ -0,0 +1,125 @@
+"""
+Provider-side context caching for shared branch prefixes.
+
+Sibling branches created from the same parent message all start their history
+with the same inherited turns (see `canvas.context`). When such a prefix is long
+and is seen a second time within the TTL, it is uploaded once as a Gemini
+`CachedContent`, and later requests only send their own turns against a model
+bound to that cache.
+
+Caching is an optimization only: if the provider (or the configured model)
+doesn't support it, or a handle has expired, callers fall back to a regular
+request. The provider is any `services.llm.LLMProvider`, so the whole flow can
+be exercised offline with `FakeProvider`.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from services.llm import LLMError
+
+logger = logging.getLogger(__name__)
+
+# Registry value for a prefix seen once but not (yet) worth caching
+_SEEN = "__seen__"
+
+# Gemini answers NOT_FOUND or PERMISSION_DENIED for a cached content that expired or was deleted
+CACHE_MISSING_STATUS_CODES = {403, 404}
+
+
+def is_cache_missing(error):
+    """
+    True if a request against a cached prefix failed because the cache is gone,
+    the one failure that resending the prefix inline can fix.
+    """
+    return isinstance(error, LLMError) and error.status in CACHE_MISSING_STATUS_CODES
+
+
+class PrefixCache:
+    """
+    Maps prefix hashes to provider cache handles.
+
+    :param client: LLMProvider implementing `create_cache(contents, ttl_seconds)` and `bind_cache(handle)`
+    :param registry: Cache backend (get/set) for prefix hash -> handle, e.g. `LRUCache`
+    :param min_tokens: Prefixes shorter than this are never cached (provider minimums apply)
+    :param ttl: Provider-side TTL in seconds; registry entries expire slightly earlier
+    :param retry_after: After a `create` failure, caching is skipped for this many seconds
+    """
+
+    KEY_PREFIX = "canvas:llm-prefix:"
+
+    def __init__(self, client, registry, min_tokens=4096, ttl=600, retry_after=300):
+        self.client = client
+        self.registry = registry
+        self.min_tokens = min_tokens
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self.hits = 0
+        self.creates = 0
+        self._disabled_until = 0.0
+        self._providers = {}
+        self._lock = threading.Lock()
+
+    def key(self, contents):
+        payload = json.dumps(contents, sort_keys=True, separators=(",", ":"))
+        return self.KEY_PREFIX + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _bound_provider(self, handle):
+        with self._lock:
+            bound = self._providers.get(handle)
+        if bound is None:
+            bound = self.client.bind_cache(handle)
+            with self._lock:
+                # Handles expire provider-side; keep the memo from growing without bound
+                if len(self._providers) >= 256:
+                    self._providers.clear()
+                self._providers[handle] = bound
+        return bound
+
+    def provider_for(self, prefix_contents, prefix_tokens):
+        """
+        Returns a provider bound to the cached prefix, or None when the prefix should be
+        sent inline (too short, seen only once so far, or caching unavailable).
+        Creating and binding a cache are blocking provider calls; async callers run
+        this in a worker thread.
+        """
+        if prefix_tokens < self.min_tokens or time.monotonic() < self._disabled_until:
+            return None
+
+        key = self.key(prefix_contents)
+        handle = self.registry.get(key)
+
+        if handle is None:
+            # First sighting: only remember it. A second chat with the same prefix
+            # proves it is shared and makes the upload worthwhile.
+            self.registry.set(key, _SEEN)
+            return None
+
+        try:
+            if handle == _SEEN:
+                handle = self.client.create_cache(prefix_contents, self.ttl)
+                self.registry.set(key, handle)
+                self.creates += 1
+            else:
+                self.hits += 1
+            return self._bound_provider(handle)
+        except Exception as e:
+            logger.warning("Context caching unavailable, sending prefix inline: %s", e)
+            self._disabled_until = time.monotonic() + self.retry_after
+            return None
+
+    def invalidate(self, prefix_contents):
+        """
+        Forgets the handle for a prefix (e.g. after the provider reported it expired).
+        """
+        key = self.key(prefix_contents)
+        handle = self.registry.get(key)
+        self.registry.delete(key)
+        with self._lock:
+            self._providers.pop(handle, None)
+
+    def stats(self):
+        return {"hits": self.hits, "creates": self.creates}
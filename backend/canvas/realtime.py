@@ -0,0 +1,232 @@
+"""
+Real-time canvas sync over WebSockets.
+
+Clients connect to ws(s)://<host>/ws/workspaces/{workspace_id}/?token={access JWT}
+and receive the deltas that the write paths publish with `pg_notify` (see
+`canvas.persistence`), one JSON text frame per event:
+
+    {"workspace_id": ..., "event": "chat.created",    "data": {chat}}
+    {"workspace_id": ..., "event": "chat.updated",    "data": {"chats": [{"id": .., <changed fields>}]}}
+    {"workspace_id": ..., "event": "chat.deleted",    "data": {"id": ...}}
+    {"workspace_id": ..., "event": "message.created", "data": {message, "chat_id": ...}}
+    {"workspace_id": ..., "event": "message.deleted", "data": {"id": ..., "chat_id": ...}}
+    {"workspace_id": ..., "event": "link.created",    "data": {link}}
+
+Two control events carry no workspace data:
+    {"event": "ping"}    sent after HEARTBEAT_SECONDS of silence, to keep proxies from closing the socket
+    {"event": "resync"}  events may have been missed (slow client, listener reconnect);
+                         the client should reload the workspace snapshot
+
+Each process keeps one LISTEN connection and fans notifications out to its own
+sockets, so the database sees a single listener per process however many tabs
+are open.
+
+A socket outlives the checks made at the handshake, so they are repeated while it
+is open: before every frame, the token is checked against the revocation mirror
+(no query, see `accounts.revocation`), and on `chat.deleted`, which a deleted
+workspace publishes for each of its chats, ownership is re-read from the database.
+The socket is closed with 4401 or 4403 respectively.
+"""
+
+import asyncio
+import json
+import logging
+import re
+from urllib.parse import parse_qs
+
+import psycopg
+from django.conf import settings
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken, TokenError
+
+from accounts.authentication import RawSQLJWTAuthentication
+from accounts.revocation import revocations
+from workspaces.permissions import WORKSPACE_OWNER_QUERY, ownership
+from .async_db import conninfo, fetch_one
+from .persistence import CHANNEL
+
+logger = logging.getLogger(__name__)
+
+WS_PATH = re.compile(r"^/ws/workspaces/(?P<workspace_id>[0-9a-fA-F-]{36})/?$")
+
+# Events buffered per socket before the client is told to resync
+QUEUE_SIZE = getattr(settings, 'CANVAS_REALTIME_QUEUE_SIZE', 256)
+HEARTBEAT_SECONDS = getattr(settings, 'CANVAS_REALTIME_HEARTBEAT', 30)
+MAX_RECONNECT_DELAY = 30
+
+PING = json.dumps({"event": "ping"})
+RESYNC = json.dumps({"event": "resync"})
+
+_authenticator = RawSQLJWTAuthentication(refresh_revocations=False)
+
+
+class _Subscriber:
+    __slots__ = ('queue',)
+
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    def push(self, text):
+        try:
+            self.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            # Drop the backlog: the client reloads the snapshot instead of replaying it
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+
+
+class Hub:
+    """
+    Per-process fan-out from the Postgres channel to workspace subscribers.
+    The LISTEN connection is opened on the first subscription and kept open. It goes
+    straight to Postgres (settings.DATABASE_DIRECT): LISTEN is session state that a
+    transaction-mode PgBouncer would not keep.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+        self._task = None
+
+    def subscribe(self, workspace_id):
+        subscriber = _Subscriber()
+        self._subscribers.setdefault(workspace_id, set()).add(subscriber)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._listen())
+        return subscriber
+
+    def unsubscribe(self, workspace_id, subscriber):
+        subscribers = self._subscribers.get(workspace_id)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[workspace_id]
+
+    def _dispatch(self, payload):
+        try:
+            workspace_id = str(json.loads(payload).get("workspace_id")).lower()
+        except ValueError:
+            return
+        for subscriber in list(self._subscribers.get(workspace_id, ())):
+            subscriber.push(payload)
+
+    def _broadcast(self, text):
+        for subscribers in list(self._subscribers.values()):
+            for subscriber in list(subscribers):
+                subscriber.push(text)
+
+    async def _listen(self):
+        delay = 1
+        connected_before = False
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(conninfo(direct=True), autocommit=True) as conn:
+                    await conn.execute(f"LISTEN {CHANNEL}")
+                    delay = 1
+                    if connected_before:
+                        # Anything published while we were disconnected is lost
+                        self._broadcast(RESYNC)
+                    connected_before = True
+                    async for notification in conn.notifies():
+                        self._dispatch(notification.payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Canvas listener disconnected (%s), reconnecting in %ss", e, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+
+hub = Hub()
+
+
+async def _authenticate(scope):
+    """
+    Browsers can't set headers on WebSocket handshakes, so the access token comes in
+    the query string. Returns the same lightweight user the viewsets see and the
+    token's version (`ver` claim), or (None, None).
+    """
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    token = (query.get("token") or [None])[0]
+    if not token:
+        return None, None
+    await revocations.arefresh_if_stale()
+    try:
+        validated = _authenticator.get_validated_token(token)
+        return _authenticator.get_user(validated), validated.get('ver', 0)
+    except (AuthenticationFailed, InvalidToken, TokenError):
+        return None, None
+
+
+async def _close_code(user, token_version, workspace_id, text):
+    """
+    Re-checks an open socket before `text` is sent. Returns the close code, or None to go on.
+    """
+    await revocations.arefresh_if_stale()
+    if revocations.is_revoked(user.id, token_version):
+        return 4401
+    # Cheap test first: most frames are not deletions
+    if '"chat.deleted"' in text and json.loads(text).get("event") == "chat.deleted":
+        # Not the ownership cache: it may still remember the deleted workspace
+        if await fetch_one(WORKSPACE_OWNER_QUERY, [workspace_id, user.id]) is None:
+            ownership.forget_workspace(user.id, workspace_id)
+            return 4403
+    return None
+
+
+async def _pump(subscriber, receive, send, check):
+    async def forward():
+        while True:
+            try:
+                text = await asyncio.wait_for(subscriber.queue.get(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                text = PING
+            code = await check(text)
+            if code is not None:
+                await send({"type": "websocket.close", "code": code})
+                return
+            await send({"type": "websocket.send", "text": text})
+
+    async def drain():
+        # The channel is push-only; client frames are ignored until it disconnects
+        while (await receive())["type"] != "websocket.disconnect":
+            pass
+
+    tasks = [asyncio.ensure_future(forward()), asyncio.ensure_future(drain())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def websocket_app(scope, receive, send):
+    """
+    ASGI application for /ws/workspaces/{workspace_id}/. Closes with 4401 for a
+    missing, invalid or (later) revoked token, 4403 for a workspace the user doesn't
+    (or no longer) own(s) and 4404 for an unknown path.
+    """
+    if (await receive())["type"] != "websocket.connect":
+        return
+
+    match = WS_PATH.match(scope["path"])
+    if match is None:
+        await send({"type": "websocket.close", "code": 4404})
+        return
+
+    user, token_version = await _authenticate(scope)
+    if user is None:
+        await send({"type": "websocket.close", "code": 4401})
+        return
+
+    workspace_id = match.group("workspace_id").lower()
+    if not await ownership.aworkspace_owned(user.id, workspace_id):
+        await send({"type": "websocket.close", "code": 4403})
+        return
+
+    # Subscribe before accepting so no event published after the handshake is missed
+    subscriber = hub.subscribe(workspace_id)
+    try:
+        await send({"type": "websocket.accept"})
+        await _pump(subscriber, receive, send, lambda text: _close_code(user, token_version, workspace_id, text))
+    finally:
+        hub.unsubscribe(workspace_id, subscriber)
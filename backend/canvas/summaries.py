@@ -0,0 +1,161 @@
+"""
+Rolling per-chat summaries.
+
+Every `SUMMARY_EVERY` new messages, the older part of a chat is folded into
+`chats.summary` and `chats.summary_through` records the last order_index it
+covers. Prompts then send the summary plus the messages after it (see
+`canvas.context`), so request size stays bounded however long a chat grows.
+
+Summaries are refreshed off the request path, after the reply has been saved, on
+a small per-process pool of SUMMARY_WORKERS threads. A chat has at most one
+refresh queued or running, and at most SUMMARY_MAX_PENDING chats wait at a time;
+beyond that a refresh is skipped, and the chat's next reply asks again (it is
+still due). The generation-jobs queue is not used for this: it only runs where
+workers are deployed, and a multi-call refresh would hold up the chat's prompts.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection
+
+from .ai_services import summarize_conversation
+from .context import load_inherited
+
+logger = logging.getLogger(__name__)
+
+SUMMARIES_ENABLED = getattr(settings, 'CANVAS_SUMMARIES_ENABLED', True)
+# New messages (beyond the kept tail) that trigger a refresh
+SUMMARY_EVERY = getattr(settings, 'CANVAS_SUMMARY_EVERY', 10)
+# Most recent messages always sent verbatim instead of being summarized
+SUMMARY_KEEP_RECENT = getattr(settings, 'CANVAS_SUMMARY_KEEP_RECENT', 6)
+SUMMARY_MAX_WORDS = getattr(settings, 'CANVAS_SUMMARY_MAX_WORDS', 250)
+# Messages folded in per model call when a chat has a long backlog
+SUMMARY_BATCH = getattr(settings, 'CANVAS_SUMMARY_BATCH', 50)
+# Threads refreshing summaries in parallel, and chats allowed to wait for one
+SUMMARY_WORKERS = getattr(settings, 'CANVAS_SUMMARY_WORKERS', 2)
+SUMMARY_MAX_PENDING = getattr(settings, 'CANVAS_SUMMARY_MAX_PENDING', 100)
+
+# Candidates for the new boundary: the newest visible messages after `summary_through`.
+# The summary never passes a reply slot still waiting for its answer (see
+# `canvas.persistence`), since the answer would then be in neither summary nor history.
+BOUNDARY_QUERY = """
+    SELECT order_index FROM messages
+    WHERE chat_id = %s AND order_index > COALESCE(%s::int, -1) AND is_hidden = FALSE
+      AND order_index < COALESCE(
+          (SELECT MIN(order_index) FROM messages WHERE chat_id = %s AND is_hidden = TRUE), 2147483647
+      )
+    ORDER BY order_index DESC
+    LIMIT %s
+"""
+
+# The chat's own messages after `summary_through`, up to and including the new boundary
+FOLD_QUERY = """
+    SELECT role, content, order_index FROM messages
+    WHERE chat_id = %s AND order_index > COALESCE(%s::int, -1) AND order_index <= %s AND is_hidden = FALSE
+    ORDER BY order_index
+    LIMIT %s
+"""
+
+# Chats with a refresh queued or running in this process
+_in_flight = set()
+_in_flight_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix="chat-summary")
+
+
+def is_due(summary_through, last_order_index):
+    """
+    True when enough messages accumulated after the summary to fold a new batch in.
+    """
+    covered = -1 if summary_through is None else summary_through
+    return last_order_index - covered >= SUMMARY_EVERY + SUMMARY_KEEP_RECENT
+
+
+def refresh_summary(chat_id):
+    """
+    Folds the messages after the current summary (minus the kept tail) into it,
+    SUMMARY_BATCH messages per model call. For a chat's first summary, the inherited
+    branch context is folded in as well. `summary_through` is saved after every batch,
+    so it never moves past what the summary actually covers.
+    Returns True if the summary was updated.
+    """
+    # 1. Read (short): current summary and the new boundary
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT summary, summary_through FROM chats WHERE id = %s", [chat_id])
+        row = cursor.fetchone()
+        if row is None:
+            return False
+        summary, through = row
+        cursor.execute(BOUNDARY_QUERY, [chat_id, through, chat_id, SUMMARY_EVERY + SUMMARY_KEEP_RECENT])
+        indexes = [r[0] for r in cursor.fetchall()]
+        # The first summary absorbs the ancestors' context, which later prompts no longer load
+        pending = load_inherited(cursor, chat_id) if through is None else []
+
+    if len(indexes) < SUMMARY_EVERY + SUMMARY_KEEP_RECENT:
+        return False
+
+    # `indexes` is newest first: the first SUMMARY_KEEP_RECENT stay verbatim
+    new_through = indexes[SUMMARY_KEEP_RECENT]
+    updated = False
+
+    while through is None or through < new_through:
+        # 2. Read (short): the next batch of exactly the messages not yet covered
+        with connection.cursor() as cursor:
+            cursor.execute(FOLD_QUERY, [chat_id, through, new_through, SUMMARY_BATCH])
+            rows = cursor.fetchall()
+        if not rows:
+            break
+        batch = pending + [{"role": role, "content": content} for role, content, _ in rows]
+        pending = []
+
+        # 3. Summarize without holding a connection (unless an outer transaction needs it)
+        if not connection.in_atomic_block:
+            connection.close()
+        new_summary = summarize_conversation(summary, batch, SUMMARY_MAX_WORDS)
+
+        # 4. Write (short); stops if another worker moved the summary meanwhile
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE chats SET summary = %s, summary_through = %s
+                WHERE id = %s AND summary_through IS NOT DISTINCT FROM %s
+                """,
+                [new_summary, rows[-1][2], chat_id, through]
+            )
+            if cursor.rowcount != 1:
+                return updated
+        summary, through, updated = new_summary, rows[-1][2], True
+
+    return updated
+
+
+def _run(chat_id):
+    try:
+        refresh_summary(chat_id)
+    except Exception:
+        logger.exception("Summary refresh failed for chat %s", chat_id)
+    finally:
+        # Pool threads own their connection; don't hold it while idle
+        connection.close()
+        with _in_flight_lock:
+            _in_flight.discard(chat_id)
+
+
+def schedule_summary(chat_id, summary_through, last_order_index):
+    """
+    Queues a background refresh if the chat is due, has none queued or running, and
+    the pool has room. Cheap to call after every reply: the due check uses values the
+    request already has. Returns True if a refresh was queued.
+    """
+    if not SUMMARIES_ENABLED or not is_due(summary_through, last_order_index):
+        return False
+
+    with _in_flight_lock:
+        if chat_id in _in_flight or len(_in_flight) >= SUMMARY_MAX_PENDING:
+            return False
+        _in_flight.add(chat_id)
+
+    _executor.submit(_run, chat_id)
+    return True
@@ -0,0 +1,124 @@
+"""
+Delta sync for the canvas hydration endpoints.
+
+Every workspace carries a change version (`workspaces.version`), and every chat,
+link and message the revision at which it last changed (see
+canvas/migrations/0006_change_versions.py). Deleted rows leave tombstones.
+
+Client contract:
+    - ChatViewSet.list, LinkViewSet.list and the workspace canvas snapshot include
+      "version": the workspace version the data is current to.
+    - ?since={version} on ChatViewSet.list, LinkViewSet.list and MessageViewSet.list:
+      only rows changed after that version are returned in "data", plus the ids
+      removed since then in "deleted". Apply both, then keep the new "version".
+    - Without ?since= the full set (or, for messages, the keyset page) is returned as before.
+
+The version is read before the rows, so a change committed in between shows up
+again on the next sync rather than being missed; applying deltas is idempotent.
+"""
+
+from typing import Optional
+
+from services.db import Query, fetch_all
+from .pagination import MAX_PAGE_SIZE, MESSAGE_COLUMNS
+
+# Both double as ownership checks: no row for someone else's workspace or chat
+VERSION_QUERY = "SELECT version FROM workspaces WHERE id = %s AND user_id = %s"
+
+CHAT_VERSION_QUERY = """
+    SELECT w.id, w.version FROM chats c
+    JOIN workspaces w ON w.id = c.workspace_id
+    WHERE c.id = %s AND w.user_id = %s
+"""
+
+# Messages of one chat changed after a version, oldest change first; fetched with
+# LIMIT MAX_PAGE_SIZE + 1 so `cap_message_delta` can tell whether more follow
+CHANGED_MESSAGES_QUERY = f"""
+    SELECT {MESSAGE_COLUMNS}, revision
+    FROM messages
+    WHERE chat_id = %s AND is_hidden = FALSE AND revision > %s
+    ORDER BY revision
+    LIMIT %s
+"""
+
+
+class SinceError(ValueError):
+    pass
+
+
+def parse_since(query_params) -> Optional[int]:
+    """
+    Validates ?since=. Returns None when absent. Raises SinceError on invalid input.
+    """
+    raw = query_params.get('since')
+    if raw is None:
+        return None
+    try:
+        since = int(raw)
+    except ValueError:
+        raise SinceError("since must be an integer version")
+    if since < 0:
+        raise SinceError("since must not be negative")
+    return since
+
+
+def since_clause(alias, since):
+    """
+    Returns (sql, params) restricting `alias` to rows changed after `since` ("" when None).
+    """
+    if since is None:
+        return "", []
+    return f"AND {alias}.revision > %s", [since]
+
+
+def tombstones_query(workspace_id, kind, since, chat_id=None, upto=None):
+    """
+    Builds the query for ids of `kind` ('chats', 'message_links' or 'messages')
+    deleted after `since` (and up to `upto`), optionally limited to one chat.
+    """
+    params = [workspace_id, kind, since]
+    condition = ""
+    if chat_id is not None:
+        condition += " AND chat_id = %s"
+        params.append(chat_id)
+    if upto is not None:
+        condition += " AND revision <= %s"
+        params.append(upto)
+    query = f"""
+        SELECT object_id FROM canvas_tombstones
+        WHERE workspace_id = %s AND kind = %s AND revision > %s{condition}
+        ORDER BY revision
+    """
+    return query, params
+
+
+def fetch_deleted(workspace_id, kind, since, chat_id=None, upto=None, using=None):
+    query, params = tombstones_query(workspace_id, kind, since, chat_id, upto)
+    return [r[0] for r in fetch_all(Query("canvas.tombstones", query), params, using=using, as_dicts=False)]
+
+
+def cap_message_delta(rows, version):
+    """
+    Cuts rows of CHANGED_MESSAGES_QUERY down to one page. When more changed, the page's
+    version stops at its last revision so the client's next call picks up the rest.
+    Returns (rows in conversation order, version, has_more).
+    """
+    has_more = len(rows) > MAX_PAGE_SIZE
+    if has_more:
+        rows = rows[:MAX_PAGE_SIZE]
+        version = rows[-1]["revision"]
+    for r in rows:
+        del r["revision"]
+    rows.sort(key=lambda r: r["order_index"])
+    return rows, version, has_more
+
+
+def delta_payload(data, version, since, deleted):
+    """
+    Shapes a list response: full sets keep {"data", "version"}; deltas add "since" and "deleted".
+    """
+    payload = {"data": data, "version": version}
+    if since is not None:
+        payload["since"] = since
+        payload["deleted"] = deleted
+    return payload
@@ -1,3 +1,1285 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+import time
+import uuid
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import caches
+from django.db import IntegrityError, connection, connections
+from asgiref.testing import ApplicationCommunicator
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from accounts.revocation import BUMP_VERSION_SQL, revocations
+from accounts.views import UserViewSet
+from services import compression
+from services.renderers import ORJSONRenderer
+from services.cache import LRUCache
+from services.limiter import CacheRateLimiter, FairLimiter, LLMBusyError, SingleFlight
+from services.llm import FakeProvider, LLMError, RetryPolicy, build_provider
+from . import ai_services, async_db, async_views, realtime
+from .context import (
+    CONTEXT_TOKEN_BUDGET, TRUNCATION_MARKER, build_contents, estimate_tokens, load_context, to_contents
+)
+from .jobs import CHAT_LOCK_NAMESPACE, claim_job, run_job
+from .views import INTERRUPTED_MARKER
+from .pagination import page_query
+from .prefix_cache import PrefixCache, is_cache_missing
+from . import summaries
+from .summaries import refresh_summary, schedule_summary
+
+
+def create_user(email="owner@example.com"):
+    with connection.cursor() as cursor:
+        cursor.execute("INSERT INTO users (email, password) VALUES (%s, 'x') RETURNING id", [email])
+        return cursor.fetchone()[0]
+
+
+def create_workspace(user_id, name="Canvas"):
+    with connection.cursor() as cursor:
+        cursor.execute("INSERT INTO workspaces (user_id, name) VALUES (%s, %s) RETURNING id", [user_id, name])
+        return cursor.fetchone()[0]
+
+
+def create_chat(workspace_id, title="Chat"):
+    with connection.cursor() as cursor:
+        cursor.execute("INSERT INTO chats (workspace_id, title) VALUES (%s, %s) RETURNING id", [workspace_id, title])
+        return cursor.fetchone()[0]
+
+
+def create_messages(chat_id, count):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO messages (chat_id, role, content, order_index)
+            SELECT %s, 'user', 'message ' || i, i FROM generate_series(0, %s - 1) AS i
+            """,
+            [chat_id, count]
+        )
+
+
+def api_client(user_id):
+    client = APIClient()
+    client.force_authenticate(user=SimpleNamespace(id=user_id, is_authenticated=True))
+    return client
+
+
+class IndexUsageTests(TestCase):
+    """
+    The hot canvas queries must be answerable from an index. The test tables are tiny,
+    so sequential scans are disabled to ask the planner whether an index path exists at all.
+    """
+
+    def setUp(self):
+        self.user_id = create_user()
+        self.workspace_id = create_workspace(self.user_id)
+        self.chat_id = create_chat(self.workspace_id)
+
+    def assertIndexScan(self, query, params):
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute(f"EXPLAIN {query}", params)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        self.assertNotIn("Seq Scan", plan)
+        self.assertIn("Index", plan)
+
+    def test_message_page(self):
+        for direction, cursor_value in (('before', None), ('before', 10), ('after', 10)):
+            self.assertIndexScan(*page_query(self.chat_id, direction, cursor_value, 50))
+
+    def test_chat_list(self):
+        self.assertIndexScan(
+            "SELECT id FROM chats WHERE workspace_id = %s ORDER BY created_at ASC", [self.workspace_id]
+        )
+
+    def test_chat_changes(self):
+        self.assertIndexScan("SELECT id FROM chats WHERE workspace_id = %s AND revision > %s", [self.workspace_id, 0])
+
+    def test_link_list(self):
+        self.assertIndexScan(
+            """
+            SELECT ml.id FROM message_links ml
+            JOIN chats c ON ml.from_chat_id = c.id
+            WHERE c.id = %s
+            """,
+            [self.chat_id]
+        )
+
+
+class LayoutBatchTests(TestCase):
+
+    def setUp(self):
+        self.user_id = create_user()
+        self.workspace_id = create_workspace(self.user_id)
+        self.chats = [create_chat(self.workspace_id) for _ in range(3)]
+        self.client = api_client(self.user_id)
+
+    def layout(self, chat_id):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT x_pos, y_pos, z_index FROM chats WHERE id = %s", [chat_id])
+            return cursor.fetchone()
+
+    def test_applies_batch_and_counts_changed_rows(self):
+        response = self.client.post("/api/canvas/chats/layout/", {"chats": [
+            {"id": str(self.chats[0]), "x_pos": 10, "y_pos": 20},
+            {"id": str(self.chats[1]), "z_index": 5},
+            # Already at its stored position: not counted
+            {"id": str(self.chats[2]), "x_pos": 0},
+        ]}, format="json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["updated"], 2)
+        self.assertEqual(self.layout(self.chats[0]), (10.0, 20.0, 1))
+        self.assertEqual(self.layout(self.chats[1]), (0.0, 0.0, 5))
+
+    def test_rejects_whole_batch_with_foreign_chat(self):
+        other_chat = create_chat(create_workspace(create_user("other@example.com")))
+
+        response = self.client.post("/api/canvas/chats/layout/", {"chats": [
+            {"id": str(self.chats[0]), "x_pos": 10},
+            {"id": str(other_chat), "x_pos": 10},
+        ]}, format="json")
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.layout(self.chats[0]), (0.0, 0.0, 1))
+        self.assertEqual(self.layout(other_chat), (0.0, 0.0, 1))
+
+    def test_rejects_invalid_body(self):
+        response = self.client.post("/api/canvas/chats/layout/", {"chats": [{"x_pos": 1}]}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_same_chat_in_different_spellings(self):
+        response = self.client.post("/api/canvas/chats/layout/", {"chats": [
+            {"id": str(self.chats[0]).upper(), "x_pos": 10},
+            {"id": str(self.chats[0]).replace("-", ""), "x_pos": 30},
+        ]}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["updated"], 1)
+        self.assertEqual(self.layout(self.chats[0]), (30.0, 0.0, 1))
+
+    def test_rejects_malformed_id(self):
+        response = self.client.post(
+            "/api/canvas/chats/layout/", {"chats": [{"id": "not-a-uuid", "x_pos": 1}]}, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class ChatBranchTests(TestCase):
+
+    def setUp(self):
+        self.user_id = create_user()
+        self.workspace_id = create_workspace(self.user_id)
+        self.source_chat_id = create_chat(self.workspace_id, "Source")
+        create_messages(self.source_chat_id, 3)
+        self.client = api_client(self.user_id)
+
+    def message_id(self, chat_id, order_index):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id FROM messages WHERE chat_id = %s AND order_index = %s", [chat_id, order_index])
+            return cursor.fetchone()[0]
+
+    def branch(self, source_message_id, workspace_id=None):
+        return self.client.post("/api/canvas/chats/", {
+            "workspace_id": str(workspace_id or self.workspace_id), "title": "Branch",
+            "source_message_id": str(source_message_id), "start_offset": 2, "end_offset": 7
+        }, format="json")
+
+    def chat_titles(self, workspace_id):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT title FROM chats WHERE workspace_id = %s ORDER BY title", [workspace_id])
+            return [row[0] for row in cursor.fetchall()]
+
+    def test_creates_chat_and_link_together(self):
+        source_message_id = self.message_id(self.source_chat_id, 1)
+        response = self.branch(source_message_id)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["message"], "Chat branched successfully")
+        branch_id = response.data["chat_id"]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT id, source_message_id, start_offset, end_offset, from_chat_id, to_chat_id
+                FROM message_links
+                """
+            )
+            self.assertEqual(
+                cursor.fetchall(),
+                [(uuid.UUID(response.data["link_id"]), source_message_id, 2, 7, self.source_chat_id, branch_id)]
+            )
+        self.assertEqual(self.chat_titles(self.workspace_id), ["Branch", "Source"])
+        # Parent messages are inherited through the link, not copied
+        self.assertEqual(transcript(branch_id), [])
+
+    def test_source_message_from_another_workspace_creates_plain_chat(self):
+        other_chat_id = create_chat(create_workspace(self.user_id, "Other"))
+        create_messages(other_chat_id, 1)
+
+        response = self.branch(self.message_id(other_chat_id, 0))
+
+        self.assertEqual(response.status_code, 201)
+        self.assertIsNone(response.data["link_id"])
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM message_links")
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_foreign_workspace_creates_nothing(self):
+        other_workspace_id = create_workspace(create_user("other@example.com"))
+
+        response = self.branch(self.message_id(self.source_chat_id, 0), other_workspace_id)
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.chat_titles(other_workspace_id), [])
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM message_links")
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+
+class MessagePaginationTests(TestCase):
+
+    def setUp(self):
+        self.user_id = create_user()
+        self.chat_id = create_chat(create_workspace(self.user_id))
+        create_messages(self.chat_id, 5)
+        self.client = api_client(self.user_id)
+
+    def page(self, **params):
+        response = self.client.get("/api/canvas/messages/", {"chat_id": self.chat_id, **params})
+        self.assertEqual(response.status_code, 200)
+        return [m["order_index"] for m in response.data["data"]], response.data["paging"]
+
+    def test_tail_then_scroll_back(self):
+        indexes, paging = self.page(limit=2)
+        self.assertEqual(indexes, [3, 4])
+        self.assertEqual(paging, {"before": 3, "after": 4, "has_more": True})
+
+        indexes, paging = self.page(limit=2, before=paging["before"])
+        self.assertEqual(indexes, [1, 2])
+        self.assertTrue(paging["has_more"])
+
+        indexes, paging = self.page(limit=2, before=paging["before"])
+        self.assertEqual(indexes, [0])
+        self.assertFalse(paging["has_more"])
+
+    def test_after_cursor(self):
+        indexes, paging = self.page(limit=3, after=0)
+        self.assertEqual(indexes, [1, 2, 3])
+        self.assertTrue(paging["has_more"])
+
+        indexes, paging = self.page(limit=3, after=paging["after"])
+        self.assertEqual(indexes, [4])
+        self.assertFalse(paging["has_more"])
+
+    def test_no_cursor_or_limit_returns_whole_conversation(self):
+        response = self.client.get("/api/canvas/messages/", {"chat_id": self.chat_id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m["order_index"] for m in response.data["data"]], [0, 1, 2, 3, 4])
+        self.assertNotIn("paging", response.data)
+
+    def test_invalid_cursor(self):
+        response = self.client.get("/api/canvas/messages/", {"chat_id": self.chat_id, "before": 1, "after": 2})
+        self.assertEqual(response.status_code, 400)
+
+
+def transcript(chat_id):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT role, content, is_hidden FROM messages WHERE chat_id = %s ORDER BY order_index", [chat_id]
+        )
+        return cursor.fetchall()
+
+
+class MessageCreateTests(TestCase):
+
+    def setUp(self):
+        self.user_id = create_user()
+        self.chat_id = create_chat(create_workspace(self.user_id))
+        self.client = api_client(self.user_id)
+
+    def create(self, content):
+        return self.client.post(
+            "/api/canvas/messages/", {"chat_id": str(self.chat_id), "content": content}, format="json"
+        )
+
+    def test_interleaved_creates_keep_replies_next_to_prompts(self):
+        histories = []
+
+        def answer(history, prompt, **kwargs):
+            histories.append([m["content"] for m in history])
+            if prompt == "p1":
+                # p2 arrives while p1's answer is still being generated
+                self.assertEqual(self.create("p2").status_code, 201)
+            return "r" + prompt[1:]
+
+        with mock.patch("canvas.views.ask_gemini", side_effect=answer):
+            response = self.create("p1")
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            transcript(self.chat_id),
+            [("user", "p1", False), ("model", "r1", False), ("user", "p2", False), ("model", "r2", False)]
+        )
+        # p2 was sent without p1's answer, which did not exist yet
+        self.assertEqual(histories, [["p1"], ["p1", "p2"]])
+
+    def test_overloaded_create_leaves_nothing(self):
+        with mock.patch("canvas.views.ask_gemini", side_effect=LLMError("Resource exhausted", status=429)):
+            response = self.create("p1")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(transcript(self.chat_id), [])
+
+
+def parse_sse(frame):
+    frame = frame.decode() if isinstance(frame, bytes) else frame
+    event, data = frame.strip().split("\n")
+    return event[len("event: "):], json.loads(data[len("data: "):])
+
+
+class MessageStreamTests(TestCase):
+
+    def setUp(self):
+        self.user_id = create_user()
+        self.chat_id = create_chat(create_workspace(self.user_id))
+        self.client = api_client(self.user_id)
+
+    def stream(self):
+        response = self.client.post(
+            "/api/canvas/messages/stream/", {"chat_id": str(self.chat_id), "content": "p1"}, format="json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        return response
+
+    # The model is only called once the response is iterated, so the patch wraps the reading
+    @mock.patch("canvas.views.stream_gemini", side_effect=lambda *a, **k: iter(["Hel", "lo"]))
+    def test_relays_chunks_and_saves_reply(self, _):
+        response = self.stream()
+        events = [parse_sse(frame) for frame in response.streaming_content]
+
+        self.assertEqual([name for name, _ in events], ["prompt", "chunk", "chunk", "done"])
+        self.assertEqual("".join(data["text"] for name, data in events if name == "chunk"), "Hello")
+        self.assertEqual(events[-1][1]["model_message"]["content"], "Hello")
+        self.assertEqual(transcript(self.chat_id), [("user", "p1", False), ("model", "Hello", False)])
+
+    @mock.patch("canvas.views.stream_gemini", side_effect=lambda *a, **k: iter(["Hel", "lo"]))
+    def test_disconnect_saves_partial_reply_with_marker(self, _):
+        response = self.stream()
+        frames = response.streaming_content
+        self.assertEqual(parse_sse(next(frames))[0], "prompt")
+        self.assertEqual(parse_sse(next(frames)), ("chunk", {"text": "Hel"}))
+        # The client goes away: the server stops iterating and closes the response. Closing the
+        # test client's iterator does that without request_finished dropping TestCase's connection.
+        response._iterator.close()
+
+        self.assertEqual(
+            transcript(self.chat_id), [("user", "p1", False), ("model", f"Hel\n\n{INTERRUPTED_MARKER}", False)]
+        )
+
+
+class GenerationJobTests(TestCase):
+
+    def setUp(self):
+        self.user_id = create_user()
+        self.chat_id = create_chat(create_workspace(self.user_id))
+        self.client = api_client(self.user_id)
+
+    def enqueue(self, key=None, chat_id=None):
+        headers = {"HTTP_IDEMPOTENCY_KEY": key} if key else {}
+        return self.client.post("/api/canvas/messages/", {
+            "chat_id": str(chat_id or self.chat_id), "content": "Hello", "async": True
+        }, format="json", **headers)
+
+    def prompt_count(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM messages WHERE chat_id = %s AND role = 'user'", [self.chat_id])
+            return cursor.fetchone()[0]
+
+    def test_idempotency_key_returns_original_job(self):
+        first = self.enqueue("retry-1")
+        second = self.enqueue("retry-1")
+
+        self.assertEqual(first.status_code, 202)
+        self.assertEqual(second.status_code, 202)
+        self.assertEqual(first.data["job_id"], second.data["job_id"])
+        self.assertEqual(self.prompt_count(), 1)
+
+        status = self.client.get(f"/api/canvas/jobs/{first.data['job_id']}/")
+        self.assertEqual(status.data["status"], "queued")
+
+    def test_rejects_invalid_idempotency_key(self):
+        self.assertEqual(self.enqueue("k" * 256).status_code, 400)
+        response = self.client.post("/api/canvas/messages/", {
+            "chat_id": str(self.chat_id), "content": "Hello", "async": True, "idempotency_key": ["k"]
+        }, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.prompt_count(), 0)
+
+    def test_claims_one_job_per_chat_at_a_time(self):
+        first = self.enqueue()
+        self.enqueue()
+        other_chat = create_chat(create_workspace(self.user_id, "Other"))
+        other = self.enqueue(chat_id=other_chat)
+
+        claimed = claim_job()
+        self.assertEqual(claimed.id, first.data["job_id"])
+        self.assertEqual(claimed.attempts, 1)
+        # The second job of the same chat waits for the first; the other chat's runs
+        self.assertEqual(claim_job().id, other.data["job_id"])
+        self.assertIsNone(claim_job())
+
+    def test_queued_prompts_are_answered_in_order(self):
+        for content in ("p1", "p2"):
+            self.client.post("/api/canvas/messages/", {
+                "chat_id": str(self.chat_id), "content": content, "async": True
+            }, format="json")
+        histories = []
+
+        def answer(history, prompt, **kwargs):
+            histories.append([m["content"] for m in history])
+            return "r" + prompt[1:]
+
+        with mock.patch("canvas.jobs.ask_gemini", side_effect=answer):
+            run_job(claim_job())
+            run_job(claim_job())
+
+        # p1's job did not see p2, and each reply sits right after its prompt
+        self.assertEqual(histories, [["p1"], ["p1", "r1", "p2"]])
+        self.assertEqual(
+            transcript(self.chat_id),
+            [("user", "p1", False), ("model", "r1", False), ("user", "p2", False), ("model", "r2", False)]
+        )
+
+    def test_other_integrity_errors_are_not_key_races(self):
+        with mock.patch("canvas.views.append_exchange", side_effect=IntegrityError("chat is gone")):
+            with self.assertRaises(IntegrityError):
+                self.enqueue("retry-1")
+
+    def test_skips_chat_another_worker_is_claiming(self):
+        self.enqueue()
+        other = connections.create_connection('default')
+        try:
+            with other.cursor() as cursor:
+                cursor.execute("BEGIN")
+                cursor.execute(
+                    "SELECT pg_advisory_xact_lock(%s, hashtext(%s::text))", [CHAT_LOCK_NAMESPACE, self.chat_id]
+                )
+                self.assertIsNone(claim_job())
+                cursor.execute("ROLLBACK")
+            self.assertIsNotNone(claim_job())
+        finally:
+            other.close()
+
+
+class DeltaSyncTests(TestCase):
+
+    def setUp(self):
+        self.user_id = create_user()
+        self.workspace_id = create_workspace(self.user_id)
+        self.chats = [create_chat(self.workspace_id, f"Chat {i}") for i in range(3)]
+        self.client = api_client(self.user_id)
+
+    def chats_since(self, since=None):
+        params = {"workspace_id": self.workspace_id}
+        if since is not None:
+            params["since"] = since
+        response = self.client.get("/api/canvas/chats/", params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_returns_only_changes_and_deletions(self):
+        version = self.chats_since()["version"]
+
+        self.client.patch(f"/api/canvas/chats/{self.chats[0]}/", {"x_pos": 50}, format="json")
+        self.client.delete(f"/api/canvas/chats/{self.chats[1]}/")
+
+        delta = self.chats_since(version)
+        self.assertEqual([c["id"] for c in delta["data"]], [self.chats[0]])
+        self.assertEqual(delta["deleted"], [self.chats[1]])
+        self.assertGreater(delta["version"], version)
+
+        empty = self.chats_since(delta["version"])
+        self.assertEqual((empty["data"], empty["deleted"]), ([], []))
+
+    def test_deleted_messages_and_links(self):
+        create_messages(self.chats[0], 2)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO message_links (source_message_id, start_offset, end_offset, from_chat_id, to_chat_id)
+                SELECT id, 0, 1, chat_id, %s FROM messages WHERE chat_id = %s AND order_index = 0
+                RETURNING id
+                """,
+                [self.chats[1], self.chats[0]]
+            )
+            link_id = cursor.fetchone()[0]
+            version = self.chats_since()["version"]
+            cursor.execute("DELETE FROM messages WHERE chat_id = %s RETURNING id", [self.chats[0]])
+            message_ids = {r[0] for r in cursor.fetchall()}
+
+        response = self.client.get("/api/canvas/messages/", {"chat_id": self.chats[0], "since": version})
+        self.assertEqual(set(response.data["deleted"]), message_ids)
+        response = self.client.get("/api/canvas/links/", {"workspace_id": self.workspace_id, "since": version})
+        self.assertEqual(response.data["deleted"], [link_id])
+
+    def test_message_changes(self):
+        create_messages(self.chats[0], 2)
+        version = self.chats_since()["version"]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO messages (chat_id, role, content, order_index) VALUES (%s, 'model', 'new', 2)",
+                [self.chats[0]]
+            )
+
+        response = self.client.get("/api/canvas/messages/", {"chat_id": self.chats[0], "since": version})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m["content"] for m in response.data["data"]], ["new"])
+        self.assertFalse(response.data["has_more"])
+
+    def test_messages_of_deleted_chat(self):
+        version = self.chats_since()["version"]
+        # Ownership is still cached from the listing above when the chat disappears
+        self.client.get("/api/canvas/messages/", {"chat_id": self.chats[0]})
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM chats WHERE id = %s", [self.chats[0]])
+
+        response = self.client.get("/api/canvas/messages/", {"chat_id": self.chats[0], "since": version})
+        self.assertEqual(response.status_code, 403)
+
+    def test_rejects_invalid_since(self):
+        response = self.client.get("/api/canvas/chats/", {"workspace_id": self.workspace_id, "since": "x"})
+        self.assertEqual(response.status_code, 400)
+
+
+class AsyncDeltaSyncTests(TransactionTestCase):
+    """
+    The async views read through their own connection pool, which cannot see
+    TestCase's uncommitted rows.
+    """
+
+    def setUp(self):
+        self.user_id = create_user()
+        self.chat_id = create_chat(create_workspace(self.user_id))
+        create_messages(self.chat_id, 3)
+        self.client = api_client(self.user_id)
+
+    def tearDown(self):
+        # The raw-SQL tables are not Django models, so TransactionTestCase's flush skips them
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM users WHERE id = %s", [self.user_id])
+
+    def async_list(self, **params):
+        async def run():
+            request = AsyncRequestFactory().get("/api/canvas/async/messages/", {"chat_id": self.chat_id, **params})
+            try:
+                return await async_views.messages(request)
+            finally:
+                await (await async_db.get_pool()).close()
+
+        user = SimpleNamespace(id=self.user_id, is_authenticated=True)
+        # A pool per event loop: asyncio.run starts a new one each call
+        with mock.patch.object(async_db, "_pool", None), mock.patch.object(async_db, "_pool_lock", None), \
+                mock.patch.object(async_views, "_authenticate", mock.AsyncMock(return_value=user)):
+            response = asyncio.run(run())
+        return response.status_code, json.loads(response.content)
+
+    def test_since_matches_sync_view(self):
+        version = self.client.get("/api/canvas/messages/", {"chat_id": self.chat_id, "since": 0}).data["version"]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT id FROM messages WHERE chat_id = %s ORDER BY order_index", [self.chat_id]
+            )
+            first, second, _ = [str(r[0]) for r in cursor.fetchall()]
+            cursor.execute("DELETE FROM messages WHERE id = %s", [first])
+            cursor.execute("UPDATE messages SET content = 'edited' WHERE id = %s", [second])
+
+        status_code, payload = self.async_list(since=version)
+        self.assertEqual(status_code, 200)
+        self.assertEqual([m["id"] for m in payload["data"]], [second])
+        self.assertEqual(payload["deleted"], [first])
+        self.assertFalse(payload["has_more"])
+
+        expected = self.client.get("/api/canvas/messages/", {"chat_id": self.chat_id, "since": version}).data
+        self.assertEqual(payload["version"], expected["version"])
+        self.assertEqual(payload["deleted"], [str(i) for i in expected["deleted"]])
+
+    def test_invalid_since(self):
+        self.assertEqual(self.async_list(since="yesterday")[0], 400)
+
+
+class SummarySchedulingTests(SimpleTestCase):
+
+    @mock.patch('canvas.summaries.SUMMARY_MAX_PENDING', 2)
+    def test_one_refresh_per_chat_and_bounded_backlog(self):
+        due = summaries.SUMMARY_EVERY + summaries.SUMMARY_KEEP_RECENT
+        with mock.patch.object(summaries, "_executor") as executor, \
+                mock.patch.object(summaries, "_in_flight", set()):
+            self.assertTrue(schedule_summary("a", None, due))
+            self.assertFalse(schedule_summary("a", None, due + 1))
+            # Not due yet
+            self.assertFalse(schedule_summary("b", due, due + 1))
+            self.assertTrue(schedule_summary("b", None, due))
+            # Backlog full
+            self.assertFalse(schedule_summary("c", None, due))
+        self.assertEqual([c.args[1] for c in executor.submit.call_args_list], ["a", "b"])
+
+
+class SummaryRefreshTests(TestCase):
+
+    def setUp(self):
+        self.chat_id = create_chat(create_workspace(create_user()))
+
+    def summary_state(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT summary, summary_through FROM chats WHERE id = %s", [self.chat_id])
+            return cursor.fetchone()
+
+    @mock.patch('canvas.summaries.SUMMARY_BATCH', 50)
+    @mock.patch('canvas.summaries.summarize_conversation')
+    def test_folds_every_message_up_to_the_kept_tail(self, summarize):
+        # More unsummarized messages than the context window loads
+        create_messages(self.chat_id, 120)
+        summarize.side_effect = lambda previous, messages, max_words: f"{previous or ''}|{len(messages)}"
+
+        self.assertTrue(refresh_summary(self.chat_id))
+
+        # 120 messages, the last 6 kept verbatim: 0..113 folded in batches of 50
+        folded = [call.args[1] for call in summarize.call_args_list]
+        self.assertEqual([len(batch) for batch in folded], [50, 50, 14])
+        self.assertEqual(folded[0][0]["content"], "message 0")
+        self.assertEqual(folded[-1][-1]["content"], "message 113")
+        self.assertEqual(self.summary_state(), ("|50|50|14", 113))
+
+    @mock.patch('canvas.summaries.summarize_conversation', side_effect=["first", RuntimeError("overloaded")])
+    @mock.patch('canvas.summaries.SUMMARY_BATCH', 50)
+    def test_failed_batch_keeps_earlier_progress(self, summarize):
+        create_messages(self.chat_id, 120)
+
+        with self.assertRaises(RuntimeError):
+            refresh_summary(self.chat_id)
+        self.assertEqual(self.summary_state(), ("first", 49))
+
+
+class _FailingProvider(FakeProvider):
+
+    def __init__(self, error):
+        super().__init__()
+        self.error = error
+
+    def generate(self, contents):
+        raise self.error
+
+
+def turns(count, length=400):
+    return [
+        {"role": "user" if i % 2 == 0 else "model", "content": f"turn {i} ".ljust(length, "x")}
+        for i in range(count)
+    ]
+
+
+def texts(contents):
+    return [c["parts"][0]["text"] for c in contents]
+
+
+class HistoryQueryTests(TestCase):
+
+    def setUp(self):
+        self.workspace_id = create_workspace(create_user())
+        self.root_id = create_chat(self.workspace_id, "Root")
+        self.add_messages(self.root_id, "root", 5)
+        self.branch_id = self.branch(self.root_id, 2)
+        self.add_messages(self.branch_id, "branch", 3)
+
+    def add_messages(self, chat_id, prefix, count):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO messages (chat_id, role, content, order_index)
+                SELECT %s, 'user', %s || ' ' || i, i FROM generate_series(0, %s - 1) AS i
+                """,
+                [chat_id, prefix, count]
+            )
+
+    def branch(self, chat_id, order_index):
+        branch_id = create_chat(self.workspace_id, "Branch")
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO message_links (source_message_id, start_offset, end_offset, from_chat_id, to_chat_id)
+                SELECT id, 0, 4, chat_id, %s FROM messages WHERE chat_id = %s AND order_index = %s
+                """,
+                [branch_id, chat_id, order_index]
+            )
+        return branch_id
+
+    def context(self, chat_id, **kwargs):
+        with connection.cursor() as cursor:
+            return load_context(cursor, chat_id, **kwargs)
+
+    def test_branch_inherits_ancestors_up_to_the_branch_point(self):
+        leaf_id = self.branch(self.branch_id, 1)
+        self.add_messages(leaf_id, "leaf", 1)
+        with connection.cursor() as cursor:
+            # A reply slot in the parent is no context for anyone
+            cursor.execute(
+                "UPDATE messages SET is_hidden = TRUE WHERE chat_id = %s AND order_index = 0", [self.branch_id]
+            )
+
+        context = self.context(leaf_id)
+
+        self.assertEqual(
+            [turn["content"] for turn in context.history],
+            ["root 0", "root 1", "root 2", "branch 1", "leaf 0"]
+        )
+        self.assertEqual(context.inherited, 4)
+        self.assertEqual(context.highlight, "bran")
+
+    def test_ancestors_are_capped_per_level(self):
+        with mock.patch("canvas.context.BRANCH_CONTEXT_DEPTH", 2):
+            context = self.context(self.branch_id)
+        self.assertEqual(
+            [turn["content"] for turn in context.history], ["root 1", "root 2", "branch 0", "branch 1", "branch 2"]
+        )
+
+    def test_summary_floor_skips_folded_messages_and_ancestors(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE chats SET summary = 'earlier', summary_through = 0 WHERE id = %s", [self.branch_id]
+            )
+
+        context = self.context(self.branch_id)
+
+        # The first summary already absorbed the inherited context
+        self.assertEqual([turn["content"] for turn in context.history], ["branch 1", "branch 2"])
+        self.assertEqual((context.summary, context.summary_through, context.inherited), ("earlier", 0, 0))
+
+    def test_upto_stops_at_the_prompt_being_answered(self):
+        context = self.context(self.branch_id, upto=1)
+        self.assertEqual(
+            [turn["content"] for turn in context.history], ["root 0", "root 1", "root 2", "branch 0", "branch 1"]
+        )
+
+
+class BuildContentsTests(SimpleTestCase):
+
+    def test_drops_the_saved_prompt_from_history(self):
+        history = turns(2) + [{"role": "user", "content": "Next?"}]
+        contents, _ = build_contents(history, "Next?")
+        self.assertEqual(texts(contents)[:-1], [m["content"] for m in history[:2]])
+        self.assertTrue(texts(contents)[-1].endswith("Next?"))
+
+        # An earlier, identical question is still history
+        contents, _ = build_contents(history[:2] + [{"role": "model", "content": "Next?"}], "Next?")
+        self.assertEqual(len(contents), 4)
+
+    def test_drops_oldest_turns_over_budget(self):
+        history = turns(10)
+        instruction_tokens = estimate_tokens("Instruction: Answer in plain text (paragraphs): Next?")
+        # Room for three whole turns (100 tokens each) and 50 tokens of the fourth newest
+        contents, used = build_contents(history, "Next?", budget=instruction_tokens + 350)
+
+        sent = texts(contents)[:-1]
+        self.assertEqual(sent[1:], [m["content"] for m in history[-3:]])
+        self.assertTrue(sent[0].startswith("turn 6 ") and sent[0].endswith(TRUNCATION_MARKER))
+        self.assertLessEqual(used, instruction_tokens + 350)
+
+    def test_long_turn_is_truncated(self):
+        history = turns(1, length=40000) + turns(1)
+        contents, _ = build_contents(history, "Next?")
+        long_turn = texts(contents)[0]
+        self.assertEqual(len(long_turn), 8000)
+        self.assertTrue(long_turn.endswith(TRUNCATION_MARKER))
+        # The newest turn is untouched
+        self.assertEqual(texts(contents)[1], history[1]["content"])
+
+    def test_summary_and_highlight_frame_the_conversation(self):
+        history = turns(2)
+        contents, used = build_contents(history, "Next?", highlight="a passage", summary="Earlier talk")
+        sent = texts(contents)
+
+        self.assertEqual(sent[0], "Summary of the earlier conversation: Earlier talk")
+        self.assertEqual(sent[1:3], [m["content"] for m in history])
+        self.assertTrue(sent[3].startswith('Highlighted passage this conversation branched from: "a passage"'))
+        self.assertTrue(sent[3].endswith("Instruction: Answer in plain text (paragraphs): Next?"))
+        self.assertEqual(used, sum(estimate_tokens(text) for text in sent))
+
+
+class PrefixCachePlanTests(SimpleTestCase):
+
+    def setUp(self):
+        self.provider = FakeProvider()
+        self.cache = PrefixCache(self.provider, LRUCache(), min_tokens=100)
+        patcher = mock.patch.object(ai_services, 'prefix_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(ai_services, 'get_llm', return_value=self.provider)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def plan(self, inherited_chars, own_chars, own_count=20):
+        inherited = [{"role": "model", "content": "p" * inherited_chars}]
+        own = [{"role": "user" if i % 2 else "model", "content": f"{i} " + "o" * own_chars} for i in range(own_count)]
+        # The second sighting of a prefix creates its cache entry
+        ai_services._plan_request(inherited + own, "Next?", inherited=1)
+        return ai_services._plan_request(inherited + own, "Next?", inherited=1)
+
+    def test_prefix_and_suffix_share_the_budget(self):
+        plan = self.plan(inherited_chars=6000 * 4, own_chars=1500 * 4)
+
+        self.assertIsNotNone(plan.cached_prefix)
+        self.assertEqual(plan.cached_tokens, 6000)
+        self.assertLessEqual(plan.tokens + plan.cached_tokens, CONTEXT_TOKEN_BUDGET)
+        self.assertLessEqual(plan.full_tokens, CONTEXT_TOKEN_BUDGET)
+
+    def test_prefix_over_budget_is_sent_inline(self):
+        plan = self.plan(inherited_chars=CONTEXT_TOKEN_BUDGET * 4, own_chars=10)
+        self.assertIsNone(plan.cached_prefix)
+
+    def test_falls_back_only_when_cache_is_missing(self):
+        plan = self.plan(inherited_chars=6000 * 4, own_chars=100)
+
+        expired = plan._replace(provider=_FailingProvider(LLMError("CachedContent not found", status=404)))
+        self.assertTrue(ai_services._generate(expired).startswith("[fake:"))
+
+        overloaded = plan._replace(provider=_FailingProvider(LLMError("Resource exhausted", status=429)))
+        with self.assertRaises(LLMError):
+            ai_services._generate(overloaded)
+
+
+class _SlowCacheProvider(FakeProvider):
+
+    def create_cache(self, contents, ttl_seconds):
+        # Blocks like the SDK's upload with retry backoff
+        time.sleep(0.3)
+        return super().create_cache(contents, ttl_seconds)
+
+
+class AsyncPrefixCacheTests(SimpleTestCase):
+
+    def test_cache_creation_does_not_block_the_event_loop(self):
+        provider = _SlowCacheProvider()
+        cache = PrefixCache(provider, LRUCache(), min_tokens=100)
+        history = [{"role": "model", "content": "p" * 4000}, {"role": "user", "content": "Own turn"}]
+        # First sighting, so the next request creates the cache
+        cache.provider_for(to_contents(history[:1]), 1000)
+
+        async def ticker(stop):
+            ticks = 0
+            while not stop.is_set():
+                await asyncio.sleep(0.01)
+                ticks += 1
+            return ticks
+
+        async def run():
+            stop = asyncio.Event()
+            ticks = asyncio.ensure_future(ticker(stop))
+            answer = await ai_services.ask_gemini_async(history, "Next?", use_cache=False, inherited=1)
+            stop.set()
+            return answer, await ticks
+
+        with mock.patch.object(ai_services, 'prefix_cache', cache), \
+                mock.patch.object(ai_services, 'get_llm', return_value=provider):
+            answer, ticks = asyncio.run(run())
+
+        self.assertEqual(cache.creates, 1)
+        self.assertTrue(answer.startswith("[fake:"))
+        # A blocked loop would tick once at most while the 0.3s upload runs
+        self.assertGreater(ticks, 10)
+
+
+class RequestKeyTests(SimpleTestCase):
+
+    def test_whitespace_is_significant(self):
+        def contents(text):
+            return [{"role": "user", "parts": [{"text": text}]}]
+
+        key = ai_services.request_key("fake", contents("def f():\n    return 1"))
+        self.assertEqual(key, ai_services.request_key("fake", contents("def f():\n    return 1")))
+        self.assertNotEqual(key, ai_services.request_key("fake", contents("def f(): return 1")))
+
+
+class CompressionNegotiationTests(SimpleTestCase):
+
+    def negotiate(self, header):
+        request = RequestFactory().get("/", headers={"Accept-Encoding": header})
+        with mock.patch.object(compression, "ENCODINGS", ["br", "gzip"]):
+            return compression._negotiate(request)
+
+    def test_client_q_wins_over_server_order(self):
+        self.assertEqual(self.negotiate("br;q=0.5, gzip;q=1.0"), "gzip")
+
+    def test_server_order_breaks_ties(self):
+        self.assertEqual(self.negotiate("gzip, br"), "br")
+        self.assertEqual(self.negotiate("*"), "br")
+
+    def test_refused_codings(self):
+        self.assertEqual(self.negotiate("br;q=0, *;q=0.1"), "gzip")
+        self.assertIsNone(self.negotiate("identity"))
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not reached")
+        time.sleep(0.001)
+
+
+class FairLimiterTests(SimpleTestCase):
+
+    def test_round_robin_between_users(self):
+        limiter = FairLimiter(max_concurrent=1, max_wait=5)
+        limiter.acquire("holder")
+        order = []
+        threads = []
+        # The heavy user queues three requests before the light user's one
+        for name in ("heavy-1", "heavy-2", "heavy-3", "light-1"):
+            user = name.split("-")[0]
+            thread = threading.Thread(target=limiter.run, args=(user, lambda name=name: order.append(name)))
+            thread.start()
+            threads.append(thread)
+            wait_until(lambda: limiter.stats()["waiting"] == len(threads))
+
+        limiter.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ["heavy-1", "light-1", "heavy-2", "heavy-3"])
+        self.assertEqual(limiter.stats()["active"], 0)
+
+    def test_max_wait_raises_busy(self):
+        limiter = FairLimiter(max_concurrent=1, max_wait=0.05)
+        limiter.acquire("a")
+        with self.assertRaises(LLMBusyError) as raised:
+            limiter.acquire("b")
+        self.assertEqual(raised.exception.status, 503)
+        self.assertEqual(limiter.stats()["rejected"], 1)
+
+    def test_timed_out_waiter_leaves_slot_to_next(self):
+        limiter = FairLimiter(max_concurrent=1, max_wait=0.3)
+
+        async def run():
+            await limiter.aacquire("holder")
+            first = asyncio.ensure_future(limiter.aacquire("a"))
+            await asyncio.sleep(0.15)
+            second = asyncio.ensure_future(limiter.arun("b", lambda: asyncio.sleep(0, "b ran")))
+            await asyncio.sleep(0)
+            with self.assertRaises(LLMBusyError):
+                await first
+            limiter.release()
+            return await second
+
+        self.assertEqual(asyncio.run(run()), "b ran")
+        self.assertEqual(limiter.stats()["active"], 0)
+        self.assertEqual(limiter.stats()["waiting"], 0)
+
+    def test_cancelled_waiter_hands_granted_slot_on(self):
+        limiter = FairLimiter(max_concurrent=1, max_wait=5)
+
+        async def run():
+            await limiter.aacquire("holder")
+            first = asyncio.ensure_future(limiter.aacquire("a"))
+            second = asyncio.ensure_future(limiter.arun("b", lambda: asyncio.sleep(0, "b ran")))
+            await asyncio.sleep(0)
+            # The slot goes to "a", whose client disconnects before it resumes
+            limiter.release()
+            first.cancel()
+            results = await asyncio.gather(first, second, return_exceptions=True)
+            return results
+
+        first, second = asyncio.run(run())
+        self.assertIsInstance(first, asyncio.CancelledError)
+        self.assertEqual(second, "b ran")
+        self.assertEqual(limiter.stats()["active"], 0)
+
+
+class SingleFlightTests(SimpleTestCase):
+
+    def test_do_coalesces_concurrent_callers(self):
+        flight = SingleFlight()
+        started, proceed = threading.Event(), threading.Event()
+        calls = []
+
+        def leader_call():
+            calls.append(1)
+            started.set()
+            proceed.wait()
+            return "answer"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do("key", leader_call)))]
+        threads[0].start()
+        started.wait()
+        for _ in range(3):
+            threads.append(threading.Thread(target=lambda: results.append(flight.do("key", leader_call))))
+            threads[-1].start()
+        wait_until(lambda: flight.coalesced == 3)
+        proceed.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ["answer"] * 4)
+        self.assertEqual(len(calls), 1)
+
+    def test_do_shares_the_leaders_exception(self):
+        flight = SingleFlight()
+        started, proceed = threading.Event(), threading.Event()
+
+        def failing():
+            started.set()
+            proceed.wait()
+            raise LLMError("Rate limited", status=429)
+
+        errors = []
+
+        def call():
+            try:
+                flight.do("key", failing)
+            except LLMError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call)]
+        threads[0].start()
+        started.wait()
+        threads.append(threading.Thread(target=call))
+        threads[-1].start()
+        wait_until(lambda: flight.coalesced == 1)
+        proceed.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(errors), 2)
+        self.assertIs(errors[0], errors[1])
+
+    def test_ado_coalesces_and_shares_exceptions(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def answer():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "answer"
+
+        async def fail():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            raise LLMError("Rate limited", status=429)
+
+        async def run():
+            answers = await asyncio.gather(*(flight.ado("ok", answer) for _ in range(3)))
+            errors = await asyncio.gather(*(flight.ado("bad", fail) for _ in range(3)), return_exceptions=True)
+            return answers, errors
+
+        answers, errors = asyncio.run(run())
+        self.assertEqual(answers, ["answer"] * 3)
+        self.assertTrue(all(isinstance(e, LLMError) and e.status == 429 for e in errors))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(flight.coalesced, 4)
+
+
+class CacheRateLimiterTests(SimpleTestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_budget_resets_with_the_next_window(self):
+        limiter = CacheRateLimiter(per_minute=2)
+        with mock.patch("services.limiter.time.time", return_value=60 * 1000 + 59.5):
+            self.assertEqual([limiter.wait_time(), limiter.wait_time()], [0, 0])
+            self.assertAlmostEqual(limiter.wait_time(), 0.5)
+        with mock.patch("services.limiter.time.time", return_value=60 * 1001 + 0.1):
+            self.assertEqual(limiter.wait_time(), 0)
+
+    def test_async_budget(self):
+        limiter = CacheRateLimiter(per_minute=1)
+
+        async def run():
+            return [await limiter.await_time(), await limiter.await_time()]
+
+        with mock.patch("services.limiter.time.time", return_value=60 * 2000 + 30):
+            self.assertEqual(asyncio.run(run()), [0, 30])
+
+
+class ProviderError(Exception):
+
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+
+
+def failing(*statuses, result="ok"):
+    """
+    Returns a call that raises ProviderError for each status in turn, then returns `result`.
+    """
+    pending = list(statuses)
+
+    def call():
+        call.count += 1
+        if pending:
+            raise ProviderError(pending.pop(0))
+        return result
+
+    call.count = 0
+    return call
+
+
+@mock.patch("services.llm.time.sleep")
+class RetryPolicyTests(SimpleTestCase):
+
+    def test_retries_rate_limits_and_server_errors(self, sleep):
+        call = failing(429, 503)
+        self.assertEqual(RetryPolicy(max_retries=3).call(call), "ok")
+        self.assertEqual((call.count, sleep.call_count), (3, 2))
+
+    def test_client_errors_are_not_retried(self, sleep):
+        call = failing(400)
+        with self.assertRaises(LLMError) as raised:
+            RetryPolicy(max_retries=3).call(call)
+        self.assertEqual(raised.exception.status, 400)
+        self.assertEqual((call.count, sleep.call_count), (1, 0))
+
+    def test_status_survives_exhaustion(self, sleep):
+        call = failing(503, 503, 503)
+        with self.assertRaises(LLMError) as raised:
+            RetryPolicy(max_retries=2).call(call)
+        self.assertEqual(raised.exception.status, 503)
+        self.assertEqual(call.count, 3)
+        self.assertIsInstance(raised.exception.__cause__, ProviderError)
+
+    def test_async_call(self, sleep):
+        call = failing(502)
+
+        async def acall():
+            return call()
+
+        with mock.patch("services.llm.asyncio.sleep", new_callable=mock.AsyncMock) as asleep:
+            self.assertEqual(asyncio.run(RetryPolicy(max_retries=1).acall(acall)), "ok")
+            self.assertEqual(asleep.await_count, 1)
+
+        call = failing(429, 429)
+        with mock.patch("services.llm.asyncio.sleep", new_callable=mock.AsyncMock):
+            with self.assertRaises(LLMError) as raised:
+                asyncio.run(RetryPolicy(max_retries=1).acall(acall))
+        self.assertEqual(raised.exception.status, 429)
+        sleep.assert_not_called()
+
+
+class ProviderTests(SimpleTestCase):
+
+    def test_unknown_provider(self):
+        with self.assertRaises(ValueError):
+            build_provider({"PROVIDER": "nope"})
+
+    def test_unknown_cache_handle_reads_as_expired(self):
+        provider = FakeProvider()
+        with self.assertRaises(LLMError) as raised:
+            provider.bind_cache("fake-cache/missing")
+        self.assertEqual(raised.exception.status, 404)
+        self.assertTrue(is_cache_missing(raised.exception))
+
+        handle = provider.create_cache([{"role": "user", "parts": [{"text": "Hi"}]}], ttl_seconds=60)
+        self.assertEqual(provider.bind_cache(handle).prefix[0]["parts"][0]["text"], "Hi")
+
+
+class RealtimeRecheckTests(TransactionTestCase):
+    """
+    Runs the WebSocket app against committed rows: it reads through the async pool.
+    """
+
+    def setUp(self):
+        self.user_id = str(create_user())
+        self.workspace_id = str(create_workspace(self.user_id))
+        self.chat_id = str(create_chat(self.workspace_id))
+        self.token = UserViewSet().get_tokens_for_user(self.user_id)['access']
+
+    def tearDown(self):
+        # The raw-SQL tables are not Django models, so TransactionTestCase's flush skips them
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM users WHERE id = %s", [self.user_id])
+            cursor.execute("DELETE FROM token_versions WHERE user_id = %s", [self.user_id])
+
+    def run_socket(self, after_accept):
+        """
+        Connects, runs `after_accept(communicator)` and returns what it returns.
+        The Postgres listener is replaced by direct `hub._dispatch` calls.
+        """
+        async def run():
+            communicator = ApplicationCommunicator(realtime.websocket_app, {
+                "type": "websocket",
+                "path": f"/ws/workspaces/{self.workspace_id}/",
+                "query_string": f"token={self.token}".encode(),
+            })
+            try:
+                await communicator.send_input({"type": "websocket.connect"})
+                self.assertEqual(await communicator.receive_output(2), {"type": "websocket.accept"})
+                return await after_accept(communicator)
+            finally:
+                await communicator.send_input({"type": "websocket.disconnect", "code": 1000})
+                await communicator.wait(2)
+                await (await async_db.get_pool()).close()
+
+        with mock.patch.object(async_db, "_pool", None), mock.patch.object(async_db, "_pool_lock", None), \
+                mock.patch.object(realtime.Hub, "_listen", mock.AsyncMock()), \
+                mock.patch.object(revocations, "refresh_seconds", 0):
+            return asyncio.run(run())
+
+    def event(self, name, data):
+        realtime.hub._dispatch(json.dumps({"workspace_id": self.workspace_id, "event": name, "data": data}))
+
+    def test_events_flow_while_checks_pass(self):
+        async def after_accept(communicator):
+            self.event("chat.deleted", {"id": "00000000-0000-0000-0000-000000000000"})
+            return await communicator.receive_output(2)
+
+        frame = self.run_socket(after_accept)
+        self.assertEqual(json.loads(frame["text"])["event"], "chat.deleted")
+
+    def test_revoked_token_drops_socket(self):
+        async def after_accept(communicator):
+            # Revoked by another process: reaches this one through the mirror's refresh
+            await async_db.fetch_one(BUMP_VERSION_SQL, [self.user_id])
+            self.event("chat.updated", {"chats": []})
+            return await communicator.receive_output(2)
+
+        self.assertEqual(self.run_socket(after_accept), {"type": "websocket.close", "code": 4401})
+
+    def test_deleted_workspace_drops_socket(self):
+        async def after_accept(communicator):
+            await async_db.fetch_one(
+                "DELETE FROM workspaces WHERE id = %s RETURNING id", [self.workspace_id]
+            )
+            self.event("chat.deleted", {"id": self.chat_id})
+            return await communicator.receive_output(2)
+
+        self.assertEqual(self.run_socket(after_accept), {"type": "websocket.close", "code": 4403})
+
+
+class ORJSONRendererTests(SimpleTestCase):
+
+    def assertSameAsDRF(self, data):
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_matches_drf_output(self):
+        self.assertSameAsDRF({
+            "id": uuid.UUID("12345678-1234-5678-1234-567812345678"),
+            "created_at": datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=timezone.utc),
+            "day": date(2024, 5, 1),
+            "score": Decimal("1.5"),
+            "content": "Grüße, 你好 \"quoted\" \\ \n",
+            "items": [1, 2.5, None, True],
+        })
+
+    def test_escapes_line_and_paragraph_separators(self):
+        data = {"content": "one\u2028two\u2029three"}
+        self.assertSameAsDRF(data)
+        self.assertIn(b"\\u2028", ORJSONRenderer().render(data))
+
+    def test_refused_data_falls_back(self):
+        self.assertSameAsDRF({"big": 2 ** 70})
+
+    @mock.patch.object(ORJSONRenderer, "ensure_ascii", True)
+    def test_ascii_only_output_falls_back(self):
+        self.assertEqual(ORJSONRenderer().render({"content": "Grüße"}), b'{"content":"Gr\\u00fc\\u00dfe"}')
@@ -1,12 +1,17 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import ChatViewSet, MessageViewSet, LinkViewSet
+from .views import ChatViewSet, MessageViewSet, JobViewSet, LinkViewSet
+from . import async_views
 
 router = DefaultRouter()
 router.register(r'chats', ChatViewSet, basename='chats')
 router.register(r'messages', MessageViewSet, basename='messages')
+router.register(r'jobs', JobViewSet, basename='jobs')
 router.register(r'links', LinkViewSet, basename='links')
 
 urlpatterns = [
+    # ASGI-native variants of the hot read/chat paths
+    path('async/chats/', async_views.chat_list, name='async-chats'),
+    path('async/messages/', async_views.messages, name='async-messages'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
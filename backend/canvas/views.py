@@ -1,7 +1,53 @@
+import json
+import uuid
+
 from rest_framework import viewsets, status, permissions
 from rest_framework.response import Response
-from django.db import connection, transaction
-from .ai_services import ask_gemini
+from rest_framework.decorators import action
+from rest_framework.utils.encoders import JSONEncoder
+from django.db import IntegrityError, connection, transaction
+from django.http import StreamingHttpResponse
+from django.urls import reverse
+from services.db import Query, fetch_all, fetch_one
+from services.limiter import is_overloaded, retry_after
+from services.routing import mark_write, read_connection
+from workspaces.permissions import IsChatOwner, ownership
+from .ai_services import ask_gemini, stream_gemini
+from .context import load_context
+from .jobs import MAX_IDEMPOTENCY_KEY_LENGTH, enqueue_job, find_job, get_job
+from .persistence import (
+    append_exchange, delete_message, fill_reply, lock_chat_workspace, notify, notify_layout, release_reply
+)
+from .summaries import schedule_summary
+from .pagination import CursorError, MAX_PAGE_SIZE, parse_cursor, page_query, build_page
+from .sync import (
+    CHANGED_MESSAGES_QUERY, CHAT_VERSION_QUERY, VERSION_QUERY, SinceError, cap_message_delta, delta_payload,
+    fetch_deleted, parse_since, since_clause
+)
+
+# Appended to a streamed reply that was cut short by the client disconnecting
+INTERRUPTED_MARKER = "[Response interrupted]"
+
+# Columns of a chat window as returned by `ChatViewSet.list` and pushed in `chat.created` events
+CHAT_COLUMNS = ['id', 'title', 'x_pos', 'y_pos', 'width', 'height', 'z_index', 'created_at']
+LINK_COLUMNS = ['id', 'source_message_id', 'start_offset', 'end_offset', 'from_chat_id', 'to_chat_id', 'created_at']
+
+# Layout fields accepted by the bulk layout endpoint, with their SQL types
+LAYOUT_FIELDS = [('x_pos', 'float8'), ('y_pos', 'float8'), ('width', 'int'), ('height', 'int'), ('z_index', 'int')]
+MAX_LAYOUT_BATCH = 500
+
+# Named for the timing in `services.db`; the SQL strings are shared with the async views
+WORKSPACE_VERSION_QUERY = Query("workspaces.version", VERSION_QUERY)
+CHAT_WORKSPACE_VERSION_QUERY = Query("chats.version", CHAT_VERSION_QUERY)
+MESSAGES_SINCE_QUERY = Query("messages.since", CHANGED_MESSAGES_QUERY)
+
+
+def _sse(event, payload):
+    """
+    Formats a single Server-Sent Event frame. Uses DRF's encoder so UUIDs and
+    timestamps serialize the same way they do in regular JSON responses.
+    """
+    return f"event: {event}\ndata: {json.dumps(payload, cls=JSONEncoder)}\n\n"
 
 class ChatViewSet(viewsets.ViewSet):
     """
@@ -11,20 +57,19 @@ class ChatViewSet(viewsets.ViewSet):
     
     permission_classes = [permissions.IsAuthenticated]
 
-    def _verify_workspace_ownership(self, user_id, workspace_id):
-        """
-        Internal Utility: Validates that the workspace belongs to the authenticated user.
-        """
-        query = "SELECT id FROM workspaces WHERE id = %s AND user_id = %s"
-        with connection.cursor() as cursor:
-            cursor.execute(query, [workspace_id, user_id])
-            return cursor.fetchone() is not None
+    def get_permissions(self):
+        # The other actions check ownership inside their own statements
+        if self.action == 'partial_update':
+            return [permissions.IsAuthenticated(), IsChatOwner()]
+        return super().get_permissions()
 
     def list(self, request):
         """
-        GET /canvas/chats/?workspace_id={uuid}
+        GET /canvas/chats/?workspace_id={uuid}&since={version}
         Retrieves all chat windows for a specific workspace.
         Used to hydrate the canvas layout on initial load.
+        With `since`, only windows changed after that version plus the ids of deleted
+        ones are returned (see `canvas.sync`).
         """
         workspace_id = request.query_params.get('workspace_id')
         current_user_id = request.user.id
@@ -32,21 +77,27 @@ class ChatViewSet(viewsets.ViewSet):
         if not workspace_id:
             return Response({"error": "workspace_id is required"}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Ensure the user owns the workspace they are trying to view
-        if not self._verify_workspace_ownership(current_user_id, workspace_id):
-            return Response({"error": "Forbidden: Workspace access denied"}, status=status.HTTP_403_FORBIDDEN)
+        try:
+            since = parse_since(request.query_params)
+        except SinceError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-        query = """
+        changed, changed_params = since_clause('chats', since)
+        query = f"""
             SELECT id, title, x_pos, y_pos, width, height, z_index, created_at 
             FROM chats 
-            WHERE workspace_id = %s
+            WHERE workspace_id = %s {changed}
             ORDER BY created_at ASC
         """
-        with connection.cursor() as cursor:
-            cursor.execute(query, [workspace_id])
-            columns = [col[0] for col in cursor.description]
-            rows = cursor.fetchall()
-            return Response({"data": [dict(zip(columns, r)) for r in rows]})
+        db = read_connection(current_user_id)
+        # Ensure the user owns the workspace they are trying to view (and read its version)
+        row = fetch_one(WORKSPACE_VERSION_QUERY, [workspace_id, current_user_id], using=db, as_dicts=False)
+        if not row:
+            return Response({"error": "Forbidden: Workspace access denied"}, status=status.HTTP_403_FORBIDDEN)
+
+        rows = fetch_all(Query("chats.list", query), [workspace_id, *changed_params], using=db)
+        deleted = fetch_deleted(workspace_id, 'chats', since, using=db) if since is not None else []
+        return Response(delta_payload(rows, row[0], since, deleted))
 
     def create(self, request):
         """
@@ -54,6 +105,11 @@ class ChatViewSet(viewsets.ViewSet):
         Creates a new chat window. 
         If 'source_message_id' is provided, it automatically creates a 'message_link' (Arrow),
         implementing the seamless branching feature.
+
+        The ownership check, the chat and the link are written by a single
+        statement, so a branch costs one round trip. No parent messages are
+        copied: the branch inherits them through the link (see `canvas.context`).
+        Publishes `chat.created` (and `link.created`) to the workspace's listeners.
         """
         data = request.data
         user_id = request.user.id
@@ -66,71 +122,77 @@ class ChatViewSet(viewsets.ViewSet):
         source_message_id = data.get('source_message_id')
         start_offset = data.get('start_offset')
         end_offset = data.get('end_offset')
-
-        if not self._verify_workspace_ownership(user_id, workspace_id):
-            return Response({"error": "Forbidden: Workspace access denied"}, status=status.HTTP_403_FORBIDDEN)
+        is_branch = source_message_id and start_offset is not None and end_offset is not None
+
+        # 1. Create the New Chat Window, only if the user owns the workspace
+        new_chat_cte = f"""
+            new_chat AS (
+                INSERT INTO chats (workspace_id, title, x_pos, y_pos)
+                SELECT id, %s, %s, %s FROM workspaces WHERE id = %s AND user_id = %s
+                RETURNING {", ".join(CHAT_COLUMNS)}
+            )
+        """
+        params = [title, x_pos, y_pos, workspace_id, user_id]
+
+        if is_branch:
+            query = f"""
+                WITH {new_chat_cte},
+                -- The source message must live in the same workspace
+                source AS (
+                    SELECT m.chat_id FROM messages m
+                    JOIN chats c ON m.chat_id = c.id
+                    WHERE m.id = %s AND c.workspace_id = %s
+                ),
+                -- 2. The visual link (The Arrow)
+                link AS (
+                    INSERT INTO message_links
+                    (source_message_id, start_offset, end_offset, from_chat_id, to_chat_id)
+                    SELECT %s, %s, %s, source.chat_id, new_chat.id FROM source, new_chat
+                    RETURNING {", ".join(LINK_COLUMNS)}
+                )
+                SELECT new_chat.*, to_jsonb(link) FROM new_chat LEFT JOIN link ON TRUE
+            """
+            params += [
+                source_message_id, workspace_id,
+                source_message_id, start_offset, end_offset,
+            ]
+        else:
+            query = f"WITH {new_chat_cte} SELECT new_chat.*, NULL::jsonb FROM new_chat"
 
         try:
             with transaction.atomic():
                 with connection.cursor() as cursor:
-                    # 1. Create the New Chat Window
-                    cursor.execute(
-                        "INSERT INTO chats (workspace_id, title, x_pos, y_pos) VALUES (%s, %s, %s, %s) RETURNING id",
-                        [workspace_id, title, x_pos, y_pos]
-                    )
-                    new_chat_id = cursor.fetchone()[0]
-
-                    # 2. If this is a branched chat, create the visual link (The Arrow)
-                    link_id = None
-                    if source_message_id and start_offset is not None and end_offset is not None:
-                        # We need to find which chat the source message belonged to
-                        cursor.execute("SELECT chat_id FROM messages WHERE id = %s", [source_message_id])
-                        from_chat_row = cursor.fetchone()
-                        
-                        if from_chat_row:
-                            from_chat_id = from_chat_row[0]
-                            cursor.execute(
-                                """
-                                INSERT INTO message_links 
-                                (source_message_id, start_offset, end_offset, from_chat_id, to_chat_id)
-                                VALUES (%s, %s, %s, %s, %s) RETURNING id
-                                """,
-                                [source_message_id, start_offset, end_offset, from_chat_id, new_chat_id]
-                            )
-                            link_id = cursor.fetchone()[0]
-                        
-                        # 3. Fetch last 10 messages from parent
-                        cursor.execute(
-                            "SELECT role, content FROM messages WHERE chat_id = %s ORDER BY order_index DESC LIMIT 10", 
-                            [from_chat_id]
-                        )
-                        parent_history = reversed(cursor.fetchall())
-
-                        # 4. Inject into NEW chat but hide them from the UI
-                        for idx, (role, content) in enumerate(parent_history):
-                            cursor.execute(
-                                """
-                                INSERT INTO messages (chat_id, role, content, order_index, is_hidden) 
-                                VALUES (%s, %s, %s, %s, TRUE)
-                                """,
-                                [new_chat_id, role, content, idx]
-                            )
-
-                    return Response({
-                        "chat_id": new_chat_id,
-                        "link_id": link_id,
-                        "message": "Chat branched successfully" if link_id else "Chat created"
-                    }, status=status.HTTP_201_CREATED)
+                    cursor.execute(query, params)
+                    row = cursor.fetchone()
+                    if row:
+                        chat = dict(zip(CHAT_COLUMNS, row[:-1]))
+                        # Django's cursor hands jsonb back undecoded
+                        link = json.loads(row[-1]) if row[-1] else None
+                        notify(cursor, workspace_id, "chat.created", chat)
+                        if link:
+                            notify(cursor, workspace_id, "link.created", link)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
+        if not row:
+            return Response({"error": "Forbidden: Workspace access denied"}, status=status.HTTP_403_FORBIDDEN)
+
+        new_chat_id = chat['id']
+        link_id = link['id'] if link else None
+        # The first prompt in the new window skips the ownership query
+        ownership.remember_chat(user_id, new_chat_id, workspace_id)
+        return Response({
+            "chat_id": new_chat_id,
+            "link_id": link_id,
+            "message": "Chat branched successfully" if link_id else "Chat created"
+        }, status=status.HTTP_201_CREATED)
+
     def partial_update(self, request, pk=None):
         """
         PATCH /canvas/chats/{id}/
         Updates window metadata (position, size, z-index).
         Designed to be called by the frontend's debounced auto-save logic.
         """
-        user_id = request.user.id
         data = request.data
         
         # Fields allowed for layout updates
@@ -140,26 +202,105 @@ class ChatViewSet(viewsets.ViewSet):
         if not update_data:
             return Response({"error": "No valid fields provided"}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Ownership check: Ensure chat belongs to a workspace owned by the user
-        check_query = """
-            SELECT c.id FROM chats c 
-            JOIN workspaces w ON c.workspace_id = w.id 
-            WHERE c.id = %s AND w.user_id = %s
-        """
-        
         with connection.cursor() as cursor:
-            cursor.execute(check_query, [pk, user_id])
-            if not cursor.fetchone():
-                return Response({"error": "Forbidden"}, status=status.HTTP_403_FORBIDDEN)
-
             # Build dynamic SQL update string
             set_clause = ", ".join([f"{k} = %s" for k in update_data.keys()])
             params = list(update_data.values()) + [pk]
             
-            cursor.execute(f"UPDATE chats SET {set_clause} WHERE id = %s", params)
+            with transaction.atomic():
+                # Workspace first: the change-version trigger takes the same lock
+                lock_chat_workspace(cursor, pk)
+                cursor.execute(
+                    f"UPDATE chats SET {set_clause} WHERE id = %s RETURNING workspace_id, id, {', '.join(update_data)}",
+                    params
+                )
+                rows = cursor.fetchall()
+                # The ownership check may be answered from the cache: the chat can be gone by now
+                if not rows:
+                    return Response({"error": "Not found or access denied"}, status=status.HTTP_404_NOT_FOUND)
+                notify_layout(cursor, rows, ['id', *update_data])
 
         return Response({"message": "Layout saved"})
 
+    @action(detail=False, methods=['post', 'patch'])
+    def layout(self, request):
+        """
+        POST/PATCH /canvas/chats/layout/
+        Bulk variant of `partial_update` for group drags and z-index re-stacking.
+        Body: {"chats": [{"id": uuid, "x_pos": .., "y_pos": .., "width": .., "height": .., "z_index": ..}, ...]}
+        Omitted fields keep their current value. The batch is all-or-nothing: if any id
+        is missing or belongs to another user, nothing is written.
+        """
+        user_id = request.user.id
+        entries = request.data.get('chats')
+
+        if not isinstance(entries, list) or not entries:
+            return Response({"error": "chats must be a non-empty list"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(entries) > MAX_LAYOUT_BATCH:
+            return Response({"error": f"At most {MAX_LAYOUT_BATCH} chats per batch"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Later entries for the same window win, matching sequential PATCHes
+        updates = {}
+        for entry in entries:
+            if not isinstance(entry, dict) or not entry.get('id'):
+                return Response({"error": "Every entry needs an id"}, status=status.HTTP_400_BAD_REQUEST)
+            # Canonical form, so the same window spelled in upper case or without dashes
+            # collapses into one entry and the ownership count below stays exact
+            try:
+                chat_id = str(uuid.UUID(str(entry['id'])))
+            except ValueError:
+                return Response({"error": f"Invalid chat id: {entry['id']}"}, status=status.HTTP_400_BAD_REQUEST)
+            updates[chat_id] = [entry.get(field) for field, _ in LAYOUT_FIELDS]
+
+        chat_ids = list(updates.keys())
+        values_sql = ", ".join(
+            ["(%s::uuid, " + ", ".join(f"%s::{sql_type}" for _, sql_type in LAYOUT_FIELDS) + ")"] * len(updates)
+        )
+        params = [v for chat_id, fields in updates.items() for v in [chat_id, *fields]]
+        set_clause = ", ".join(f"{field} = COALESCE(v.{field}, c.{field})" for field, _ in LAYOUT_FIELDS)
+        # Skip rows whose layout is already up to date so the count reflects real changes
+        changed_clause = " OR ".join(
+            f"(v.{field} IS NOT NULL AND v.{field} IS DISTINCT FROM c.{field})" for field, _ in LAYOUT_FIELDS
+        )
+
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    # 1. Ownership check for the whole batch in one query. It also locks the
+                    #    workspace rows (in a fixed order) ahead of the change-version triggers.
+                    cursor.execute(
+                        """
+                        SELECT w.id FROM chats c
+                        JOIN workspaces w ON c.workspace_id = w.id
+                        WHERE c.id = ANY(%s::uuid[]) AND w.user_id = %s
+                        ORDER BY w.id
+                        FOR UPDATE OF w
+                        """,
+                        [chat_ids, user_id]
+                    )
+                    if len(cursor.fetchall()) != len(chat_ids):
+                        return Response({"error": "Forbidden"}, status=status.HTTP_403_FORBIDDEN)
+
+                    # 2. Apply every entry with a single statement
+                    cursor.execute(
+                        f"""
+                        UPDATE chats c SET {set_clause}
+                        FROM (VALUES {values_sql}) AS v(id, {", ".join(field for field, _ in LAYOUT_FIELDS)})
+                        WHERE c.id = v.id AND ({changed_clause})
+                        RETURNING c.workspace_id, c.id, {", ".join(f"c.{field}" for field, _ in LAYOUT_FIELDS)}
+                        """,
+                        params
+                    )
+                    rows = cursor.fetchall()
+                    updated = len(rows)
+
+                    # 3. Push the new layout to other tabs/devices (delivered on commit)
+                    notify_layout(cursor, rows, ['id', *(field for field, _ in LAYOUT_FIELDS)])
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({"message": "Layout saved", "updated": updated})
+
     def destroy(self, request, pk=None):
         """
         DELETE /canvas/chats/{id}/
@@ -171,11 +312,20 @@ class ChatViewSet(viewsets.ViewSet):
         query = """
             DELETE FROM chats 
             WHERE id = %s AND workspace_id IN (SELECT id FROM workspaces WHERE user_id = %s)
+            RETURNING workspace_id
         """
-        with connection.cursor() as cursor:
-            cursor.execute(query, [pk, user_id])
-            if cursor.rowcount == 0:
-                return Response({"error": "Not found or access denied"}, status=status.HTTP_404_NOT_FOUND)
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                # Workspace first: the tombstone trigger takes the same lock
+                lock_chat_workspace(cursor, pk)
+                cursor.execute(query, [pk, user_id])
+                row = cursor.fetchone()
+                if row is None:
+                    return Response({"error": "Not found or access denied"}, status=status.HTTP_404_NOT_FOUND)
+                # Clients drop the chat's window, messages and arrows
+                notify(cursor, row[0], "chat.deleted", {"id": pk})
+
+        ownership.forget_chat(user_id, pk)
         
         return Response({"message": f"Chat id: {pk} has been deleted"}, status=status.HTTP_200_OK)
     
@@ -192,105 +342,305 @@ class MessageViewSet(viewsets.ViewSet):
     Implements context-aware responses and sequential message ordering.
     """
     
-    permission_classes = [permissions.IsAuthenticated]
+    # Every action names a chat_id the user must own (answered from the ownership cache
+    # when possible, see `workspaces.permissions`)
+    permission_classes = [permissions.IsAuthenticated, IsChatOwner]
+
+    def list(self, request):
+        """
+        GET /canvas/messages/?chat_id={uuid}&before={order_index}&after={order_index}&limit={n}
+        Retrieves the conversation history for a specific window, one keyset page at a time.
+        Without before/after/limit the whole conversation is returned, unpaginated;
+        see `canvas.pagination` for the contract.
 
-    def _check_chat_ownership(self, user_id, chat_id):
+        GET /canvas/messages/?chat_id={uuid}&since={version}
+        Returns the window's messages changed after that workspace version (see `canvas.sync`).
         """
-        Security Utility: Ensures the chat belongs to the authenticated user.
+        chat_id = request.query_params.get('chat_id')
+        user_id = request.user.id
+        if not chat_id:
+            return Response({"error": "Unauthorized or missing chat_id"}, status=status.HTTP_403_FORBIDDEN)
+
+        try:
+            since = parse_since(request.query_params)
+        except SinceError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if since is not None:
+            return self._list_since(chat_id, user_id, since)
+
+        try:
+            direction, cursor_value, limit = parse_cursor(request.query_params)
+        except CursorError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        query, params = page_query(chat_id, direction, cursor_value, limit)
+        
+        rows = fetch_all(Query("messages.list", query), params, using=read_connection(user_id))
+        return Response(build_page(rows, direction, limit))
+
+    def _persist_prompt(self, chat_id, content):
         """
-        query = """
-            SELECT c.id FROM chats c
-            JOIN workspaces w ON c.workspace_id = w.id
-            WHERE c.id = %s AND w.user_id = %s
+        Phase 1 (short transaction): Saves the user's prompt, reserves the slot after it for
+        the reply and loads the context window for the AI.
+        Returns the new message id, the reply's slot id and the chat's ChatContext
+        (history, summary, highlight).
         """
-        with connection.cursor() as cursor:
-            cursor.execute(query, [chat_id, user_id])
-            return cursor.fetchone() is not None
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                # 1. Save User Message at the next free position, the reply's slot right after it
+                prompt, reply_id = append_exchange(cursor, chat_id, content)
 
-    def list(self, request):
+                # 2. Fetch History for Gemini (including inherited branch context);
+                #    ask_gemini trims it to the token budget
+                context = load_context(cursor, chat_id)
+
+        return prompt[0], reply_id, context
+
+    def _release_connection(self):
         """
-        GET /canvas/messages/?chat_id={uuid}
-        Retrieves the conversation history for a specific window.
+        Phase 2 helper: Hands the database connection back before the multi-second LLM call.
+        Django reconnects lazily on the next query, so the reply phase needs no special handling.
+        Skipped when an outer transaction is open, since closing would abort it.
         """
-        chat_id = request.query_params.get('chat_id')
-        user_id = request.user.id
+        if not connection.in_atomic_block:
+            connection.close()
+
+    def _persist_reply(self, chat_id, reply_id, content):
+        """
+        Phase 3 (short transaction): Saves the model's answer into the slot reserved in phase 1,
+        so it stays next to its prompt whatever was written meanwhile.
+        Returns the (id, order_index, created_at) of the reply.
+        """
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                row = fill_reply(cursor, chat_id, reply_id, content)
+        # Streamed replies are saved long after the request's own read-your-writes window began
+        mark_write(self.request.user.id)
+        return row
 
-        if not chat_id or not self._check_chat_ownership(user_id, chat_id):
+    def _list_since(self, chat_id, user_id, since):
+        """
+        Delta variant of `list`, paged by revision: when more than MAX_PAGE_SIZE messages
+        changed, "version" stops at the last one returned and "has_more" is true, so the
+        client repeats the call with the new version.
+        """
+        db = read_connection(user_id)
+        row = fetch_one(CHAT_WORKSPACE_VERSION_QUERY, [chat_id, user_id], using=db, as_dicts=False)
+        # The ownership check may be answered from the cache: the chat can be gone (or not yet on the replica)
+        if row is None:
             return Response({"error": "Unauthorized or missing chat_id"}, status=status.HTTP_403_FORBIDDEN)
+        workspace_id, version = row
+
+        rows = fetch_all(MESSAGES_SINCE_QUERY, [chat_id, since, MAX_PAGE_SIZE + 1], using=db)
+        rows, version, has_more = cap_message_delta(rows, version)
+        deleted = fetch_deleted(workspace_id, 'messages', since, chat_id, upto=version, using=db)
+
+        payload = delta_payload(rows, version, since, deleted)
+        payload["has_more"] = has_more
+        return Response(payload)
+
+    def _discard_prompt(self, user_msg_id, reply_id):
+        """
+        Internal Utility: Removes a prompt that never got an answer because the model was
+        overloaded (and its reply slot), so the client can retry the same request without
+        posting it twice.
+        """
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                release_reply(cursor, reply_id)
+                delete_message(cursor, user_msg_id)
+
+    def _busy_response(self, error):
+        return Response(
+            {"error": str(error), "retryable": True},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"Retry-After": str(retry_after(error))}
+        )
+
+    def _enqueue(self, request, chat_id, content, use_cache):
+        """
+        Async mode: Saves the prompt and its generation job in one transaction and returns 202.
+        A repeated Idempotency-Key returns the original job instead of posting the prompt again.
+        """
+        user_id = request.user.id
+        key = request.headers.get('Idempotency-Key') or request.data.get('idempotency_key')
+        if key is not None and (not isinstance(key, str) or len(key) > MAX_IDEMPOTENCY_KEY_LENGTH):
+            return Response(
+                {"error": f"Idempotency-Key must be a string of at most {MAX_IDEMPOTENCY_KEY_LENGTH} characters"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-        query = """
-            SELECT id, role, content, order_index, created_at
-            FROM messages
-            WHERE chat_id = %s AND is_hidden = FALSE
-            ORDER BY order_index ASC
-            """
-        
         with connection.cursor() as cursor:
-            cursor.execute(query, [chat_id])
-            columns = [col[0] for col in cursor.description]
-            rows = cursor.fetchall()
-            return Response({"data": [dict(zip(columns, r)) for r in rows]})
+            job = find_job(cursor, user_id, key) if key else None
+
+        if job is None:
+            try:
+                with transaction.atomic():
+                    with connection.cursor() as cursor:
+                        prompt, reply_id = append_exchange(cursor, chat_id, content)
+                        job = enqueue_job(cursor, user_id, chat_id, prompt[0], reply_id, use_cache, key)
+            except IntegrityError:
+                # A concurrent retry with the same key won the race; its prompt is the one kept
+                if not key:
+                    raise
+                with connection.cursor() as cursor:
+                    job = find_job(cursor, user_id, key)
+                # Any other violation (e.g. the chat was deleted meanwhile) is not a key race
+                if job is None:
+                    raise
+
+        return Response(
+            job, status=status.HTTP_202_ACCEPTED,
+            headers={"Location": reverse('jobs-detail', args=[job['job_id']])}
+        )
 
     def create(self, request):
         """
         POST /canvas/messages/
         1. Saves the user's prompt.
-        2. Fetches the last 10 messages for context.
-        3. Requests a response from Gemini.
+        2. Fetches the conversation history (trimmed to a token budget) for context.
+        3. Requests a response from Gemini (no DB connection held).
         4. Saves and returns the AI response.
+
+        When the model is overloaded (queue timeout or provider rate limit), the prompt is
+        removed again and 503 with Retry-After is returned.
+
+        With "async": true, steps 2-4 run in a worker instead and 202 is returned with a
+        job to poll at GET /api/canvas/jobs/{job_id}/ (see `canvas.jobs`).
         """
         user_id = request.user.id
         chat_id = request.data.get('chat_id')
         content = request.data.get('content')
+        # Clients send "use_cache": false to force a fresh answer (e.g. "regenerate")
+        use_cache = request.data.get('use_cache', True) is not False
 
         if not chat_id or not content:
             return Response({"error": "chat_id and content are required"}, status=status.HTTP_400_BAD_REQUEST)
 
-        if not self._check_chat_ownership(user_id, chat_id):
-            return Response({"error": "Access denied"}, status=status.HTTP_403_FORBIDDEN)
+        if request.data.get('async') is True:
+            return self._enqueue(request, chat_id, content, use_cache)
 
         try:
-            with connection.cursor() as cursor:
-                # 1. Get the current highest order_index
-                cursor.execute("SELECT COALESCE(MAX(order_index), -1) FROM messages WHERE chat_id = %s", [chat_id])
-                last_index = cursor.fetchone()[0]
-
-                # 2. Save User Message
-                cursor.execute(
-                    "INSERT INTO messages (chat_id, role, content, order_index) VALUES (%s, %s, %s, %s) RETURNING id",
-                    [chat_id, 'user', content, last_index + 1]
+            user_msg_id, reply_id, context = self._persist_prompt(chat_id, content)
+
+            # 3. Request a response from Gemini without holding a database connection
+            self._release_connection()
+            try:
+                ai_content = ask_gemini(
+                    context.history, content, use_cache=use_cache,
+                    highlight=context.highlight, summary=context.summary,
+                    inherited=context.inherited, user_id=user_id
                 )
-                user_msg_id = cursor.fetchone()[0]
+            except Exception as e:
+                if not is_overloaded(e):
+                    raise
+                self._discard_prompt(user_msg_id, reply_id)
+                return self._busy_response(e)
+
+            # 4. Save and Return Gemini Response
+            row = self._persist_reply(chat_id, reply_id, ai_content)
+            schedule_summary(chat_id, context.summary_through, row[1])
+            
+            return Response({
+                "user_message_id": user_msg_id,
+                "model_message": {
+                    "id": row[0],
+                    "role": "model",
+                    "content": ai_content,
+                    "created_at": row[2]
+                }
+            }, status=status.HTTP_201_CREATED)
 
-                # 3. Fetch History for Gemini (Last 10 messages)
-                cursor.execute(
-                    "SELECT role, content FROM messages WHERE chat_id = %s ORDER BY order_index DESC LIMIT 10",
-                    [chat_id]
-                )
-                # Reverse it so Gemini gets it in chronological order
-                history = [{"role": r, "content": c} for r, c in reversed(cursor.fetchall())]
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-                # 4. Save and Return Gemini Response
-                ai_content = ask_gemini(history, content)
+    @action(detail=False, methods=['post'])
+    def stream(self, request):
+        """
+        POST /canvas/messages/stream/
+        Same contract as `create`, but relays Gemini's answer as Server-Sent Events
+        so the window can render the first tokens immediately.
+
+        Event sequence:
+            event: prompt  -> {"user_message_id": ...}
+            event: chunk   -> {"text": "..."}            (repeated)
+            event: done    -> {"model_message": {...}}
+            event: error   -> {"error": "..."}           (instead of `done` on failure)
+
+        If the model is overloaded before any text was produced, the error event carries
+        "retryable": true and "retry_after", and the prompt is removed again.
+        The reply is persisted once the stream ends. If the client disconnects early,
+        whatever was generated so far is saved with `INTERRUPTED_MARKER` appended.
+        """
+        user_id = request.user.id
+        chat_id = request.data.get('chat_id')
+        content = request.data.get('content')
+        # Clients send "use_cache": false to force a fresh answer (e.g. "regenerate")
+        use_cache = request.data.get('use_cache', True) is not False
 
-                cursor.execute(
-                    "INSERT INTO messages (chat_id, role, content, order_index) VALUES (%s, %s, %s, %s) RETURNING id, created_at",
-                    [chat_id, 'model', ai_content, last_index + 2]
-                )
-                row = cursor.fetchone()
-                
-                return Response({
-                    "user_message_id": user_msg_id,
+        if not chat_id or not content:
+            return Response({"error": "chat_id and content are required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            user_msg_id, reply_id, context = self._persist_prompt(chat_id, content)
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        # The stream can stay open for a long time; don't pin a connection for it
+        self._release_connection()
+
+        def event_stream():
+            chunks = []
+            finished = False
+            try:
+                yield _sse("prompt", {"user_message_id": user_msg_id})
+
+                try:
+                    for text in stream_gemini(
+                        context.history, content, use_cache=use_cache,
+                        highlight=context.highlight, summary=context.summary,
+                        inherited=context.inherited, user_id=user_id
+                    ):
+                        chunks.append(text)
+                        yield _sse("chunk", {"text": text})
+                except Exception as e:
+                    if is_overloaded(e) and not chunks:
+                        finished = True
+                        self._discard_prompt(user_msg_id, reply_id)
+                        yield _sse("error", {"error": str(e), "retryable": True, "retry_after": retry_after(e)})
+                        return
+                    # Mirror ask_gemini: the error text becomes the stored answer
+                    chunks = [f"AI Service Error: {str(e)}"]
+                    finished = True
+                    self._persist_reply(chat_id, reply_id, chunks[0])
+                    yield _sse("error", {"error": chunks[0]})
+                    return
+
+                ai_content = "".join(chunks)
+                finished = True
+                row = self._persist_reply(chat_id, reply_id, ai_content)
+                schedule_summary(chat_id, context.summary_through, row[1])
+
+                yield _sse("done", {
                     "model_message": {
                         "id": row[0],
                         "role": "model",
                         "content": ai_content,
-                        "created_at": row[1]
+                        "created_at": row[2]
                     }
-                }, status=status.HTTP_201_CREATED)
-
-        except Exception as e:
-            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+                })
+            finally:
+                # Client went away mid-generation (GeneratorExit): keep what we have
+                if not finished:
+                    partial = "".join(chunks)
+                    partial = f"{partial}\n\n{INTERRUPTED_MARKER}" if partial else INTERRUPTED_MARKER
+                    self._persist_reply(chat_id, reply_id, partial)
+
+        response = StreamingHttpResponse(event_stream(), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        # Stop nginx from buffering the stream, which would defeat time-to-first-token
+        response["X-Accel-Buffering"] = "no"
+        return response
         
 
 
@@ -299,6 +649,26 @@ class MessageViewSet(viewsets.ViewSet):
 
 
 
+class JobViewSet(viewsets.ViewSet):
+    """
+    ViewSet for polling asynchronous generation jobs created by `POST /canvas/messages/` in async mode.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def retrieve(self, request, pk=None):
+        """
+        GET /canvas/jobs/{job_id}/
+        Returns the job's status ('queued', 'running', 'succeeded' or 'failed') and,
+        once it succeeded, the saved model message.
+        """
+        with connection.cursor() as cursor:
+            job = get_job(cursor, request.user.id, pk)
+
+        if job is None:
+            return Response({"error": "Job not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(job)
+
+
 class LinkViewSet(viewsets.ViewSet):
     """
     ViewSet for retrieving visual connections (Arrows) between chat windows.
@@ -307,25 +677,35 @@ class LinkViewSet(viewsets.ViewSet):
 
     def list(self, request):
         """
-        GET /canvas/links/?workspace_id={uuid}
+        GET /canvas/links/?workspace_id={uuid}&since={version}
         Retrieves all arrows for the canvas. 
         Returns coordinates and source text for the 'Glow Aura' effect.
+        With `since`, only arrows changed after that version plus the ids of deleted
+        ones are returned (see `canvas.sync`).
         """
         workspace_id = request.query_params.get('workspace_id')
         user_id = request.user.id
 
+        try:
+            since = parse_since(request.query_params)
+        except SinceError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
         # Security: Ensure user owns the workspace these links belong to
-        query = """
+        changed, changed_params = since_clause('ml', since)
+        query = f"""
             SELECT ml.id, ml.source_message_id, ml.start_offset, ml.end_offset, 
                    ml.from_chat_id, ml.to_chat_id, ml.created_at
             FROM message_links ml
             JOIN chats c ON ml.from_chat_id = c.id
             JOIN workspaces w ON c.workspace_id = w.id
-            WHERE w.id = %s AND w.user_id = %s
+            WHERE w.id = %s AND w.user_id = %s {changed}
         """
         
-        with connection.cursor() as cursor:
-            cursor.execute(query, [workspace_id, user_id])
-            columns = [col[0] for col in cursor.description]
-            rows = cursor.fetchall()
-            return Response({"data": [dict(zip(columns, r)) for r in rows]})
\ No newline at end of file
+        db = read_connection(user_id)
+        row = fetch_one(WORKSPACE_VERSION_QUERY, [workspace_id, user_id], using=db, as_dicts=False)
+        version = row[0] if row else None
+
+        rows = fetch_all(Query("links.list", query), [workspace_id, user_id, *changed_params], using=db)
+        deleted = fetch_deleted(workspace_id, 'message_links', since, using=db) if row and since is not None else []
+        return Response(delta_payload(rows, version, since, deleted))
\ No newline at end of file
@@ -11,6 +11,8 @@ https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
 from pathlib import Path
+import copy
+import importlib.util
 import os
 from dotenv import load_dotenv
 from datetime import timedelta
@@ -48,18 +50,21 @@ INSTALLED_APPS = [
     'rest_framework_simplejwt',
     
     'accounts',
-    # 'workspaces',
-    # 'canvas',
+    'workspaces',
+    'canvas',
 ]
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # First after security: compresses the final body produced by everything below it
+    'services.compression.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'services.routing.ReadYourWritesMiddleware',
 ]
 
 ROOT_URLCONF = 'continuiq.urls'
@@ -93,9 +98,85 @@ DATABASES = {
         "PASSWORD": os.getenv('DB_PASSWORD'),
         "HOST": os.getenv('DB_HOST'),
         "PORT": os.getenv('DB_PORT'),
+        "OPTIONS": {},
     }
 }
 
+# Connection lifecycle, selected with DB_CONNECTIONS:
+#   'pool'       (default) a psycopg pool per process; requests borrow a connection and return it
+#                when Django closes it, including the early close before LLM calls in the canvas views
+#   'persistent' one connection per thread, reused for DB_CONN_MAX_AGE seconds
+#   'pgbouncer'  persistent connections to PgBouncer in transaction mode. Consecutive
+#                transactions may run on different server connections, so no server-side
+#                prepared statements or cursors are used; the raw-SQL paths keep no session
+#                state (SET, temp tables, advisory locks) outside a transaction.
+#   'none'       a new connection for every request
+# The one session-level feature is LISTEN (canvas/realtime.py). It connects to DB_DIRECT_HOST /
+# DB_DIRECT_PORT, which must point at Postgres itself when DB_HOST is a PgBouncer.
+DB_CONNECTIONS = os.getenv('DB_CONNECTIONS', 'pool')
+
+if DB_CONNECTIONS == 'pool':
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+        'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+        # Seconds a request waits for a free connection before failing
+        'timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+        'max_idle': 300,
+        'max_lifetime': 1800,
+    }
+    # Django then passes ConnectionPool.check_connection to the pool, which validates a
+    # connection as it is handed out and replaces ones the server dropped
+    DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+elif DB_CONNECTIONS in ('persistent', 'pgbouncer'):
+    DATABASES['default']['CONN_MAX_AGE'] = int(os.getenv('DB_CONN_MAX_AGE', 60))
+    DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+
+if DB_CONNECTIONS == 'pgbouncer':
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+    DATABASES['default']['OPTIONS']['prepare_threshold'] = None
+
+# Server-side parameter binding lets services/db.py prepare its named queries (not with
+# 'pgbouncer'). Off by default: Postgres then infers parameter types itself, which some
+# untyped parameters (e.g. in SELECT lists) don't survive without explicit casts.
+if os.getenv('DB_SERVER_SIDE_BINDING', 'false').lower() == 'true':
+    DATABASES['default']['OPTIONS']['server_side_binding'] = True
+
+# Query timing (services/db.py): queries slower than SLOW_QUERY_MS are logged; None disables it.
+DB_QUERIES = {
+    'SLOW_QUERY_MS': int(os.getenv('DB_SLOW_QUERY_MS', 0)) or None,
+}
+
+# Read replica (services/routing.py), enabled by setting DB_REPLICA_HOST. The hydration reads
+# (workspace list/detail/canvas, chat, message and link lists) go to it, except for users who
+# wrote within STICKY_SECONDS; keep that above the replica's usual lag.
+# Tests run against the primary's test database, unless DB_REPLICA_TEST_MIRROR=false: then the
+# replica gets a test database of its own and the routing tests in workspaces/tests.py run, e.g.
+# with two databases on one local server:
+#   DB_REPLICA_HOST=localhost DB_REPLICA_NAME=continuiq_replica DB_REPLICA_TEST_MIRROR=false python manage.py test
+if os.getenv('DB_REPLICA_HOST'):
+    DATABASES['replica'] = {
+        **copy.deepcopy(DATABASES['default']),
+        'NAME': os.getenv('DB_REPLICA_NAME') or DATABASES['default']['NAME'],
+        'HOST': os.getenv('DB_REPLICA_HOST'),
+        'PORT': os.getenv('DB_REPLICA_PORT') or DATABASES['default']['PORT'],
+        'TEST': {'MIRROR': 'default'} if os.getenv('DB_REPLICA_TEST_MIRROR', 'true').lower() == 'true' else {},
+    }
+
+READ_REPLICA = {
+    'ALIAS': 'replica',
+    'STICKY_SECONDS': float(os.getenv('DB_REPLICA_STICKY_SECONDS', 5)),
+    'CACHE_ALIAS': 'default',
+}
+
+DATABASE_DIRECT = {
+    'HOST': os.getenv('DB_DIRECT_HOST') or DATABASES['default']['HOST'],
+    'PORT': os.getenv('DB_DIRECT_PORT') or DATABASES['default']['PORT'],
+}
+
+# Pool behind the async canvas views (canvas/async_db.py), per process
+ASYNC_DB_POOL_MIN_SIZE = int(os.getenv('ASYNC_DB_POOL_MIN_SIZE', 1))
+ASYNC_DB_POOL_MAX_SIZE = int(os.getenv('ASYNC_DB_POOL_MAX_SIZE', 10))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -115,6 +196,43 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Password hashing (accounts/hashers.py, services/passwords.py)
+# ALGORITHM: 'pbkdf2' (default) or 'argon2', which needs argon2-cffi and falls back to pbkdf2
+# when it isn't installed. New hashes use it; hashes made with the other algorithm or older
+# parameters are upgraded on the user's next successful login.
+# WORKERS threads hash in parallel (about one core each); beyond MAX_PENDING queued or running
+# hashes, requests get a 503 instead of waiting.
+PASSWORD_HASHING = {
+    'ALGORITHM': os.getenv('PASSWORD_HASHER', 'pbkdf2'),
+    'ARGON2_TIME_COST': int(os.getenv('ARGON2_TIME_COST', 2)),
+    'ARGON2_MEMORY_COST': int(os.getenv('ARGON2_MEMORY_COST', 19456)),  # KiB
+    'ARGON2_PARALLELISM': 1,
+    'PBKDF2_ITERATIONS': int(os.getenv('PBKDF2_ITERATIONS', 0)) or None,  # None: Django's default
+    'WORKERS': int(os.getenv('PASSWORD_HASH_WORKERS', max(1, (os.cpu_count() or 2) // 2))),
+    'MAX_PENDING': int(os.getenv('PASSWORD_HASH_MAX_PENDING', 64)),
+    'MAX_WAIT': 5.0,
+}
+
+if PASSWORD_HASHING['ALGORITHM'] == 'argon2' and importlib.util.find_spec('argon2') is None:
+    PASSWORD_HASHING['ALGORITHM'] = 'pbkdf2'
+
+_PASSWORD_HASHERS = {
+    'argon2': 'accounts.hashers.TunedArgon2PasswordHasher',
+    'pbkdf2': 'accounts.hashers.TunedPBKDF2PasswordHasher',
+}
+PASSWORD_HASHERS = [_PASSWORD_HASHERS[PASSWORD_HASHING['ALGORITHM']]] + [
+    hasher for name, hasher in _PASSWORD_HASHERS.items() if name != PASSWORD_HASHING['ALGORITHM']
+]
+
+# Attempt limits for login/registration (accounts/throttling.py), per WINDOW seconds.
+# CACHE_ALIAS should be a shared cache (e.g. Redis) for the limits to hold across workers.
+LOGIN_THROTTLE = {
+    'EMAIL_ATTEMPTS': 10,
+    'IP_ATTEMPTS': 100,
+    'WINDOW': 300,
+    'CACHE_ALIAS': 'default',
+}
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/6.0/topics/i18n/
@@ -142,6 +260,22 @@ REST_FRAMEWORK = {
     ],
 }
 
+# API_JSON_RENDERER=orjson renders API responses with orjson (services/renderers.py; needs orjson)
+if os.getenv('API_JSON_RENDERER', 'default') == 'orjson':
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'] = [
+        'services.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ]
+
+# Response compression (services/compression.py). Bodies of at least MIN_SIZE bytes get the
+# first of ENCODINGS the client accepts; 'br' needs the brotli package and is skipped without it.
+RESPONSE_COMPRESSION = {
+    'MIN_SIZE': int(os.getenv('RESPONSE_COMPRESSION_MIN_SIZE', 1024)),
+    # 'ENCODINGS' defaults to ['br', 'gzip'] with the brotli package installed, else ['gzip']
+    'GZIP_LEVEL': 6,
+    'BROTLI_QUALITY': 4,
+}
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60), 
     
@@ -156,4 +290,84 @@ SIMPLE_JWT = {
     'AUTH_HEADER_TYPES': ('Bearer',),
     'USER_ID_FIELD': 'id',
     'USER_ID_CLAIM': 'user_id',
+}
+
+# Token revocation (accounts/revocation.py). Each process re-reads changed token versions
+# at most every REFRESH_SECONDS, which bounds how long a revoked token keeps working elsewhere.
+TOKEN_REVOCATION = {
+    'REFRESH_SECONDS': float(os.getenv('TOKEN_REVOCATION_REFRESH_SECONDS', 5)),
+}
+
+# LLM client (services/llm.py)
+# PROVIDER: 'gemini' or 'fake' (deterministic, offline; for tests and benchmarks).
+# TRANSPORT: google-generativeai transport ('grpc' or 'rest'); None keeps the SDK default.
+LLM = {
+    'PROVIDER': os.getenv('LLM_PROVIDER', 'gemini'),
+    'MODEL': os.getenv('LLM_MODEL', 'gemini-flash-latest'),
+    'API_KEY': os.getenv('GEMINI_API_KEY'),
+    'TIMEOUT': int(os.getenv('LLM_TIMEOUT', 60)),
+    'MAX_RETRIES': 3,
+    'BACKOFF_BASE': 0.5,
+    'BACKOFF_MAX': 8.0,
+    'TRANSPORT': os.getenv('LLM_TRANSPORT'),
+    # Seconds per call of the offline 'fake' provider (load tests, e.g. benchmark_concurrency)
+    'FAKE_LATENCY': float(os.getenv('LLM_FAKE_LATENCY', 0)),
+}
+
+# Cache of verified workspace/chat ownership (workspaces/permissions.py).
+# BACKEND: 'memory' (per process), 'django' (shared CACHES alias) or None to always query.
+# Deletes invalidate entries in every worker only with 'django' on a cache all workers share;
+# with 'memory' other workers keep a deleted row's entry until TTL expires.
+OWNERSHIP_CACHE = {
+    'BACKEND': 'memory',
+    'TTL': 60,
+    'MAX_ENTRIES': 10000,
+}
+
+# Admission control for LLM calls (services/limiter.py)
+# MAX_CONCURRENT is per process; MAX_WAIT is how long a request may queue before a 503.
+# RATE_PER_MINUTE (optional) is shared by all workers through the RATE_CACHE_ALIAS cache,
+# which must then be a shared backend such as Redis.
+LLM_LIMITS = {
+    'MAX_CONCURRENT': int(os.getenv('LLM_MAX_CONCURRENT', 8)),
+    'MAX_WAIT': float(os.getenv('LLM_MAX_WAIT', 20)),
+    'RATE_PER_MINUTE': int(os.getenv('LLM_RATE_PER_MINUTE', 0)) or None,
+    'RATE_CACHE_ALIAS': 'default',
+}
+
+# Canvas
+# Number of messages a branched chat inherits from each ancestor (ending at the branch point)
+CANVAS_BRANCH_CONTEXT_DEPTH = int(os.getenv('CANVAS_BRANCH_CONTEXT_DEPTH', 10))
+# Context sent to the LLM is selected by (estimated) token budget rather than a fixed turn count
+CANVAS_CONTEXT_MAX_MESSAGES = 50
+CANVAS_CONTEXT_TOKEN_BUDGET = int(os.getenv('CANVAS_CONTEXT_TOKEN_BUDGET', 8000))
+CANVAS_CONTEXT_MAX_TURN_TOKENS = 2000
+CANVAS_CONTEXT_INCLUDE_HIGHLIGHT = True
+# Rolling summaries: every N new messages, older turns are folded into chats.summary
+CANVAS_SUMMARIES_ENABLED = True
+CANVAS_SUMMARY_EVERY = 10
+CANVAS_SUMMARY_KEEP_RECENT = 6
+CANVAS_SUMMARY_MAX_WORDS = 250
+# Messages per summarization call when catching up on a long backlog
+CANVAS_SUMMARY_BATCH = 50
+# Refresh threads per process, and chats allowed to wait for one before refreshes are skipped
+CANVAS_SUMMARY_WORKERS = 2
+CANVAS_SUMMARY_MAX_PENDING = 100
+
+# Cache for identical Gemini requests (same history + prompt).
+# BACKEND: 'memory' (per-process LRU), 'django' (shared, uses CACHES[ALIAS]) or None to disable.
+CANVAS_LLM_CACHE = {
+    'BACKEND': os.getenv('CANVAS_LLM_CACHE_BACKEND', 'memory'),
+    'TTL': 60 * 60,
+    'MAX_ENTRIES': 1024,
+    'ALIAS': 'default',
+}
+
+# Provider-side (Gemini CachedContent) caching of long branch prefixes shared by sibling chats.
+# Off by default: it needs a model version that supports explicit caching.
+CANVAS_LLM_PREFIX_CACHE = {
+    'ENABLED': os.getenv('CANVAS_LLM_PREFIX_CACHE', 'false').lower() == 'true',
+    'MIN_TOKENS': 4096,
+    'TTL': 10 * 60,
+    'BACKEND': 'memory',
 }
\ No newline at end of file
@@ -11,6 +11,7 @@ CREATE TABLE workspaces (
   id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
   user_id UUID REFERENCES users(id) ON DELETE CASCADE,
   name VARCHAR NOT NULL,
+  version BIGINT NOT NULL DEFAULT 0,
   created_at TIMESTAMPTZ NOT NULL DEFAULT now()
 );
 
@@ -23,6 +24,9 @@ CREATE TABLE chats (
   width INT DEFAULT 400,
   height INT DEFAULT 600,
   z_index INT DEFAULT 1,
+  summary TEXT,
+  summary_through INT,
+  revision BIGINT NOT NULL DEFAULT 0,
   created_at TIMESTAMPTZ DEFAULT now()
 );
 
@@ -32,6 +36,8 @@ CREATE TABLE messages (
   role VARCHAR CHECK (role IN ('user', 'model')),
   content TEXT NOT NULL,
   order_index INT NOT NULL,
+  is_hidden BOOLEAN NOT NULL DEFAULT FALSE,
+  revision BIGINT NOT NULL DEFAULT 0,
   created_at TIMESTAMPTZ DEFAULT now()
 );
 
@@ -42,5 +48,40 @@ CREATE TABLE message_links (
   end_offset INT NOT NULL, 
   from_chat_id UUID REFERENCES chats(id) ON DELETE CASCADE,
   to_chat_id UUID REFERENCES chats(id) ON DELETE CASCADE,
+  revision BIGINT NOT NULL DEFAULT 0,
   created_at TIMESTAMPTZ DEFAULT now()
-);
\ No newline at end of file
+);
+
+CREATE TABLE generation_jobs (
+  id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+  user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+  chat_id UUID NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+  prompt_message_id UUID REFERENCES messages(id) ON DELETE CASCADE,
+  reply_message_id UUID REFERENCES messages(id) ON DELETE SET NULL,
+  idempotency_key VARCHAR(255),
+  use_cache BOOLEAN NOT NULL DEFAULT TRUE,
+  status VARCHAR NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'succeeded', 'failed')),
+  attempts INT NOT NULL DEFAULT 0,
+  error TEXT,
+  run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+  locked_until TIMESTAMPTZ,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  finished_at TIMESTAMPTZ
+);
+
+-- Revisions, tombstones and their triggers: canvas/migrations/0006_change_versions.py
+CREATE TABLE canvas_tombstones (
+  workspace_id UUID NOT NULL REFERENCES workspaces(id) ON DELETE CASCADE,
+  kind VARCHAR NOT NULL CHECK (kind IN ('chats', 'messages', 'message_links')),
+  object_id UUID NOT NULL,
+  chat_id UUID,
+  revision BIGINT NOT NULL,
+  deleted_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- Token revocation (accounts/revocation.py); no FK so it outlives deleted users
+CREATE TABLE token_versions (
+  user_id UUID PRIMARY KEY,
+  version INT NOT NULL,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
@@ -0,0 +1,86 @@
+"""
+Small cache backends shared across apps. Both expose get/set/delete plus
+async aget/aset, so callers can switch between them through settings.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded in-process cache with a per-entry TTL.
+    The least recently used entry is evicted once `max_entries` is reached.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aset(self, key, value):
+        self.set(key, value)
+
+
+class DjangoCacheBackend:
+    """
+    Stores entries in one of Django's CACHES aliases (e.g. Redis/Memcached),
+    so every worker process shares the same entries. Size-bounded eviction is
+    delegated to the cache server.
+    """
+
+    def __init__(self, alias='default', ttl=3600):
+        self.alias = alias
+        self.ttl = ttl
+
+    @property
+    def _cache(self):
+        return caches[self.alias]
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value):
+        self._cache.set(key, value, self.ttl)
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+    async def aget(self, key):
+        return await self._cache.aget(key)
+
+    async def aset(self, key, value):
+        await self._cache.aset(key, value, self.ttl)
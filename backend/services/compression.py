@@ -0,0 +1,139 @@
+"""
+Response compression negotiated per request.
+
+Responses of at least settings.RESPONSE_COMPRESSION['MIN_SIZE'] bytes are compressed
+with the coding of ENCODINGS the client gives the highest q-value, the order of
+ENCODINGS breaking ties: Brotli ('br', needs the brotli package) compresses long
+message text noticeably better than gzip at a similar CPU cost with a low quality
+setting. Smaller bodies are sent as-is, since compression would cost more than it saves.
+
+Without an ENCODINGS setting, Brotli is preferred when the package is installed
+and gzip is used otherwise. Listing 'br' explicitly without the package logs a
+warning at startup.
+
+Streaming responses (the SSE endpoint) are never compressed: compressors buffer
+their input, which would hold back the tokens the stream exists to deliver.
+"""
+
+import gzip
+import logging
+import re
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+logger = logging.getLogger(__name__)
+
+_config = getattr(settings, 'RESPONSE_COMPRESSION', {})
+MIN_SIZE = _config.get('MIN_SIZE', 1024)
+GZIP_LEVEL = _config.get('GZIP_LEVEL', 6)
+BROTLI_QUALITY = _config.get('BROTLI_QUALITY', 4)
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+
+
+def _load_brotli(warn=True):
+    try:
+        import brotli
+    except ImportError:
+        if warn:
+            logger.warning("brotli is not installed; responses fall back to gzip")
+        return None
+    return brotli
+
+
+_configured = _config.get('ENCODINGS')
+if _configured is None:
+    _brotli = _load_brotli(warn=False)
+    _configured = ['br', 'gzip']
+else:
+    _brotli = _load_brotli() if 'br' in _configured else None
+
+_COMPRESSORS = {
+    'gzip': lambda body: gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0),
+}
+if _brotli is not None:
+    _COMPRESSORS['br'] = lambda body: _brotli.compress(body, quality=BROTLI_QUALITY)
+
+ENCODINGS = [e for e in _configured if e in _COMPRESSORS]
+
+_ACCEPT_ITEM = re.compile(r'^\s*([\w*-]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?')
+
+
+def accepted_encodings(header):
+    """
+    Parses Accept-Encoding into {coding: q-value}.
+    """
+    accepted = {}
+    for item in header.split(','):
+        match = _ACCEPT_ITEM.match(item)
+        if not match:
+            continue
+        try:
+            accepted[match.group(1).lower()] = float(match.group(2)) if match.group(2) else 1.0
+        except ValueError:
+            continue
+    return accepted
+
+
+def _negotiate(request):
+    accepted = accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    best, best_q = None, 0
+    for encoding in ENCODINGS:
+        # An explicit q=0 refuses the coding even when "*" is accepted
+        q = accepted.get(encoding, accepted.get('*', 0))
+        # Strictly greater: on equal q the earlier (server-preferred) coding stays
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress_response(request, response):
+    if response.streaming or response.has_header('Content-Encoding'):
+        return response
+    if not response.get('Content-Type', '').startswith(COMPRESSIBLE_TYPES):
+        return response
+
+    # Caches must keep compressed and plain variants apart, whatever this response got
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if len(response.content) < MIN_SIZE:
+        return response
+    encoding = _negotiate(request)
+    if encoding is None:
+        return response
+
+    compressed = _COMPRESSORS[encoding](response.content)
+    if len(compressed) >= len(response.content):
+        return response
+
+    response.content = compressed
+    response['Content-Length'] = str(len(compressed))
+    response['Content-Encoding'] = encoding
+    # The body changed, so a strong ETag no longer describes it
+    etag = response.get('ETag')
+    if etag and etag.startswith('"'):
+        response['ETag'] = 'W/' + etag
+    return response
+
+
+class CompressionMiddleware:
+    """
+    Compresses eligible responses (see `compress_response`).
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return compress_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return compress_response(request, await self.get_response(request))
@@ -0,0 +1,153 @@
+"""
+Shared data access for the raw-SQL views.
+
+    rows = fetch_all(WORKSPACES_QUERY, [user_id])               # list of dicts
+    row = fetch_one(VERSION_QUERY, [workspace_id, user_id], as_dicts=False)
+    for row in stream(EXPORT_QUERY, [workspace_id]): ...        # rows in chunks
+    count = execute(RENAME_QUERY, [name, workspace_id])
+
+Rows are shaped by psycopg's row factories while they are fetched, instead of a
+second pass over `cursor.description` in every view. `using` takes a connection
+(e.g. from `services.routing.read_connection`) and defaults to the primary.
+Statements run through Django's cursor wrapper, so errors surface as django.db
+exceptions and `connection.execute_wrapper` hooks, `connection.queries` and
+`assertNumQueries` see them, exactly as with `connection.cursor()`.
+
+Queries declared as `Query(name, sql)` are prepared server-side (psycopg
+`prepare=True`) when the connection allows it: only with server-side binding
+(DATABASES OPTIONS 'server_side_binding') and not behind a transaction-mode
+PgBouncer (prepare_threshold None), where a prepared statement may not exist on
+the next server connection. Otherwise they run unprepared. Django's wrapper
+cannot pass `prepare`, so prepared statements execute on the psycopg cursor
+directly and only show up in `stats()` and the hooks below.
+
+Every call is timed: `stats()` aggregates per query name, queries slower than
+settings.DB_QUERIES['SLOW_QUERY_MS'] are logged, and `add_hook` registers
+callbacks receiving (name, sql, seconds, rows).
+"""
+
+import logging
+import time
+from typing import NamedTuple
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
+from psycopg.rows import dict_row, tuple_row
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_MS = getattr(settings, 'DB_QUERIES', {}).get('SLOW_QUERY_MS')
+
+
+class Query(NamedTuple):
+    name: str
+    sql: str
+    prepare: bool = True
+
+
+_hooks = []
+_stats = {}
+
+
+def add_hook(hook):
+    """
+    Registers hook(name, sql, seconds, rows), called after every query.
+    """
+    _hooks.append(hook)
+
+
+def _report(query, seconds, rows):
+    entry = _stats.setdefault(query.name, [0, 0.0])
+    entry[0] += 1
+    entry[1] += seconds
+    if SLOW_QUERY_MS is not None and seconds * 1000 >= SLOW_QUERY_MS:
+        logger.warning("Slow query %s: %.1f ms, %d rows", query.name, seconds * 1000, rows)
+    for hook in _hooks:
+        hook(query.name, query.sql, seconds, rows)
+
+
+def stats():
+    return {
+        name: {"calls": calls, "total_ms": total * 1000, "avg_ms": total * 1000 / calls}
+        for name, (calls, total) in _stats.items()
+    }
+
+
+def _as_query(query):
+    # Ad hoc SQL strings are timed under a generic name and never prepared
+    return query if isinstance(query, Query) else Query("sql", query, prepare=False)
+
+
+def _prepare(db, query):
+    options = db.settings_dict.get('OPTIONS', {})
+    if not query.prepare or not options.get('server_side_binding'):
+        return None
+    if 'prepare_threshold' in options and options['prepare_threshold'] is None:
+        return None
+    return True
+
+
+def _execute(db, wrapper, query, params):
+    if _prepare(db, query):
+        with db.wrap_database_errors:
+            db.validate_no_broken_transaction()
+            wrapper.cursor.execute(query.sql, params, prepare=True)
+    else:
+        wrapper.execute(query.sql, params)
+
+
+def _run(query, params, using, as_dicts, fetch):
+    db = using or connection
+    query = _as_query(query)
+    start = time.perf_counter()
+    with db.cursor() as wrapper:
+        wrapper.cursor.row_factory = dict_row if as_dicts else tuple_row
+        _execute(db, wrapper, query, params)
+        result = fetch(wrapper)
+        rows = wrapper.rowcount
+    _report(query, time.perf_counter() - start, rows)
+    return result
+
+
+def fetch_all(query, params=(), using=None, as_dicts=True):
+    """
+    Returns every row, as dicts keyed by column name or as tuples.
+    """
+    return _run(query, params, using, as_dicts, lambda cursor: cursor.fetchall())
+
+
+def fetch_one(query, params=(), using=None, as_dicts=True):
+    """
+    Returns the first row (or None).
+    """
+    return _run(query, params, using, as_dicts, lambda cursor: cursor.fetchone())
+
+
+def execute(query, params=(), using=None):
+    """
+    Runs a statement without a result set and returns the number of affected rows.
+    """
+    return _run(query, params, using, False, lambda cursor: cursor.rowcount)
+
+
+def stream(query, params=(), using=None, as_dicts=True):
+    """
+    Yields rows from a server-side cursor, fetched GET_ITERATOR_CHUNK_SIZE at a
+    time, so large results are never held in memory as a whole (Django's
+    `chunked_cursor`, which falls back to a regular cursor with
+    DISABLE_SERVER_SIDE_CURSORS). For unbounded results only: bounded ones are
+    cheaper with `fetch_all`. Consume it fully, or close it, before running
+    another query on the same connection. Never prepared.
+    """
+    db = using or connection
+    query = _as_query(query)
+    start = time.perf_counter()
+    count = 0
+    with db.chunked_cursor() as wrapper:
+        wrapper.cursor.row_factory = dict_row if as_dicts else tuple_row
+        wrapper.execute(query.sql, params)
+        while rows := wrapper.fetchmany(GET_ITERATOR_CHUNK_SIZE):
+            count += len(rows)
+            yield from rows
+    _report(query, time.perf_counter() - start, count)
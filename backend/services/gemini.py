@@ -1,41 +1,104 @@
-import google.generativeai as genai
-import os
-from typing import List, TypedDict
+import threading
+from datetime import timedelta
 
-genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-model = genai.GenerativeModel("gemini-flash-latest")
+from .llm import LLMError, LLMProvider, RetryPolicy
 
-class Message(TypedDict):
-    role: str
-    content: str
+_configure_lock = threading.Lock()
+_configured = False
 
-def ask_gemini(previous_messages: List[Message], prompt: str):
+
+def _genai(api_key, transport):
+    """
+    Imports and configures google.generativeai once per process. The SDK keeps one
+    client (and its gRPC channel / HTTP session) per process after this, so every
+    request reuses the same connection instead of dialing a new one.
+    """
+    global _configured
+    import google.generativeai as genai
+
+    if not _configured:
+        with _configure_lock:
+            if not _configured:
+                options = {"api_key": api_key}
+                if transport:
+                    options["transport"] = transport
+                genai.configure(**options)
+                _configured = True
+    return genai
+
+
+class GeminiProvider(LLMProvider):
     """
-    Call Gemini API to get a response to `prompt` with context `previous_messages`
-    
-    :param previous_messages: Message class is {"role": either "user" or "model", "content": "..."}
-    :type previous_messages: List[Message]
-    :param prompt: The current prompt to ask LLM
-    :type prompt: str
+    Google Gemini via google-generativeai, with timeouts, retries and lazy SDK setup.
     """
-    
-    contents = []
-
-    # Previous messages
-    for m in previous_messages:
-        role = "user" if m["role"] == "user" else "model"
-        contents.append({
-            "role": role,
-            "parts": [{"text": m["content"]}]
-        })
-
-    # Current prompt
-    contents.append({
-        "role": "user",
-        "parts": [{
-            "text": f"Answer in plain text (paragraphs): {prompt}"
-        }]
-    })
-
-    response = model.generate_content(contents)
-    return response.text
\ No newline at end of file
+
+    def __init__(self, model_name, api_key=None, timeout=60, transport=None, retry=None, cached_content=None):
+        self.model_name = model_name
+        self.api_key = api_key
+        self.timeout = timeout
+        self.transport = transport
+        self.retry = retry or RetryPolicy()
+        self.cached_content = cached_content
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    genai = _genai(self.api_key, self.transport)
+                    if self.cached_content is not None:
+                        self._model = genai.GenerativeModel.from_cached_content(
+                            cached_content=genai.caching.CachedContent.get(self.cached_content)
+                        )
+                    else:
+                        self._model = genai.GenerativeModel(self.model_name)
+        return self._model
+
+    @property
+    def _request_options(self):
+        return {"timeout": self.timeout}
+
+    def generate(self, contents):
+        return self.retry.call(
+            lambda: self.model.generate_content(contents, request_options=self._request_options).text
+        )
+
+    async def agenerate(self, contents):
+        async def call():
+            response = await self.model.generate_content_async(contents, request_options=self._request_options)
+            return response.text
+
+        return await self.retry.acall(call)
+
+    def stream(self, contents):
+        # Only opening the stream is retried; once chunks were yielded a retry would duplicate text
+        response = self.retry.call(
+            lambda: self.model.generate_content(contents, stream=True, request_options=self._request_options)
+        )
+        try:
+            for chunk in response:
+                # Safety-filtered or empty chunks carry no parts; skip them instead of raising
+                if chunk.parts:
+                    yield chunk.text
+        except Exception as e:
+            raise LLMError(str(e), RetryPolicy.status_of(e)) from e
+
+    def create_cache(self, contents, ttl_seconds):
+        genai = _genai(self.api_key, self.transport)
+        cached = self.retry.call(lambda: genai.caching.CachedContent.create(
+            model=f"models/{self.model_name}",
+            contents=contents,
+            ttl=timedelta(seconds=ttl_seconds),
+        ))
+        return cached.name
+
+    def bind_cache(self, handle):
+        bound = GeminiProvider(
+            self.model_name, self.api_key, self.timeout, self.transport, self.retry, cached_content=handle
+        )
+        # Fetch the CachedContent now: callers bind off the event loop (see canvas.ai_services),
+        # while the first request may run on it
+        bound.model
+        return bound
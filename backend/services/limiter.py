@@ -0,0 +1,382 @@
+"""
+Admission control for outbound LLM calls.
+
+- `FairLimiter` caps concurrent provider calls per process. Callers beyond the
+  cap wait in per-user queues that are served round-robin, so one user's burst
+  cannot starve everyone else, and give up with `LLMBusyError` after `max_wait`.
+- `CacheRateLimiter` optionally adds a requests-per-minute budget shared by
+  every worker process through a Django cache (e.g. Redis).
+- `SingleFlight` coalesces identical in-flight requests: followers wait for the
+  leader's result instead of issuing their own call.
+
+Both sync (WSGI threads) and async (ASGI) callers are supported.
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .llm import LLMError
+
+# Failures that mean "try again later" rather than "this request is broken"
+OVERLOADED_STATUS_CODES = {429, 503}
+
+# Seconds clients are told to wait when no better estimate is available
+DEFAULT_RETRY_AFTER = 5
+
+# Limiter key for work not triggered by a user request (e.g. summaries)
+BACKGROUND = "__background__"
+
+
+class LLMBusyError(LLMError):
+    """
+    No capacity became available within the limiter's max wait.
+    """
+
+    def __init__(self, message="LLM capacity exhausted, try again shortly", retry_after=DEFAULT_RETRY_AFTER):
+        super().__init__(message, status=503)
+        self.retry_after = retry_after
+
+
+def is_overloaded(error):
+    """
+    True for errors the client should retry later: local queue timeouts and
+    provider rate limiting / unavailability that outlasted the retry policy.
+    """
+    return isinstance(error, LLMError) and error.status in OVERLOADED_STATUS_CODES
+
+
+def retry_after(error):
+    return getattr(error, 'retry_after', DEFAULT_RETRY_AFTER)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _Ticket:
+    """
+    A queued request. Granting hands a slot over directly to the waiter,
+    whether it blocks on a thread Event or awaits a Future on an event loop.
+    """
+
+    __slots__ = ('granted', 'event', 'loop', 'future')
+
+    def __init__(self, loop=None):
+        self.granted = False
+        self.loop = loop
+        self.event = None if loop else threading.Event()
+        self.future = loop.create_future() if loop else None
+
+    def grant(self):
+        self.granted = True
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+
+
+class CacheRateLimiter:
+    """
+    Fixed-window budget of `per_minute` calls shared through a Django cache alias.
+    Requires a cache shared by all workers (Redis/Memcached) to be cross-process.
+    """
+
+    def __init__(self, per_minute, alias='default'):
+        self.per_minute = per_minute
+        self.alias = alias
+
+    def _window(self):
+        now = time.time()
+        return f"llm:rate:{int(now // 60)}", 60 - now % 60
+
+    def wait_time(self):
+        """
+        Takes a token and returns 0, or returns the seconds until the next window.
+        """
+        key, remaining = self._window()
+        cache = caches[self.alias]
+        cache.add(key, 0, 90)
+        return 0 if cache.incr(key) <= self.per_minute else remaining
+
+    async def await_time(self):
+        """
+        `wait_time` through the cache's async API, for callers on an event loop.
+        """
+        key, remaining = self._window()
+        cache = caches[self.alias]
+        await cache.aadd(key, 0, 90)
+        return 0 if await cache.aincr(key) <= self.per_minute else remaining
+
+
+class FairLimiter:
+    """
+    Process-wide concurrency limit with per-user round-robin queueing.
+
+    :param max_concurrent: Provider calls allowed in flight at once in this process
+    :param max_wait: Seconds a caller may wait for a slot before `LLMBusyError`
+    :param rate_limiter: Optional `CacheRateLimiter` checked once a slot is held
+    """
+
+    def __init__(self, max_concurrent=8, max_wait=20.0, rate_limiter=None):
+        self.max_concurrent = max_concurrent
+        self.max_wait = max_wait
+        self.rate_limiter = rate_limiter
+        self._lock = threading.Lock()
+        self._active = 0
+        # user -> queued tickets; the first user in the dict is served next
+        self._waiting = OrderedDict()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+
+    def _enter_or_enqueue(self, user, ticket):
+        # Called with the lock held. New arrivals never jump ahead of queued callers.
+        if self._active < self.max_concurrent and not self._waiting:
+            self._active += 1
+            self.admitted += 1
+            return True
+        self._waiting.setdefault(user, deque()).append(ticket)
+        self.queued += 1
+        return False
+
+    def _abandon(self, user, ticket):
+        # Called with the lock held. Returns True if the slot was granted meanwhile.
+        if ticket.granted:
+            return True
+        queue = self._waiting.get(user)
+        if queue is not None:
+            queue.remove(ticket)
+            if not queue:
+                del self._waiting[user]
+        self.rejected += 1
+        return False
+
+    def release(self):
+        with self._lock:
+            if not self._waiting:
+                self._active -= 1
+                return
+            # Round-robin: serve the first user's oldest ticket, then move that user to the back
+            user, queue = next(iter(self._waiting.items()))
+            ticket = queue.popleft()
+            del self._waiting[user]
+            if queue:
+                self._waiting[user] = queue
+            self.admitted += 1
+            ticket.grant()
+
+    def _check_rate(self, deadline, sleep):
+        while self.rate_limiter is not None:
+            wait = self.rate_limiter.wait_time()
+            if not wait:
+                return
+            if time.monotonic() + wait > deadline:
+                raise LLMBusyError(retry_after=int(wait) + 1)
+            sleep(wait)
+
+    async def _acheck_rate(self, deadline):
+        while self.rate_limiter is not None:
+            wait = await self.rate_limiter.await_time()
+            if not wait:
+                return
+            if time.monotonic() + wait > deadline:
+                raise LLMBusyError(retry_after=int(wait) + 1)
+            await asyncio.sleep(wait)
+
+    def acquire(self, user):
+        deadline = time.monotonic() + self.max_wait
+        ticket = _Ticket()
+        with self._lock:
+            entered = self._enter_or_enqueue(user, ticket)
+
+        if not entered and not ticket.event.wait(self.max_wait):
+            with self._lock:
+                if not self._abandon(user, ticket):
+                    raise LLMBusyError()
+
+        try:
+            self._check_rate(deadline, time.sleep)
+        except LLMBusyError:
+            self.release()
+            raise
+
+    async def aacquire(self, user):
+        deadline = time.monotonic() + self.max_wait
+        ticket = _Ticket(asyncio.get_running_loop())
+        with self._lock:
+            entered = self._enter_or_enqueue(user, ticket)
+
+        if not entered:
+            try:
+                await asyncio.wait_for(asyncio.shield(ticket.future), self.max_wait)
+            except asyncio.TimeoutError:
+                with self._lock:
+                    if not self._abandon(user, ticket):
+                        raise LLMBusyError()
+            except asyncio.CancelledError:
+                # Client went away while queued; hand back the slot if it arrived meanwhile
+                with self._lock:
+                    granted = self._abandon(user, ticket)
+                if granted:
+                    self.release()
+                raise
+
+        try:
+            await self._acheck_rate(deadline)
+        except BaseException:
+            self.release()
+            raise
+
+    def run(self, user, fn):
+        with self.slot(user):
+            return fn()
+
+    async def arun(self, user, coro_fn):
+        async with self.aslot(user):
+            return await coro_fn()
+
+    @contextmanager
+    def slot(self, user):
+        self.acquire(user)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def aslot(self, user):
+        await self.aacquire(user)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active": self._active,
+                "waiting": sum(len(q) for q in self._waiting.values()),
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "rejected": self.rejected
+            }
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _AsyncCall:
+    __slots__ = ('task', 'waiters')
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time; concurrent callers with the same key
+    share the leader's result (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._async_calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    async def ado(self, key, coro_fn):
+        """
+        Async `do`. The call runs as its own task that every caller awaits through
+        `asyncio.shield`, so a cancelled caller (e.g. a disconnected client) only stops
+        waiting; the call itself is cancelled once no caller is left waiting for it.
+        """
+        # Async callers share one event loop per process, so a plain dict of calls suffices
+        call = self._async_calls.get(key)
+        if call is None:
+            call = self._async_calls[key] = _AsyncCall(asyncio.ensure_future(coro_fn()))
+            call.task.add_done_callback(lambda task: self._async_done(key, call))
+        else:
+            self.coalesced += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if not call.waiters and not call.task.done():
+                call.task.cancel()
+
+    def _async_done(self, key, call):
+        if self._async_calls.get(key) is call:
+            del self._async_calls[key]
+        # Mark the error retrieved even if every caller gave up waiting for it
+        if not call.task.cancelled():
+            call.task.exception()
+
+
+_limiter = None
+_single_flight = SingleFlight()
+_limiter_lock = threading.Lock()
+
+
+def get_limiter() -> FairLimiter:
+    """
+    Returns the process-wide limiter configured by settings.LLM_LIMITS.
+    """
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                config = getattr(settings, 'LLM_LIMITS', {})
+                per_minute = config.get('RATE_PER_MINUTE')
+                _limiter = FairLimiter(
+                    max_concurrent=config.get('MAX_CONCURRENT', 8),
+                    max_wait=config.get('MAX_WAIT', 20.0),
+                    rate_limiter=CacheRateLimiter(per_minute, config.get('RATE_CACHE_ALIAS', 'default'))
+                    if per_minute else None
+                )
+    return _limiter
+
+
+def get_single_flight() -> SingleFlight:
+    return _single_flight
@@ -0,0 +1,210 @@
+"""
+Provider-agnostic LLM client.
+
+All model calls go through an `LLMProvider` obtained from `get_llm()`. The
+provider is built lazily from settings.LLM on first use, so importing this
+module (e.g. from `manage.py` commands) does not pay the SDK import cost.
+
+Providers share the same behaviour:
+    - an explicit per-request timeout,
+    - bounded retries with full-jitter exponential backoff on 429/5xx,
+    - a single long-lived SDK client per process (connection reuse),
+    - errors surface as `LLMError` instead of being swallowed.
+
+`FakeProvider` is a deterministic, offline stand-in for tests and benchmarks.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from typing import Iterator, List
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# HTTP statuses worth retrying: rate limiting and transient server-side failures
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class LLMError(Exception):
+    """
+    Raised when the provider call fails after all retries.
+    `status` carries the provider's HTTP status code when known.
+    """
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class LLMProvider:
+    """
+    Interface every provider implements. `contents` uses Gemini's shape:
+    [{"role": "user" | "model", "parts": [{"text": "..."}]}, ...]
+    """
+
+    model_name = None
+
+    def generate(self, contents: List[dict]) -> str:
+        raise NotImplementedError
+
+    async def agenerate(self, contents: List[dict]) -> str:
+        raise NotImplementedError
+
+    def stream(self, contents: List[dict]) -> Iterator[str]:
+        raise NotImplementedError
+
+    def create_cache(self, contents: List[dict], ttl_seconds: int) -> str:
+        """
+        Uploads `contents` as a provider-side cached prefix and returns its handle.
+        Providers without context caching raise NotImplementedError.
+        """
+        raise NotImplementedError
+
+    def bind_cache(self, handle: str) -> "LLMProvider":
+        """
+        Returns a provider whose requests implicitly start with the cached prefix.
+        """
+        raise NotImplementedError
+
+
+class RetryPolicy:
+    """
+    Bounded retries with full-jitter exponential backoff:
+    attempt n sleeps uniform(0, min(max_delay, base_delay * 2**n)).
+    """
+
+    def __init__(self, max_retries=3, base_delay=0.5, max_delay=8.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    @staticmethod
+    def status_of(error):
+        status = getattr(error, 'status', None)
+        if status is None:
+            status = getattr(error, 'code', None)
+        return status if isinstance(status, int) else None
+
+    def is_retryable(self, error):
+        return self.status_of(error) in RETRYABLE_STATUS_CODES
+
+    def call(self, fn):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return fn()
+            except Exception as e:
+                if attempt == self.max_retries or not self.is_retryable(e):
+                    raise LLMError(str(e), self.status_of(e)) from e
+                delay = self.delay(attempt)
+                logger.warning("LLM call failed (%s), retrying in %.2fs", e, delay)
+                time.sleep(delay)
+
+    async def acall(self, fn):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await fn()
+            except Exception as e:
+                if attempt == self.max_retries or not self.is_retryable(e):
+                    raise LLMError(str(e), self.status_of(e)) from e
+                delay = self.delay(attempt)
+                logger.warning("LLM call failed (%s), retrying in %.2fs", e, delay)
+                await asyncio.sleep(delay)
+
+
+class FakeProvider(LLMProvider):
+    """
+    Deterministic offline provider: the answer depends only on the request, so
+    tests and benchmarks get stable output without network access or API spend.
+    Supports context caching by remembering the cached prefix in-process.
+    """
+
+    _caches = {}
+
+    def __init__(self, model_name="fake", latency=0.0, prefix=None):
+        self.model_name = model_name
+        self.latency = latency
+        self.prefix = prefix or []
+
+    def _answer(self, contents):
+        full = self.prefix + contents
+        digest = hashlib.sha256(json.dumps(full, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+        last = full[-1]["parts"][0]["text"] if full else ""
+        return f"[{self.model_name}:{digest}] {last}"
+
+    def generate(self, contents):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._answer(contents)
+
+    async def agenerate(self, contents):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._answer(contents)
+
+    def stream(self, contents):
+        words = self.generate(contents).split(" ")
+        for i, word in enumerate(words):
+            yield word if i == 0 else " " + word
+
+    def create_cache(self, contents, ttl_seconds):
+        handle = "fake-cache/" + hashlib.sha256(json.dumps(contents, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        self._caches[handle] = contents
+        return handle
+
+    def bind_cache(self, handle):
+        prefix = self._caches.get(handle)
+        if prefix is None:
+            # What the real API answers for an expired or deleted cache
+            raise LLMError(f"Cached content {handle} not found", status=404)
+        return FakeProvider(self.model_name, self.latency, prefix=prefix)
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def build_provider(config) -> LLMProvider:
+    """
+    Instantiates the provider described by an LLM settings dict.
+    """
+    name = config.get('PROVIDER', 'gemini')
+    retry = RetryPolicy(
+        max_retries=config.get('MAX_RETRIES', 3),
+        base_delay=config.get('BACKOFF_BASE', 0.5),
+        max_delay=config.get('BACKOFF_MAX', 8.0),
+    )
+
+    if name == 'fake':
+        return FakeProvider(config.get('MODEL', 'fake'), latency=config.get('FAKE_LATENCY', 0.0))
+    if name == 'gemini':
+        from .gemini import GeminiProvider
+
+        return GeminiProvider(
+            model_name=config.get('MODEL', 'gemini-flash-latest'),
+            api_key=config.get('API_KEY'),
+            timeout=config.get('TIMEOUT', 60),
+            transport=config.get('TRANSPORT'),
+            retry=retry,
+        )
+    raise ValueError(f"Unknown LLM provider: {name}")
+
+
+def get_llm() -> LLMProvider:
+    """
+    Returns the process-wide provider, creating it on first use.
+    """
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                _provider = build_provider(getattr(settings, 'LLM', {}))
+    return _provider
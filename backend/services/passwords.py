@@ -0,0 +1,112 @@
+"""
+Password hashing on a bounded worker pool.
+
+Hashing is deliberately expensive. Run inline on every web thread, a login burst
+(or a credential-stuffing run) takes every core and stalls unrelated endpoints.
+`HashingPool` runs hashes on a fixed number of worker threads (argon2-cffi and
+hashlib release the GIL while hashing), so at most `workers` cores are spent on
+passwords at a time. When more than `max_pending` hashes are queued or running,
+callers are turned away with `HashingBusyError` instead of piling up.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, make_password
+
+# Seconds clients are told to wait when the pool is saturated
+DEFAULT_RETRY_AFTER = 2
+
+
+class HashingBusyError(Exception):
+    """
+    The hashing pool is saturated or the hash did not finish within `max_wait`.
+    """
+
+    def __init__(self, message="Too many password operations in progress, try again shortly",
+                 retry_after=DEFAULT_RETRY_AFTER):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class HashingPool:
+    """
+    :param workers: Threads hashing in parallel (roughly the cores given to hashing)
+    :param max_pending: Hashes allowed queued or running before new ones are rejected
+    :param max_wait: Seconds a caller waits for its result before `HashingBusyError`
+    """
+
+    def __init__(self, workers=2, max_pending=64, max_wait=5.0):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self.completed = 0
+        self.rejected = 0
+
+    def _done(self, future):
+        self._slots.release()
+        if not future.cancelled():
+            self.completed += 1
+
+    def run(self, fn, *args):
+        """
+        Runs fn(*args) on the pool and returns its result.
+        """
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise HashingBusyError()
+
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+        try:
+            return future.result(timeout=self.max_wait)
+        except FutureTimeout:
+            # Only a queued hash can be cancelled; a running one finishes and is discarded
+            future.cancel()
+            self.rejected += 1
+            raise HashingBusyError()
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "completed": self.completed,
+            "rejected": self.rejected
+        }
+
+
+def _verify(raw_password, encoded):
+    rehashed = []
+    # Django calls the setter after a successful check when the stored hash uses an
+    # outdated algorithm or parameters; the new hash is computed here, on the pool.
+    valid = check_password(raw_password, encoded, setter=lambda raw: rehashed.append(make_password(raw)))
+    return valid, rehashed[0] if rehashed else None
+
+
+def _build_pool() -> HashingPool:
+    config = getattr(settings, 'PASSWORD_HASHING', {})
+    return HashingPool(
+        workers=config.get('WORKERS', 2),
+        max_pending=config.get('MAX_PENDING', 64),
+        max_wait=config.get('MAX_WAIT', 5.0)
+    )
+
+
+pool = _build_pool()
+
+
+def hash_password(raw_password):
+    """
+    Hashes with the preferred hasher (settings.PASSWORD_HASHERS[0]) on the pool.
+    """
+    return pool.run(make_password, raw_password)
+
+
+def verify_password(raw_password, encoded):
+    """
+    Checks a password on the pool. Returns (valid, new_hash), where new_hash is set
+    when the password was correct but its stored hash should be replaced.
+    """
+    return pool.run(_verify, raw_password, encoded)
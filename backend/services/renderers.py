@@ -0,0 +1,62 @@
+"""
+JSON rendering backed by orjson (opt in with API_JSON_RENDERER=orjson).
+
+orjson serializes UUIDs, datetimes and dates natively, which is most of what the
+canvas payloads hold besides message text. Output matches DRF's `JSONRenderer`:
+UTC timestamps end in "Z", Decimals become floats, and anything else orjson
+doesn't know falls back to DRF's encoder. Data orjson refuses (e.g. integers
+beyond 64 bits) is rendered by `JSONRenderer` itself.
+
+U+2028 and U+2029 are escaped as `JSONRenderer` does (they end a line in older
+JavaScript). With UNICODE_JSON or COMPACT_JSON off, which orjson cannot follow,
+rendering is left to `JSONRenderer`.
+
+One difference remains: NaN and Infinity floats render as null, where
+`JSONRenderer` raises ValueError (strict JSON). Checking for them would mean a
+second walk over every payload.
+"""
+
+import decimal
+
+import orjson
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+
+LINE_SEPARATOR = '\u2028'.encode('utf-8')
+PARAGRAPH_SEPARATOR = '\u2029'.encode('utf-8')
+
+_fallback = JSONEncoder()
+
+
+def _default(obj):
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    return _fallback.default(obj)
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    Drop-in replacement for `rest_framework.renderers.JSONRenderer`.
+    An `indent` in the Accept header (e.g. from the browsable API) gives 2-space indentation.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.ensure_ascii or not self.compact:
+            return super().render(data, accepted_media_type, renderer_context)
+        options = OPTIONS
+        if self.get_indent(accepted_media_type or '', renderer_context or {}):
+            options |= orjson.OPT_INDENT_2
+        try:
+            rendered = orjson.dumps(data, default=_default, option=options)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # Both only occur inside strings, where the escape means the same character
+        if LINE_SEPARATOR in rendered:
+            rendered = rendered.replace(LINE_SEPARATOR, b'\\u2028')
+        if PARAGRAPH_SEPARATOR in rendered:
+            rendered = rendered.replace(PARAGRAPH_SEPARATOR, b'\\u2029')
+        return rendered
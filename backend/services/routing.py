@@ -0,0 +1,94 @@
+"""
+Read-replica selection for the raw-SQL read endpoints.
+
+The viewsets talk to `django.db.connection` directly, which bypasses
+DATABASE_ROUTERS, so read endpoints pick their connection explicitly with
+`read_connection(user_id)`. It returns the replica configured in
+settings.READ_REPLICA, or the primary when:
+
+    - no replica is configured
+    - a transaction is open on the primary (the read belongs to a write)
+    - the user wrote within STICKY_SECONDS (read-your-writes)
+
+`ReadYourWritesMiddleware` starts that window after every unsafe request
+(POST/PUT/PATCH/DELETE) of an authenticated user; writes made outside a request
+(generation worker, stream replies) call `mark_write` themselves. The window is
+kept in a Django cache so it holds across workers; it should outlast the
+replica's usual lag.
+"""
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, connections
+
+_config = getattr(settings, 'READ_REPLICA', {})
+ALIAS = _config.get('ALIAS', 'replica')
+STICKY_SECONDS = _config.get('STICKY_SECONDS', 5)
+CACHE_ALIAS = _config.get('CACHE_ALIAS', 'default')
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+KEY_PREFIX = "db:wrote:"
+
+
+def replica_configured():
+    return ALIAS in settings.DATABASES
+
+
+def read_connection(user_id=None):
+    """
+    Returns the connection to run a read-only query for `user_id` on.
+    """
+    if not replica_configured() or connection.in_atomic_block:
+        return connection
+    if user_id is not None and caches[CACHE_ALIAS].get(f"{KEY_PREFIX}{user_id}"):
+        return connection
+    return connections[ALIAS]
+
+
+def mark_write(user_id):
+    """
+    Sends the user's reads to the primary for the next STICKY_SECONDS.
+    """
+    if replica_configured() and user_id is not None:
+        caches[CACHE_ALIAS].set(f"{KEY_PREFIX}{user_id}", True, STICKY_SECONDS)
+
+
+async def amark_write(user_id):
+    if replica_configured() and user_id is not None:
+        await caches[CACHE_ALIAS].aset(f"{KEY_PREFIX}{user_id}", True, STICKY_SECONDS)
+
+
+def _writer_id(request):
+    if request.method in SAFE_METHODS:
+        return None
+    # DRF copies the authenticated user onto the Django request; the async views set it themselves
+    user = getattr(request, 'user', None)
+    return user.id if user is not None and user.is_authenticated else None
+
+
+class ReadYourWritesMiddleware:
+    """
+    Marks the user as a recent writer after unsafe requests (see `mark_write`).
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        response = self.get_response(request)
+        mark_write(_writer_id(request))
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        await amark_write(_writer_id(request))
+        return response
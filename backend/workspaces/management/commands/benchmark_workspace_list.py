@@ -0,0 +1,64 @@
+import json
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from rest_framework_simplejwt.tokens import RefreshToken
+
+
+class Command(BaseCommand):
+    help = ("Measures requests/sec of GET /api/workspaces/ against a running server. Start the "
+            "server once per DB_CONNECTIONS mode (e.g. 'none' and 'pool') and compare.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default="http://127.0.0.1:8000/api/workspaces/")
+        parser.add_argument('--email', help="User to authenticate as (default: any user)")
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--seconds', type=float, default=10.0)
+
+    def _token(self, email):
+        # The user's current token version, read like login does: this process's
+        # revocation mirror has not been loaded yet
+        query = f"""
+            SELECT u.id, COALESCE(t.version, 0) FROM users u
+            LEFT JOIN token_versions t ON t.user_id = u.id
+            {"WHERE u.email = %s" if email else ""}
+            LIMIT 1
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(query, [email] if email else [])
+            row = cursor.fetchone()
+        if row is None:
+            raise CommandError("No such user")
+        refresh = RefreshToken()
+        refresh['user_id'] = str(row[0])
+        refresh['ver'] = row[1]
+        return str(refresh.access_token)
+
+    def handle(self, *args, **options):
+        request = urllib.request.Request(
+            options['url'], headers={"Authorization": f"Bearer {self._token(options['email'])}"}
+        )
+        deadline = time.monotonic() + options['seconds']
+
+        def work(_):
+            done, failed = 0, 0
+            while time.monotonic() < deadline:
+                try:
+                    with urllib.request.urlopen(request) as response:
+                        json.loads(response.read())
+                    done += 1
+                except Exception:
+                    failed += 1
+            return done, failed
+
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            results = list(executor.map(work, range(options['concurrency'])))
+
+        done = sum(r[0] for r in results)
+        failed = sum(r[1] for r in results)
+        self.stdout.write(
+            f"{done / options['seconds']:.1f} requests/s ({failed} failed), concurrency {options['concurrency']}"
+        )
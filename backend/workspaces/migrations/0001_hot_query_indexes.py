@@ -0,0 +1,82 @@
+"""
+Baseline schema and indexes for the workspace queries.
+
+The tables are those of the original database.sql, created only if missing: a
+database set up from database.sql is left as is, while a fresh one (including
+the test database) gets the schema every later migration builds on. Unlike
+database.sql it does not create pgcrypto: gen_random_uuid() is built into
+PostgreSQL 13 and later. Beyond
+that this migration only adds access paths, so it is safe to run against a live
+database (CONCURRENTLY avoids blocking writes, which in turn requires running
+outside a transaction).
+
+`users WHERE email = %s` (login) is already served by the index behind the
+UNIQUE constraint on users.email, so nothing is added for it here.
+"""
+
+from django.db import migrations
+
+BASELINE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+        email VARCHAR UNIQUE NOT NULL,
+        password VARCHAR NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+
+    CREATE TABLE IF NOT EXISTS workspaces (
+        id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+        user_id UUID REFERENCES users(id) ON DELETE CASCADE,
+        name VARCHAR NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+
+    CREATE TABLE IF NOT EXISTS chats (
+        id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+        workspace_id UUID REFERENCES workspaces(id) ON DELETE CASCADE,
+        title VARCHAR,
+        x_pos FLOAT NOT NULL DEFAULT 0,
+        y_pos FLOAT NOT NULL DEFAULT 0,
+        width INT DEFAULT 400,
+        height INT DEFAULT 600,
+        z_index INT DEFAULT 1,
+        created_at TIMESTAMPTZ DEFAULT now()
+    );
+
+    CREATE TABLE IF NOT EXISTS messages (
+        id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+        chat_id UUID REFERENCES chats(id) ON DELETE CASCADE,
+        role VARCHAR CHECK (role IN ('user', 'model')),
+        content TEXT NOT NULL,
+        order_index INT NOT NULL,
+        created_at TIMESTAMPTZ DEFAULT now()
+    );
+
+    CREATE TABLE IF NOT EXISTS message_links (
+        id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+        source_message_id UUID REFERENCES messages(id) ON DELETE CASCADE,
+        start_offset INT NOT NULL,
+        end_offset INT NOT NULL,
+        from_chat_id UUID REFERENCES chats(id) ON DELETE CASCADE,
+        to_chat_id UUID REFERENCES chats(id) ON DELETE CASCADE,
+        created_at TIMESTAMPTZ DEFAULT now()
+    );
+"""
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = []
+
+    operations = [
+        # Never dropped on reverse: the data predates the migrations
+        migrations.RunSQL(sql=BASELINE_SCHEMA, reverse_sql=migrations.RunSQL.noop),
+        # WorkspaceViewSet.list and every ownership check: WHERE user_id = %s
+        migrations.RunSQL(
+            sql="CREATE INDEX CONCURRENTLY IF NOT EXISTS workspaces_user_id_created_at_idx "
+                "ON workspaces (user_id, created_at)",
+            reverse_sql="DROP INDEX CONCURRENTLY IF EXISTS workspaces_user_id_created_at_idx",
+        ),
+    ]
@@ -0,0 +1,218 @@
+"""
+Shared authorization for workspace and chat access.
+
+Almost every canvas request first checks that the workspace (or the chat's
+workspace) belongs to the user. `OwnershipCache` remembers positive answers
+for a short TTL:
+
+    (user_id, workspace_id) -> owned
+    (user_id, chat_id)      -> workspace_id
+
+A chat check also requires the workspace entry, so deleting a workspace only
+has to forget that one key. Ownership never moves between users, so a stale
+entry can at worst authorize a request against a row that no longer exists,
+which then finds nothing to act on. Denials are not cached, so a freshly
+created workspace or chat is usable right away.
+
+`forget_workspace` / `forget_chat` only reach every worker when the backend is
+shared (OWNERSHIP_CACHE BACKEND 'django' on a shared CACHES alias). With the
+default 'memory' backend they clear the current process only; the other
+workers keep their entries until the TTL expires.
+"""
+
+import threading
+from typing import Optional
+
+from django.conf import settings
+from django.db import connection
+from rest_framework import permissions
+
+from services.cache import DjangoCacheBackend, LRUCache
+
+WORKSPACE_OWNER_QUERY = "SELECT id FROM workspaces WHERE id = %s AND user_id = %s"
+
+CHAT_WORKSPACE_QUERY = """
+    SELECT w.id FROM chats c
+    JOIN workspaces w ON c.workspace_id = w.id
+    WHERE c.id = %s AND w.user_id = %s
+"""
+
+
+class OwnershipCache:
+    """
+    Caches verified ownership in `backend` (get/set/delete, e.g. `LRUCache`).
+    Keeps hit/miss counters: one per check, a hit being a check answered without a query.
+    """
+
+    KEY_PREFIX = "authz:"
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        # Checks run on many request threads at once; `+=` alone would lose counts
+        self._lock = threading.Lock()
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _workspace_key(self, user_id, workspace_id):
+        return f"{self.KEY_PREFIX}ws:{user_id}:{str(workspace_id).lower()}"
+
+    def _chat_key(self, user_id, chat_id):
+        return f"{self.KEY_PREFIX}chat:{user_id}:{str(chat_id).lower()}"
+
+    def workspace_owned(self, user_id, workspace_id) -> bool:
+        """
+        True if the workspace belongs to the user.
+        """
+        if not workspace_id:
+            return False
+        key = self._workspace_key(user_id, workspace_id)
+        if self.backend.get(key):
+            self._count(True)
+            return True
+        self._count(False)
+
+        with connection.cursor() as cursor:
+            cursor.execute(WORKSPACE_OWNER_QUERY, [workspace_id, user_id])
+            owned = cursor.fetchone() is not None
+        if owned:
+            self.backend.set(key, True)
+        return owned
+
+    def chat_workspace(self, user_id, chat_id) -> Optional[str]:
+        """
+        Returns the id of the chat's workspace if the user owns it, else None.
+        """
+        if not chat_id:
+            return None
+        workspace_id = self.backend.get(self._chat_key(user_id, chat_id))
+        if workspace_id is not None and self.backend.get(self._workspace_key(user_id, workspace_id)):
+            self._count(True)
+            return workspace_id
+        self._count(False)
+
+        with connection.cursor() as cursor:
+            cursor.execute(CHAT_WORKSPACE_QUERY, [chat_id, user_id])
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        # One query proved both facts
+        self.remember_chat(user_id, chat_id, row[0])
+        return row[0]
+
+    async def aworkspace_owned(self, user_id, workspace_id) -> bool:
+        """
+        `workspace_owned` for async views (psycopg async pool).
+        """
+        from canvas.async_db import fetch_one
+
+        if not workspace_id:
+            return False
+        key = self._workspace_key(user_id, workspace_id)
+        if await self.backend.aget(key):
+            self._count(True)
+            return True
+        self._count(False)
+
+        owned = await fetch_one(WORKSPACE_OWNER_QUERY, [workspace_id, user_id]) is not None
+        if owned:
+            await self.backend.aset(key, True)
+        return owned
+
+    async def achat_workspace(self, user_id, chat_id) -> Optional[str]:
+        """
+        `chat_workspace` for async views (psycopg async pool).
+        """
+        from canvas.async_db import fetch_one
+
+        if not chat_id:
+            return None
+        workspace_id = await self.backend.aget(self._chat_key(user_id, chat_id))
+        if workspace_id is not None and await self.backend.aget(self._workspace_key(user_id, workspace_id)):
+            self._count(True)
+            return workspace_id
+        self._count(False)
+
+        row = await fetch_one(CHAT_WORKSPACE_QUERY, [chat_id, user_id])
+        if row is None:
+            return None
+        await self.backend.aset(self._chat_key(user_id, chat_id), row[0])
+        await self.backend.aset(self._workspace_key(user_id, row[0]), True)
+        return row[0]
+
+    def remember_workspace(self, user_id, workspace_id):
+        self.backend.set(self._workspace_key(user_id, workspace_id), True)
+
+    def remember_chat(self, user_id, chat_id, workspace_id):
+        self.backend.set(self._chat_key(user_id, chat_id), workspace_id)
+        self.remember_workspace(user_id, workspace_id)
+
+    def forget_workspace(self, user_id, workspace_id):
+        # Chat entries of the workspace become unusable along with it (see chat_workspace)
+        self.backend.delete(self._workspace_key(user_id, workspace_id))
+
+    def forget_chat(self, user_id, chat_id):
+        self.backend.delete(self._chat_key(user_id, chat_id))
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0
+        }
+
+
+def _build_ownership_cache() -> OwnershipCache:
+    """
+    Creates the cache described by settings.OWNERSHIP_CACHE. With BACKEND None the
+    cache keeps nothing and every check queries the database.
+    """
+    config = getattr(settings, 'OWNERSHIP_CACHE', {})
+    backend_name = config.get('BACKEND', 'memory')
+    ttl = config.get('TTL', 60)
+
+    if backend_name == 'django':
+        backend = DjangoCacheBackend(alias=config.get('ALIAS', 'default'), ttl=ttl)
+    elif backend_name == 'memory':
+        backend = LRUCache(max_entries=config.get('MAX_ENTRIES', 10000), ttl=ttl)
+    else:
+        backend = LRUCache(max_entries=0, ttl=0)
+    return OwnershipCache(backend)
+
+
+ownership = _build_ownership_cache()
+
+
+def _param(request, name):
+    value = request.query_params.get(name)
+    if value is None and isinstance(request.data, dict):
+        value = request.data.get(name)
+    return value
+
+
+class IsChatOwner(permissions.BasePermission):
+    """
+    Grants access when the chat of a chat detail route (its `pk`), or else the one
+    named by ?chat_id= / body chat_id, belongs to one of the user's workspaces.
+    Denials render as {"error": "Access denied"} like the rest of the API.
+    A request naming no chat passes, so the view can answer it with its own 400.
+    """
+
+    message = {"error": "Access denied"}
+
+    def has_permission(self, request, view):
+        if not (request.user and request.user.is_authenticated):
+            return False
+        chat_id = view.kwargs.get('pk') or _param(request, 'chat_id')
+        if not chat_id:
+            return True
+        return ownership.chat_workspace(request.user.id, chat_id) is not None
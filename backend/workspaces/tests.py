@@ -1,3 +1,276 @@
-from django.test import TestCase
+import threading
+from types import SimpleNamespace
+from unittest import skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, connections, transaction
+from django.test import TestCase, TransactionTestCase
+from rest_framework.test import APIClient
+
+from services import routing
+from services.cache import LRUCache
+from services.db import fetch_all, stream
+from .permissions import OwnershipCache, ownership
+from .views import WORKSPACE_LIST_QUERY
+
+
+class WorkspaceQueryTests(TestCase):
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO users (email, password) VALUES ('owner@example.com', 'x') RETURNING id")
+            self.user_id = cursor.fetchone()[0]
+            cursor.execute(
+                "INSERT INTO workspaces (user_id, name) VALUES (%s, 'First'), (%s, 'Second')",
+                [self.user_id, self.user_id]
+            )
+        self.client = APIClient()
+        self.client.force_authenticate(user=SimpleNamespace(id=self.user_id, is_authenticated=True))
+
+    def test_list_uses_index(self):
+        # The table is tiny: with sequential scans off the planner shows whether an index applies
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute(f"EXPLAIN {WORKSPACE_LIST_QUERY.sql}", [self.user_id])
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        self.assertNotIn("Seq Scan", plan)
+
+    def test_list(self):
+        response = self.client.get("/api/workspaces/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(w["name"] for w in response.data["data"]), ["First", "Second"])
+
+    def test_queries_run_through_django_cursor_wrapper(self):
+        seen = []
+
+        def record(execute, sql, params, many, context):
+            seen.append(sql)
+            return execute(sql, params, many, context)
+
+        # A plain string is never prepared, so it must take the wrapper path
+        with connection.execute_wrapper(record), self.assertNumQueries(1):
+            rows = fetch_all(WORKSPACE_LIST_QUERY.sql, [self.user_id])
+        self.assertEqual(seen, [WORKSPACE_LIST_QUERY.sql])
+        self.assertEqual(sorted(row["name"] for row in rows), ["First", "Second"])
+
+    def test_stream(self):
+        rows = list(stream("SELECT n FROM generate_series(1, 250) AS n", as_dicts=False))
+        self.assertEqual(rows, [(n,) for n in range(1, 251)])
+
+
+class WorkspaceCanvasTests(TestCase):
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO users (email, password) VALUES ('owner@example.com', 'x') RETURNING id")
+            self.user_id = cursor.fetchone()[0]
+            cursor.execute("INSERT INTO workspaces (user_id, name) VALUES (%s, 'Canvas') RETURNING id", [self.user_id])
+            self.workspace_id = cursor.fetchone()[0]
+            cursor.execute(
+                "INSERT INTO chats (workspace_id, title) VALUES (%s, 'Long'), (%s, 'Short') RETURNING id",
+                [self.workspace_id, self.workspace_id]
+            )
+            self.long_id, self.short_id = (row[0] for row in cursor.fetchall())
+            cursor.execute(
+                """
+                INSERT INTO messages (chat_id, role, content, order_index)
+                SELECT %s, 'user', 'message ' || i, i FROM generate_series(0, 4) AS i
+                """,
+                [self.long_id]
+            )
+            # A reply slot still waiting for its answer is never shown
+            cursor.execute(
+                """
+                INSERT INTO messages (chat_id, role, content, order_index, is_hidden)
+                VALUES (%s, 'model', '', 5, TRUE), (%s, 'user', 'only', 0, FALSE)
+                """,
+                [self.long_id, self.short_id]
+            )
+            cursor.execute(
+                """
+                INSERT INTO message_links (source_message_id, start_offset, end_offset, from_chat_id, to_chat_id)
+                SELECT id, 0, 7, chat_id, %s FROM messages WHERE chat_id = %s AND order_index = 4
+                RETURNING id
+                """,
+                [self.short_id, self.long_id]
+            )
+            self.link_id = cursor.fetchone()[0]
+        self.client = APIClient()
+        self.client.force_authenticate(user=SimpleNamespace(id=self.user_id, is_authenticated=True))
+
+    def snapshot(self, query=""):
+        return self.client.get(f"/api/workspaces/{self.workspace_id}/canvas/{query}")
+
+    def test_snapshot_returns_chats_links_and_last_messages(self):
+        with self.assertNumQueries(4):
+            response = self.snapshot("?messages_limit=3")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["workspace"]["name"], "Canvas")
+        self.assertIsInstance(response.data["version"], int)
+
+        chats = {chat["title"]: chat for chat in response.data["chats"]}
+        self.assertEqual(set(chats), {"Long", "Short"})
+        self.assertEqual([m["content"] for m in chats["Long"]["messages"]], ["message 2", "message 3", "message 4"])
+        self.assertTrue(chats["Long"]["has_more_messages"])
+        self.assertEqual([m["content"] for m in chats["Short"]["messages"]], ["only"])
+        self.assertFalse(chats["Short"]["has_more_messages"])
+
+        [link] = response.data["links"]
+        self.assertEqual(link["id"], self.link_id)
+        self.assertEqual((link["from_chat_id"], link["to_chat_id"]), (self.long_id, self.short_id))
+
+    def test_zero_limit_only_reports_whether_messages_exist(self):
+        response = self.snapshot("?messages_limit=0")
+        self.assertEqual(response.status_code, 200)
+        for chat in response.data["chats"]:
+            self.assertEqual(chat["messages"], [])
+            self.assertTrue(chat["has_more_messages"])
+
+    def test_invalid_limit(self):
+        self.assertEqual(self.snapshot("?messages_limit=many").status_code, 400)
+
+    def test_other_users_workspace_is_not_found(self):
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO users (email, password) VALUES ('other@example.com', 'x') RETURNING id")
+            other_id = cursor.fetchone()[0]
+        self.client.force_authenticate(user=SimpleNamespace(id=other_id, is_authenticated=True))
+        self.assertEqual(self.snapshot().status_code, 404)
+
+
+class OwnershipCacheTests(TestCase):
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO users (email, password) VALUES ('owner@example.com', 'x'), ('other@example.com', 'x') "
+                "RETURNING id"
+            )
+            self.user_id, self.other_id = [row[0] for row in cursor.fetchall()]
+            cursor.execute("INSERT INTO workspaces (user_id, name) VALUES (%s, 'Mine') RETURNING id", [self.user_id])
+            self.workspace_id = cursor.fetchone()[0]
+            cursor.execute("INSERT INTO chats (workspace_id, title) VALUES (%s, 'Chat') RETURNING id", [self.workspace_id])
+            self.chat_id = str(cursor.fetchone()[0])
+        self.cache = OwnershipCache(LRUCache(max_entries=100, ttl=60))
+
+    def test_chat_check_counts_once(self):
+        self.assertEqual(self.cache.chat_workspace(self.user_id, self.chat_id), self.workspace_id)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.cache.chat_workspace(self.user_id, self.chat_id), self.workspace_id)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_forgotten_workspace_invalidates_its_chats(self):
+        self.cache.chat_workspace(self.user_id, self.chat_id)
+        self.cache.forget_workspace(self.user_id, self.workspace_id)
+        with self.assertNumQueries(1):
+            self.cache.chat_workspace(self.user_id, self.chat_id)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_permission_denies_other_users_chat(self):
+        client = APIClient()
+        client.force_authenticate(user=SimpleNamespace(id=self.other_id, is_authenticated=True))
+        # The detail route's pk is checked, not a chat_id smuggled into the body
+        ownership.remember_chat(self.other_id, "00000000-0000-0000-0000-000000000000", self.workspace_id)
+        self.addCleanup(ownership.forget_workspace, self.other_id, self.workspace_id)
+        response = client.patch(
+            f"/api/canvas/chats/{self.chat_id}/",
+            {"x_pos": 10, "chat_id": "00000000-0000-0000-0000-000000000000"}, format="json"
+        )
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data, {"error": "Access denied"})
+
+        response = client.get("/api/canvas/messages/", {"chat_id": self.chat_id})
+        self.assertEqual(response.status_code, 403)
+
+    def test_missing_chat_id_reaches_the_view(self):
+        client = APIClient()
+        client.force_authenticate(user=SimpleNamespace(id=self.user_id, is_authenticated=True))
+        response = client.post("/api/canvas/messages/", {"content": "Hello"}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {"error": "chat_id and content are required"})
+
+    def test_layout_save_of_deleted_chat(self):
+        client = APIClient()
+        client.force_authenticate(user=SimpleNamespace(id=self.user_id, is_authenticated=True))
+        # Ownership still cached from before the delete
+        ownership.remember_chat(self.user_id, self.chat_id, self.workspace_id)
+        self.addCleanup(ownership.forget_workspace, self.user_id, self.workspace_id)
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM chats WHERE id = %s", [self.chat_id])
+        response = client.patch(f"/api/canvas/chats/{self.chat_id}/", {"x_pos": 10}, format="json")
+        self.assertEqual(response.status_code, 404)
+
+    def test_counters_under_concurrency(self):
+        self.cache.remember_chat(self.user_id, self.chat_id, self.workspace_id)
+
+        def check():
+            for _ in range(500):
+                self.cache.chat_workspace(self.user_id, self.chat_id)
+
+        threads = [threading.Thread(target=check) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.cache.stats()["hits"], 4000)
+
+
+def _separate_replica():
+    return routing.replica_configured() and not settings.DATABASES[routing.ALIAS]['TEST'].get('MIRROR')
+
+
+@skipUnless(_separate_replica(), "needs a replica test database: DB_REPLICA_HOST with DB_REPLICA_TEST_MIRROR=false")
+class ReadReplicaRoutingTests(TransactionTestCase):
+    """
+    Runs the read endpoints against two databases. The same user and workspace exist on
+    both, under different names, so each response shows which database answered it.
+    (TransactionTestCase: inside TestCase's transaction every read stays on the primary.)
+    """
+
+    # The runner collects this even from skipped classes, so only name the replica when it exists
+    databases = {'default', routing.ALIAS} if _separate_replica() else {'default'}
+
+    def setUp(self):
+        caches[routing.CACHE_ALIAS].clear()
+        self.user_id = None
+        for alias in ('default', routing.ALIAS):
+            with connections[alias].cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO users (id, email, password) VALUES (COALESCE(%s, gen_random_uuid()), %s, 'x') "
+                    "RETURNING id",
+                    [self.user_id, "owner@example.com"]
+                )
+                self.user_id = cursor.fetchone()[0]
+                cursor.execute(
+                    "INSERT INTO workspaces (user_id, name) VALUES (%s, %s)", [self.user_id, alias]
+                )
+        self.client = APIClient()
+        self.client.force_authenticate(user=SimpleNamespace(id=self.user_id, is_authenticated=True))
+
+    def tearDown(self):
+        # The raw-SQL tables are not Django models, so TransactionTestCase's flush skips them
+        for alias in ('default', routing.ALIAS):
+            with connections[alias].cursor() as cursor:
+                cursor.execute("DELETE FROM users WHERE id = %s", [self.user_id])
+
+    def listed_names(self):
+        response = self.client.get("/api/workspaces/")
+        self.assertEqual(response.status_code, 200)
+        return sorted(w["name"] for w in response.data["data"])
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(self.listed_names(), [routing.ALIAS])
+
+    def test_reads_follow_own_writes_to_primary(self):
+        response = self.client.post("/api/workspaces/", {"name": "new"}, format="json")
+        self.assertEqual(response.status_code, 201)
+        # Not replicated: only the primary has the new workspace
+        self.assertEqual(self.listed_names(), ["default", "new"])
+
+        caches[routing.CACHE_ALIAS].clear()
+        self.assertEqual(self.listed_names(), [routing.ALIAS])
+
+    def test_reads_in_transaction_stay_on_primary(self):
+        with transaction.atomic():
+            self.assertIs(routing.read_connection(self.user_id), connection)
+        self.assertIs(routing.read_connection(self.user_id), connections[routing.ALIAS])
@@ -1,9 +1,57 @@
 from rest_framework import viewsets, status, permissions
 from rest_framework.response import Response
-from django.db import connection
+from rest_framework.decorators import action
+from django.db import connection, transaction
+from canvas.persistence import notify
+from services.db import Query, execute, fetch_all, fetch_one
+from services.routing import read_connection
+from .permissions import ownership
 
 DEFAULT_WORKSPACE_NAME = "New Workspace"
 
+WORKSPACE_LIST_QUERY = Query(
+    "workspaces.list", "SELECT id, user_id, name, created_at FROM workspaces WHERE user_id = %s"
+)
+WORKSPACE_QUERY = Query(
+    "workspaces.retrieve", "SELECT id, name, created_at FROM workspaces WHERE id = %s AND user_id = %s"
+)
+SNAPSHOT_WORKSPACE_QUERY = Query(
+    "workspaces.canvas.workspace",
+    "SELECT id, name, created_at, version FROM workspaces WHERE id = %s AND user_id = %s"
+)
+SNAPSHOT_CHATS_QUERY = Query("workspaces.canvas.chats", """
+    SELECT id, title, x_pos, y_pos, width, height, z_index, created_at
+    FROM chats
+    WHERE workspace_id = %s
+    ORDER BY created_at ASC
+""")
+SNAPSHOT_LINKS_QUERY = Query("workspaces.canvas.links", """
+    SELECT ml.id, ml.source_message_id, ml.start_offset, ml.end_offset,
+           ml.from_chat_id, ml.to_chat_id, ml.created_at
+    FROM message_links ml
+    JOIN chats c ON ml.from_chat_id = c.id
+    WHERE c.workspace_id = %s
+""")
+# Last N visible messages per chat. The LATERAL subquery walks the (chat_id, order_index)
+# index backwards once per chat; one extra row is fetched to tell whether older messages exist.
+SNAPSHOT_MESSAGES_QUERY = Query("workspaces.canvas.messages", """
+    SELECT m.chat_id, m.id, m.role, m.content, m.order_index, m.created_at
+    FROM chats c
+    CROSS JOIN LATERAL (
+        SELECT chat_id, id, role, content, order_index, created_at
+        FROM messages
+        WHERE chat_id = c.id AND is_hidden = FALSE
+        ORDER BY order_index DESC
+        LIMIT %s
+    ) m
+    WHERE c.workspace_id = %s
+    ORDER BY m.chat_id, m.order_index ASC
+""")
+
+# Number of most recent visible messages returned per chat by the canvas snapshot
+DEFAULT_SNAPSHOT_MESSAGES = 20
+MAX_SNAPSHOT_MESSAGES = 100
+
 class WorkspaceViewSet(viewsets.ViewSet):
     """
     ViewSet for managing user workspaces using raw SQL queries.
@@ -20,14 +68,8 @@ class WorkspaceViewSet(viewsets.ViewSet):
         Uses a dictionary mapping to return structured data from raw SQL rows.
         """
         current_user_id = request.user.id
-        query = "SELECT id, user_id, name, created_at FROM workspaces WHERE user_id = %s"
-        
-        with connection.cursor() as cursor:
-            cursor.execute(query, [current_user_id])
-            columns = [col[0] for col in cursor.description]
-            rows = cursor.fetchall()
-            response = [dict(zip(columns, r)) for r in rows]
-            return Response({"data": response})
+        rows = fetch_all(WORKSPACE_LIST_QUERY, [current_user_id], using=read_connection(current_user_id))
+        return Response({"data": rows})
 
     def create(self, request):
         """
@@ -40,15 +82,14 @@ class WorkspaceViewSet(viewsets.ViewSet):
         
         query = "INSERT INTO workspaces(user_id, name) VALUES (%s, %s) RETURNING id, created_at"
         try:
-            with connection.cursor() as cursor:
-                cursor.execute(query, [current_user_id, name])
-                row = cursor.fetchone()
-                return Response({
-                    "id": row[0],
-                    "user_id": current_user_id,
-                    "name": name,
-                    "created_at": row[1]
-                }, status=status.HTTP_201_CREATED)
+            row = fetch_one(query, [current_user_id, name], as_dicts=False)
+            ownership.remember_workspace(current_user_id, row[0])
+            return Response({
+                "id": row[0],
+                "user_id": current_user_id,
+                "name": name,
+                "created_at": row[1]
+            }, status=status.HTTP_201_CREATED)
         except Exception:
             return Response({"error": "Failed to create workspace"}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -61,20 +102,11 @@ class WorkspaceViewSet(viewsets.ViewSet):
         """
         current_user_id = request.user.id
         
-        query = "SELECT id, name, created_at FROM workspaces WHERE id = %s AND user_id = %s"
+        row = fetch_one(WORKSPACE_QUERY, [pk, current_user_id], using=read_connection(current_user_id))
+        if not row:
+            return Response({"error": "Workspace not found or access denied"}, status=status.HTTP_404_NOT_FOUND)
         
-        with connection.cursor() as cursor:
-            cursor.execute(query, [pk, current_user_id])
-            row = cursor.fetchone()
-            
-            if not row:
-                return Response({"error": "Workspace not found or access denied"}, status=status.HTTP_404_NOT_FOUND)
-            
-            return Response({
-                "id": row[0],
-                "name": row[1],
-                "created_at": row[2]
-            })
+        return Response(row)
 
     def partial_update(self, request, pk=None):
         """
@@ -90,11 +122,8 @@ class WorkspaceViewSet(viewsets.ViewSet):
 
         query = "UPDATE workspaces SET name = %s WHERE id = %s AND user_id = %s"
         
-        with connection.cursor() as cursor:
-            cursor.execute(query, [new_name, pk, current_user_id])
-            
-            if cursor.rowcount == 0:
-                return Response({"error": "Workspace not found or access denied"}, status=status.HTTP_404_NOT_FOUND)
+        if execute(query, [new_name, pk, current_user_id]) == 0:
+            return Response({"error": "Workspace not found or access denied"}, status=status.HTTP_404_NOT_FOUND)
         
         return Response({"message": "Workspace renamed successfully", "new_name": new_name})
 
@@ -110,10 +139,75 @@ class WorkspaceViewSet(viewsets.ViewSet):
         # SQL will automatically cascade delete chats/messages
         query = "DELETE FROM workspaces WHERE id = %s AND user_id = %s"
         
-        with connection.cursor() as cursor:
-            cursor.execute(query, [pk, current_user_id])
-            
-            if cursor.rowcount == 0:
-                return Response({"error": "Workspace not found or access denied"}, status=status.HTTP_404_NOT_FOUND)
-        
-        return Response({"message": "Workspace and all associated data deleted"}, status=status.HTTP_204_NO_CONTENT)
\ No newline at end of file
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT c.id FROM chats c
+                    JOIN workspaces w ON c.workspace_id = w.id
+                    WHERE w.id = %s AND w.user_id = %s
+                    """,
+                    [pk, current_user_id]
+                )
+                chat_ids = [row[0] for row in cursor.fetchall()]
+                cursor.execute(query, [pk, current_user_id])
+                if cursor.rowcount == 0:
+                    return Response({"error": "Workspace not found or access denied"}, status=status.HTTP_404_NOT_FOUND)
+                # Open sockets re-check ownership on chat.deleted and close (see canvas.realtime)
+                for chat_id in chat_ids:
+                    notify(cursor, pk, "chat.deleted", {"id": chat_id})
+
+        ownership.forget_workspace(current_user_id, pk)
+        return Response({"message": "Workspace and all associated data deleted"}, status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=True, methods=['get'])
+    def canvas(self, request, pk=None):
+        """
+        GET /workspaces/{id}/canvas/?messages_limit={n}
+        Returns everything needed to open a canvas in one response: the workspace,
+        its chat windows, the arrows between them and the last `messages_limit`
+        visible messages of every window (with a `has_more_messages` flag for
+        lazily loading older ones). Built from four set-based queries regardless
+        of how many windows the canvas holds. `version` is the starting point for
+        `?since=` delta syncs (see `canvas.sync`).
+        """
+        current_user_id = request.user.id
+
+        try:
+            limit = int(request.query_params.get('messages_limit', DEFAULT_SNAPSHOT_MESSAGES))
+        except ValueError:
+            return Response({"error": "messages_limit must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+        limit = max(0, min(limit, MAX_SNAPSHOT_MESSAGES))
+
+        db = read_connection(current_user_id)
+
+        # 1. Workspace (doubles as the ownership check)
+        workspace = fetch_one(SNAPSHOT_WORKSPACE_QUERY, [pk, current_user_id], using=db)
+        if not workspace:
+            return Response({"error": "Workspace not found or access denied"}, status=status.HTTP_404_NOT_FOUND)
+        # Read first: later `?since=` syncs may repeat a change but never miss one
+        version = workspace.pop("version")
+
+        # 2. Chat windows
+        chats = fetch_all(SNAPSHOT_CHATS_QUERY, [pk], using=db)
+
+        # 3. Arrows
+        links = fetch_all(SNAPSHOT_LINKS_QUERY, [pk], using=db)
+
+        # 4. Last N visible messages per chat (bounded by limit + 1 per chat), grouped by chat
+        messages_by_chat = {}
+        for message in fetch_all(SNAPSHOT_MESSAGES_QUERY, [limit + 1, pk], using=db):
+            messages_by_chat.setdefault(message.pop("chat_id"), []).append(message)
+
+        for chat in chats:
+            chat_messages = messages_by_chat.get(chat["id"], [])
+            chat["has_more_messages"] = len(chat_messages) > limit
+            # Rows are ascending, so the surplus row is the oldest one
+            chat["messages"] = chat_messages[-limit:] if limit else []
+
+        return Response({
+            "workspace": workspace,
+            "version": version,
+            "chats": chats,
+            "links": links
+        })
\ No newline at end of file